@@ -1,4 +1,3 @@
-import smbus
 import time
 
 # Config Register (R/W)
@@ -57,8 +56,12 @@ class Mode:
 
 
 class INA219:
-    def __init__(self, i2c_bus=1, addr=0x40):
-        self.bus = smbus.SMBus(i2c_bus);
+    def __init__(self, i2c_bus=1, addr=0x40, bus=None):
+        # Pass an already open bus, or a fake one, to skip opening i2c_bus
+        if bus is None:
+            import smbus
+            bus = smbus.SMBus(i2c_bus)
+        self.bus = bus
         self.addr = addr
 
         # Set chip to known config values to start
@@ -163,30 +166,43 @@ class INA219:
                       self.mode
         self.write(_REG_CONFIG,self.config)
 
-    def getShuntVoltage_mV(self):
-        self.write(_REG_CALIBRATION,self._cal_value)
-        value = self.read(_REG_SHUNTVOLTAGE)
+    def read_signed(self,address):
+        value = self.read(address)
         if value > 32767:
-            value -= 65535
-        return value * 0.01
+            value -= 65536
+        return value
+
+    def getShuntVoltage_mV(self):
+        return self.read_signed(_REG_SHUNTVOLTAGE) * 0.01
 
     def getBusVoltage_V(self):
-        self.write(_REG_CALIBRATION,self._cal_value)
-        self.read(_REG_BUSVOLTAGE)
         return (self.read(_REG_BUSVOLTAGE) >> 3) * 0.004
 
     def getCurrent_mA(self):
-        value = self.read(_REG_CURRENT)
-        if value > 32767:
-            value -= 65535
-        return value * self._current_lsb
+        return self.read_signed(_REG_CURRENT) * self._current_lsb
 
     def getPower_W(self):
-        self.write(_REG_CALIBRATION,self._cal_value)
-        value = self.read(_REG_POWER)
-        if value > 32767:
-            value -= 65535
-        return value * self._power_lsb
+        return self.read_signed(_REG_POWER) * self._power_lsb
+
+    def read_all(self):
+        """Reads bus voltage (V), shunt voltage (mV), current (mA) and power (W)
+           in one pass.
+           The calibration and config registers are only written again if the
+           chip has lost them, for instance after a brownout: it then reports
+           no current even though there's a voltage across the shunt.
+        """
+        shunt = self.read_signed(_REG_SHUNTVOLTAGE)
+        current = self.read_signed(_REG_CURRENT)
+        if current == 0 and shunt != 0:
+            # A brownout resets every register, not just the calibration
+            self.write(_REG_CALIBRATION,self._cal_value)
+            self.write(_REG_CONFIG,self.config)
+            # The current and power registers update on the next conversion
+            time.sleep(0.07)
+            current = self.read_signed(_REG_CURRENT)
+        power = self.read_signed(_REG_POWER)
+        bus = self.read(_REG_BUSVOLTAGE) >> 3
+        return bus * 0.004, shunt * 0.01, current * self._current_lsb, power * self._power_lsb
         
 if __name__=='__main__':
 
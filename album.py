@@ -1,6 +1,9 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
 import logging
 import os
 import pathlib
+import threading
 import cv2
 
 from kctypes import Direction
@@ -31,17 +34,37 @@ class Album():
     def pic_path(self, value):
         self._pic_path = value
 
+    # preview path is the hidden directory holding display-sized previews of
+    # the files in pic path
+    @property
+    def preview_path(self):
+        return os.path.join(self._pic_path, constants.PREVIEW_DIR)
+
     # Store the current position for each gallery or else use 0
     @property
     def position(self):
         return self._position
 
-    def __init__(self, base_dir, id="default"):
+    # The number of files in the current gallery, read from the in-memory index
+    @property
+    def gallery_size(self):
+        return len(self._files)
+
+    def __init__(self, base_dir, id="default", watch_interval=constants.ALBUM_WATCH_INTERVAL):
         logger.debug('Function Album __init__')
         logger.debug('Received %s as base_dir for NFC card', base_dir)
         logger.debug('Received %s as id for NFC card', id)
         self.base_dir = base_dir
+        # The index is a list of file entries sorted by capture timestamp, with
+        # a parallel list of sort keys so that new files can be bisected in.
+        # The lock guards both lists against the watcher thread.
+        self._lock = threading.Lock()
+        self._files = []
+        self._keys = []
+        self._dir_mtime = None
         self.activate_id(id)
+        self._watcher = AlbumWatcher(self, watch_interval)
+        self._watcher.start()
 
     def maybe_create_picture_directory(self):
         """
@@ -61,6 +84,10 @@ class Album():
             logger.info('Creating directory %s', self._pic_path)
             # Create the folder
             os.makedirs(self._pic_path)
+        # And the hidden folder for previews within it
+        if not (os.path.exists(self.preview_path)):
+            logger.info('Creating preview directory %s', self.preview_path)
+            os.makedirs(self.preview_path)
 
     def activate_id(self, id):
         """
@@ -77,6 +104,7 @@ class Album():
         self.maybe_create_picture_directory()
         logger.info('Setting gallery file index to 0')
         self._position = 0
+        self.refresh_index()
 
     def deactivate_id(self):
         """
@@ -89,49 +117,187 @@ class Album():
         logger.debug('Function deactivate_id')
         self.activate_id("default")
 
+    def close(self):
+        """
+        close stops the background watcher that keeps the file index in sync
+        with changes made outside of the app.
+        """
+        logger.debug('Function close')
+        self._watcher.stop()
+
+    def refresh_index(self):
+        """
+        refresh_index rebuilds the in-memory file index from a full scan of
+        the current gallery directory. This is the only place the directory
+        gets listed, and it is called on activation and by the watcher when
+        the directory has changed - never from the render loop.
+        The gallery keeps showing the same file across the rebuild, or the one
+        after it if it was removed.
+        """
+        logger.debug('Function refresh_index')
+        pic_path = self._pic_path
+        dir_mtime = os.stat(pic_path).st_mtime_ns
+        entries = []
+        with os.scandir(pic_path) as it:
+            for dir_entry in it:
+                # Skip hidden files and anything that isn't a regular file
+                if dir_entry.name.startswith('.') or not dir_entry.is_file():
+                    continue
+                entries.append(self._make_entry(pic_path, dir_entry.name, dir_entry.stat().st_mtime))
+        entries.sort(key=lambda entry: entry["key"])
+        with self._lock:
+            # The active card may have changed while we were scanning
+            if pic_path != self._pic_path:
+                return
+            current = self._files[self._position] if self._files else None
+            self._files = entries
+            self._keys = [entry["key"] for entry in entries]
+            self._dir_mtime = dir_mtime
+            # The old index belongs to the last card straight after activation
+            if current is not None and os.path.dirname(current["filename"]) == pic_path:
+                self._position = bisect_left(self._keys, current["key"])
+            self._clamp_position()
+        logger.info('Indexed %s files in %s', len(entries), pic_path)
+
+    def add_file(self, filename):
+        """
+        add_file inserts a newly written file into the index at its sorted
+        position, without rescanning the directory, so it's in the gallery
+        straight away. It is used by the capture code as soon as a file has
+        been written. The watcher still rescans the directory afterwards in the
+        background: the directory's mtime can't tell this file apart from one
+        added by something else at the same moment.
+        @param filename the full path of the new file
+        """
+        logger.debug('Function add_file')
+        pic_path, name = os.path.split(filename)
+        if os.path.normpath(pic_path) != os.path.normpath(self._pic_path):
+            logger.info('Not indexing %s since it is outside the active gallery', filename)
+            return
+        entry = self._make_entry(self._pic_path, name, os.path.getmtime(filename))
+        with self._lock:
+            index = bisect_right(self._keys, entry["key"])
+            if index > 0 and self._files[index - 1]["filename"] == entry["filename"]:
+                return
+            self._keys.insert(index, entry["key"])
+            self._files.insert(index, entry)
+            # Keep showing the same file if the new one sorts before it
+            if index <= self._position and len(self._files) > 1:
+                self._position += 1
+        logger.info('Added %s to the gallery index at position %s', name, index)
+
+    def directory_changed(self):
+        """
+        directory_changed checks the modification time of the gallery
+        directory against the one recorded at the last scan. A directory's
+        mtime changes whenever entries are added, removed or renamed, so this
+        single stat is enough to tell whether the index is stale.
+        """
+        try:
+            return os.stat(self._pic_path).st_mtime_ns != self._dir_mtime
+        except FileNotFoundError:
+            return False
+
     def load_image(self):
         """
         load_image grabs the filename and extension for the file in the current
         gallery _pic_path filepath, at the current _position index in the file
-        list, and returns them.
+        index, and returns them. If the gallery is empty, None is returned.
         The function is called load_image, but it'll load any kind of file, so
         be careful to only store images or videos in these folders.
         """
-        logger.debug('Function load_image')
-        logger.debug('Fetching list of files in the gallery directory')
-        current_gallery_files = [name for name in os.listdir(self._pic_path) if os.path.isfile(os.path.join(self._pic_path,name))]
-        # This will fail if the directory has no pictures in it
-        logger.debug('Fetching filename of file at position %s', self._position)
-        filename = current_gallery_files[self._position]
-        extension = pathlib.Path(filename).suffix
-        logger.info('Found filename %s with extension %s', filename, extension)
-        return {
-            "filename": os.path.join(self._pic_path,filename),
-            "extension": extension
-        }
+        with self._lock:
+            if not self._files:
+                return None
+            return self._files[self._position]
 
-    def gallery_scroll(self, direction):
+    def peek(self, offset):
+        """
+        peek returns the index entry at an offset from the current position,
+        wrapping around the ends of the gallery, without moving the position.
+        If the gallery is empty, None is returned.
+        @param offset how many files forward (positive) or back (negative)
+        """
+        with self._lock:
+            if not self._files:
+                return None
+            return self._files[(self._position + offset) % len(self._files)]
+
+    def entries(self):
+        """
+        entries returns a copy of the whole index, in gallery order, for
+        background jobs that work through every file.
+        """
+        with self._lock:
+            return list(self._files)
+
+    def gallery_scroll(self, direction, steps=1):
         """
         gallery_scroll steps forward or backward through the current gallery
         directory by incrementing or decrementing the _position variable.
         @param direction a Direction enum, either Direction.FWD or Direction.REV
+        @param steps how many files to move by
         """
         logger.debug('Function gallery_scroll')
-        logger.debug('Calculating current size of list of files in the gallery directory')
-        self.gallery_size = len([name for name in os.listdir(self._pic_path) if os.path.isfile(os.path.join(self._pic_path,name))])
-        if direction == Direction.FWD:
-            logger.debug('Moving forward in gallery')
-            self._position += 1
-            if self._position >= self.gallery_size:
-                self._position = 0
-            logger.info('New file index is %s', self._position)
-        else:
-            logger.debug('Moving backward in gallery')
-            self._position -= 1
-            if self._position <0:
-                self._position = self.gallery_size - 1
-            logger.info('New file index is %s', self._position)
-        
+        with self._lock:
+            if not self._files:
+                return
+            if direction == Direction.FWD:
+                self._position = (self._position + steps) % len(self._files)
+            else:
+                self._position = (self._position - steps) % len(self._files)
+        logger.debug('New file index is %s', self._position)
+
+    def _clamp_position(self):
+        # Files may have been removed behind our back, so keep the position
+        # inside the index
+        if self._position >= len(self._files):
+            self._position = max(len(self._files) - 1, 0)
+
+    @staticmethod
+    def _make_entry(pic_path, name, mtime):
+        # Captured files are named by their capture timestamp. Anything else
+        # (copied in from elsewhere) falls back to its modification time.
+        # The name breaks ties so that the ordering is stable.
+        stem = pathlib.Path(name).stem
+        try:
+            timestamp = datetime.strptime(stem, "%Y%m%d%H%M%S%f").timestamp()
+        except ValueError:
+            timestamp = mtime
+        return {
+            "filename": os.path.join(pic_path, name),
+            "extension": pathlib.Path(name).suffix,
+            "mtime": mtime,
+            "key": (timestamp, name),
+        }
+
+
+# Polls the active gallery directory for changes made outside of the app (for
+# example files copied on or deleted over the network) and rebuilds the index
+# on its own thread when one is detected.
+class AlbumWatcher():
+    def __init__(self, album, interval):
+        logger.debug('Function AlbumWatcher __init__')
+        self.album = album
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='album-watcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if self.album.directory_changed():
+                    logger.info('Gallery directory changed on disk - refreshing index')
+                    self.album.refresh_index()
+            except OSError:
+                logger.exception('Failed to refresh gallery index')
+
 
 if __name__ == '__main__':
     album = Album(constants.BASE_PIC_PATH)
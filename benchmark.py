@@ -0,0 +1,296 @@
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import functools
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Pick the headless drivers before pygame or gpiozero are imported
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('GPIOZERO_PIN_FACTORY', 'mock')
+
+from fake_camera import FakePicamera2, install_fake_picamera2
+from fake_thermal import FakeThermal
+from kctypes import Direction, SelectorPosition
+from stats import nearest_rank
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Headless benchmarks for the whole camera app, for catching performance
+# regressions on a plain Linux machine.
+# CameraApp runs as it would on the device, except that SDL's dummy video
+# driver stands in for the screen, FakePicamera2 for both cameras, gpiozero's
+# mock pin factory for the buttons, selector and encoder, and fixed readings
+# for the battery and SoC temperature. Each scenario replays a scripted input trace against an
+# album of a given size, while the main loop runs as normal, and reports the
+# loop's frame rate, frame time percentiles, CPU time and peak memory.
+# Every scenario runs in a process of its own, so that peak memory is per run.
+# For record_clips, the fake encoders play a short clip made with ffmpeg on a
+# loop, so the recorder muxes and saves real video; the number of videos saved
+# is reported alongside the timings.
+#   python benchmark.py [--sizes 10,1000,50000] [--scenarios encoder_spin,photo_burst] [--output results.json]
+
+DEFAULT_SIZES = [10, 1000, 50000]
+# Full sensor resolution frames are slow to synthesise, and the preview never
+# sees them, so the fake cameras use a smaller sensor by default
+DEFAULT_SENSOR_RESOLUTION = (2028, 1520)
+DEFAULT_CAMERA_FPS = 30
+# A battery that's neither charging nor low
+FakeBattery = namedtuple('FakeBattery', ['percent', 'secsleft', 'power_plugged'])
+FAKE_BATTERY = FakeBattery(percent=80, secsleft=None, power_plugged=False)
+
+# Drives the app's inputs the way the hardware would: the capture button and
+# selector through their mock pins, and the encoder through the callback its
+# pins trigger, rather than stepping both pins through a quadrature cycle for
+# every tick.
+class InputScript():
+    def __init__(self, app):
+        self.app = app
+        self.gpio = app.input
+
+    def tick(self, direction=Direction.FWD):
+        self.gpio.encoder_was_rotated(direction)
+
+    def press(self, hold=0.12):
+        # Hold for longer than the button's debounce, or the release is lost
+        pin = self.gpio.capture_button.pin
+        pin.drive_low()
+        time.sleep(hold)
+        pin.drive_high()
+
+    def select(self, position):
+        selectors = {
+            SelectorPosition.ONE: self.gpio.selector_a,
+            SelectorPosition.TWO: self.gpio.selector_b,
+            SelectorPosition.THREE: self.gpio.selector_c,
+            SelectorPosition.FOUR: self.gpio.selector_d,
+        }
+        for selector in selectors.values():
+            selector.pin.drive_high()
+        selectors[position].pin.drive_low()
+
+def encoder_spin(script):
+    """
+    encoder_spin spins the encoder 200 ticks through the gallery as fast as a
+    hand can, then waits for the gallery to settle.
+    """
+    for _ in range(200):
+        script.tick()
+        time.sleep(0.005)
+    time.sleep(2)
+
+def photo_burst(script):
+    """
+    photo_burst switches to the forward camera and takes 20 photos in quick
+    succession, then waits for them all to be saved.
+    """
+    script.select(SelectorPosition.THREE)
+    time.sleep(1)
+    for _ in range(20):
+        script.press()
+        time.sleep(0.12)
+    while script.app.capture_pipeline.queue_depth:
+        time.sleep(0.05)
+    time.sleep(1)
+
+def record_clips(script):
+    """
+    record_clips switches to video mode and records three clips, each
+    running until the recording timeout ends it. It needs ffmpeg, both for the
+    recorder and to make the clip the fake encoder plays.
+    """
+    import camera
+    script.select(SelectorPosition.TWO)
+    time.sleep(2)
+    for _ in range(3):
+        script.press()
+        time.sleep(camera.presentation_timeout.total_seconds() + 1)
+
+def idle_gallery(script):
+    """
+    idle_gallery leaves a photo on screen in the gallery for ten seconds.
+    """
+    time.sleep(10)
+
+SCENARIOS = {
+    "encoder_spin": encoder_spin,
+    "photo_burst": photo_burst,
+    "record_clips": record_clips,
+    "idle_gallery": idle_gallery,
+}
+
+def make_album(album_dir, count):
+    """
+    make_album fills an album directory with count small photos, named for
+    consecutive seconds like the camera names them.
+    """
+    import cv2
+    import numpy as np
+    os.makedirs(album_dir, exist_ok=True)
+    gradient = np.tile(np.arange(64, dtype=np.uint8) * 4, (48, 1))
+    image = np.dstack([gradient, gradient[:, ::-1], np.full_like(gradient, 128)])
+    success, encoded = cv2.imencode('.jpeg', image)
+    if not success:
+        raise RuntimeError('Could not encode the album photo')
+    data = encoded.tobytes()
+    start = datetime(2020, 1, 1)
+    for index in range(count):
+        name = (start + timedelta(seconds=index)).strftime("%Y%m%d%H%M%S%f") + '.jpeg'
+        with open(os.path.join(album_dir, name), 'wb') as f:
+            f.write(data)
+
+def make_h264_clip(seconds=1):
+    """
+    make_h264_clip encodes a test pattern at the recording size and frame
+    rate as raw H.264 with ffmpeg, for the fake encoders to play. Like the
+    real encoder's output, it has a keyframe every second with the stream
+    headers repeated before each one, and no B-frames.
+    @return the clip's bytes
+    """
+    width, height = constants.RECORDING_SIZE
+    with tempfile.TemporaryDirectory(prefix='kid-camera-clip-') as clip_dir:
+        path = os.path.join(clip_dir, 'clip.h264')
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-y',
+            '-f', 'lavfi', '-i', 'testsrc=size={}x{}:rate={}'.format(width, height, constants.RECORDING_FPS),
+            '-t', str(seconds), '-c:v', 'libx264', '-preset', 'ultrafast', '-bf', '0', '-g', str(constants.RECORDING_FPS),
+            '-x264-params', 'repeat-headers=1:slices=1', '-f', 'h264', path], check=True)
+        with open(path, 'rb') as f:
+            return f.read()
+
+def count_videos(base_dir):
+    """
+    count_videos counts the non-empty videos saved into the albums under
+    base_dir, leaving out scratch files and proxies.
+    """
+    count = 0
+    for directory, subdirectories, filenames in os.walk(base_dir):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+        for filename in filenames:
+            if filename.endswith('.mp4') and os.path.getsize(os.path.join(directory, filename)) > 0:
+                count += 1
+    return count
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {"p50": nearest_rank(ordered, 50), "p95": nearest_rank(ordered, 95), "p99": nearest_rank(ordered, 99), "max": ordered[-1]}
+
+def run_scenario(name, size, sensor_resolution=DEFAULT_SENSOR_RESOLUTION, camera_fps=DEFAULT_CAMERA_FPS):
+    """
+    run_scenario runs one scenario against a fresh album of the given size,
+    in this process, and returns its measurements.
+    @param name the name of the scenario, from SCENARIOS
+    @param size how many photos the album starts with
+    """
+    with tempfile.TemporaryDirectory(prefix='kid-camera-bench-') as base_dir:
+        h264_clip = None
+        if name == 'record_clips':
+            h264_clip = make_h264_clip()
+        install_fake_picamera2(functools.partial(FakePicamera2, fps=camera_fps, sensor_resolution=sensor_resolution), h264_clip)
+        # Only importable once the fake picamera2 is in place
+        import camera
+        make_album(os.path.join(base_dir, 'default'), size)
+        startup_began = time.monotonic()
+        app = camera.CameraApp(base_pic_path=base_dir, battery_source=lambda: FAKE_BATTERY, thermal_source=FakeThermal().read)
+        startup_seconds = time.monotonic() - startup_began
+        script = InputScript(app)
+        # A real selector is always in one of its positions
+        script.select(SelectorPosition.ONE)
+        thread = threading.Thread(target=SCENARIOS[name], args=(script,), name='benchmark-script', daemon=True)
+        frame_times = []
+        cpu_began = cpu_seconds()
+        began = last = time.monotonic()
+        thread.start()
+        while thread.is_alive() and app.running:
+            app.run_frame()
+            now = time.monotonic()
+            frame_times.append(now - last)
+            last = now
+        elapsed = time.monotonic() - began
+        cpu = cpu_seconds() - cpu_began
+        busy = app.profiler.summary().get('busy', {})
+        # Running the loop with running cleared just shuts the app down
+        app.running = False
+        app.run()
+        videos = count_videos(base_dir)
+    return {
+        "scenario": name,
+        "album_size": size,
+        "startup_seconds": startup_seconds,
+        "seconds": elapsed,
+        "frames": len(frame_times),
+        "fps": len(frame_times) / elapsed if elapsed else 0,
+        "frame_time": percentiles(frame_times),
+        "busy_time": busy,
+        "cpu_seconds": cpu,
+        "cpu_percent": 100 * cpu / elapsed if elapsed else 0,
+        "videos_saved": videos,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def run_all(sizes, scenarios):
+    """
+    run_all runs every scenario against every album size, each in a process
+    of its own, and returns the list of results.
+    """
+    results = []
+    for size in sizes:
+        for name in scenarios:
+            if name == 'record_clips' and shutil.which('ffmpeg') is None:
+                logger.warning('Skipping record_clips - ffmpeg is not installed')
+                continue
+            logger.info('Running %s with %s photos', name, size)
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, str(size)],
+                stdout=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                logger.error('%s with %s photos failed with exit code %s', name, size, completed.returncode)
+                continue
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return results
+
+def print_report(results):
+    print('{:<14} {:>7} {:>8} {:>7} {:>9} {:>9} {:>9} {:>7} {:>9} {:>7}'.format(
+        'scenario', 'photos', 'startup', 'fps', 'p50 ms', 'p95 ms', 'p99 ms', 'cpu %', 'rss MB', 'videos'))
+    for result in results:
+        frame_time = result["frame_time"]
+        print('{:<14} {:>7} {:>7.2f}s {:>7.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7.0f} {:>9.0f} {:>7}'.format(
+            result["scenario"], result["album_size"], result["startup_seconds"], result["fps"],
+            frame_time.get("p50", 0) * 1000, frame_time.get("p95", 0) * 1000, frame_time.get("p99", 0) * 1000,
+            result["cpu_percent"], result["peak_rss_mb"], result["videos_saved"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the camera app headless against scripted input and report its performance.')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+        help='comma separated album sizes to run each scenario against')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+        help='comma separated scenarios to run, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--child', nargs=2, metavar=('SCENARIO', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        # Keep stdout for the result - the app's logging goes to stderr
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(run_scenario(args.child[0], int(args.child[1]))))
+        sys.exit()
+    logging.basicConfig(level=logging.INFO)
+    results = run_all([int(size) for size in args.sizes.split(',')], args.scenarios.split(','))
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
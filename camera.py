@@ -4,34 +4,57 @@ import logging
 import os.path
 import subprocess
 import sys
+import time
 
 # 3rd party imports
 import cv2
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FfmpegOutput
+from picamera2 import MappedArray
 import psutil
 import pygame
 
 # Local imports
 from album import Album
+from camera_manager import CameraManager
+from capture_pipeline import CapturePipeline
+from frame_ring import FrameRingBuffer
+from frame_scheduler import FrameScheduler
+from gallery_cache import SurfaceCache
 from gpioinput import GPIOInput
+from governor import QualityGovernor, read_soc_temperature
+from power import start_power_monitor
+import flight_recorder
+from latency import LatencyTracker
+from prefetch import GalleryPrefetcher
+from profiler import FrameProfiler
+from previews import video_info
+from proxies import ProxyTranscoder, playback_filename
+from recorder import Recorder
+from renderer import Renderer, BACKGROUND_COLOR
+from video_player import VideoPlayer
 from kctypes import Camera, CaptureMode, DisplayMode, SelectorPosition, Direction
-from icon import get_random_color, get_icon
+from icon import IconAtlas, default_variants
+from labels import LabelCache
 import constants
 
 # A timeout of how long to show an image/gif after it finishes
 presentation_timeout = timedelta(seconds = 5)
+# How long without any input before the loop drops to its deep idle rate
+deep_idle_timeout = timedelta(seconds = constants.DEEP_IDLE_SECONDS)
+# How long without any input before proxies are made on battery power
+proxy_idle_timeout = timedelta(seconds = constants.PROXY_IDLE_SECONDS)
 # Custom event IDs for hardware in pygame
 ENCODER_ROTATED = pygame.USEREVENT + 1
 CAPTURE_PRESSED = pygame.USEREVENT + 2
 CAPTURE_PRESSED_LONGTIME = pygame.USEREVENT + 3
-# Picamera objects
-cam_forward = Picamera2(constants.CAM_FWD_ID)
-cam_selfie = Picamera2(constants.CAM_SLF_ID)
-encoder = H264Encoder(10000000)
-# psutil battery sensor
-battery = psutil.sensors_battery()
+SELECTOR_MOVED = pygame.USEREVENT + 4
+# What each custom event is called in the input latency stats, and the screen
+# layers that show its result - None for any layer
+latency_event_kinds = {
+    ENCODER_ROTATED: ('encoder', {'background'}),
+    CAPTURE_PRESSED: ('capture', {'background', 'recording'}),
+    CAPTURE_PRESSED_LONGTIME: ('long_press', None),
+    SELECTOR_MOVED: ('selector', {'camera_label', 'capture_label'}),
+}
 
 
 logger = logging.getLogger(__name__)
@@ -44,28 +67,94 @@ def font(filename):
 def icon(filename):
     return os.path.join(constants.BASE_ICON_PATH, filename)
 
+def preview_surface(preview_image):
+    """
+    preview_surface turns a frame from the low resolution preview stream into
+    a pygame surface ready to blit. At full quality the stream is already the
+    display size; when the quality governor has shrunk it, the surface is
+    scaled up to fill the screen.
+    @param preview_image the array returned by capture_array("lores")
+    """
+    if (constants.PREVIEW_FORMAT == 'YUV420'):
+        # A YUV420 frame is the Y plane with the U and V planes below it
+        size = (preview_image.shape[1], preview_image.shape[0] * 2 // 3)
+        rgb = cv2.cvtColor(preview_image, cv2.COLOR_YUV420p2RGB)
+        surface = pygame.image.frombuffer(rgb.tobytes(), size, "RGB")
+    else:
+        size = (preview_image.shape[1], preview_image.shape[0])
+        surface = pygame.image.frombuffer(preview_image, size, "RGBX")
+    if (size != constants.DISPLAY_SIZE):
+        surface = pygame.transform.scale(surface, constants.DISPLAY_SIZE)
+    return surface
+
+def event_raised_at(event):
+    """
+    event_raised_at returns the time.monotonic() an SDL event such as a key
+    press was raised at, from the timestamp SDL gives it, so its time on the
+    queue is counted. If pygame doesn't pass the timestamp on, it falls back
+    to now.
+    @param event the pygame event
+    """
+    now = time.monotonic()
+    timestamp = getattr(event, 'timestamp', None)
+    if timestamp is None:
+        return now
+    # SDL timestamps are milliseconds on the same clock as get_ticks
+    return now - max(0, pygame.time.get_ticks() - timestamp) / 1000
+
+def snapshot_image(cam):
+    """
+    snapshot_image grabs a still from the main stream of a camera that is
+    recording, as a BGR array for the capture pipeline. It works on the same
+    request buffer the encoder is reading from, rather than a copy of it, and
+    hands the buffer back as soon as the still has been converted.
+    @param cam the recording Picamera2 object
+    """
+    request = cam.capture_request()
+    try:
+        with MappedArray(request, "main") as mapped:
+            # In video mode the main stream is YUV420
+            return cv2.cvtColor(mapped.array, cv2.COLOR_YUV2BGR_I420)
+    finally:
+        request.release()
+
 
 class CameraApp():
-    def __init__(self):
+    def __init__(self, base_pic_path=constants.BASE_PIC_PATH, battery_source=psutil.sensors_battery,
+                 thermal_source=read_soc_temperature):
+        """
+        @param base_pic_path the directory holding one folder per album
+        @param battery_source a function returning the battery status in the
+            form of psutil.sensors_battery, or None if there's no battery
+        @param thermal_source a function returning the SoC temperature in
+            degrees Celsius
+        """
         logger.debug('Function CameraApp __init__')
         # First, Pygame setup
         fullscreen = constants.FULLSCREEN
         logger.info('Initializing pygame')
         pygame.init()
-        self.font = pygame.font.Font(font(constants.CORE_FONT) , 32)
+        self.labels = LabelCache(font(constants.CORE_FONT))
         if fullscreen == 1:
             self.canvas = pygame.display.set_mode((640, 480), pygame.FULLSCREEN)
         else:
             self.canvas = pygame.display.set_mode((640, 480))
-        self.clock = pygame.time.Clock()
+        self.scheduler = FrameScheduler()
+        self.renderer = Renderer(self.canvas)
+        self.latency = LatencyTracker()
+        self.profiler = FrameProfiler()
+        self.show_profiler = constants.PROFILER_OVERLAY
+        self.profiler_overlay_at = 0                # When the profiler overlay was last redrawn
+        logger.info('Building icon atlas')
+        self.icons = IconAtlas()
+        self.icons.build(default_variants())
 
         logger.info('pygame configuration complete')
 
         # Next, set up state variables
         self.running = True                         # Is the app running or not?
         self.shut_down_everything = False           # Are we intending to shut down the computer when we close?
-        self.playing_video_file = None              # If a video is playing on the screen, which video is it
-        self.playing_video_fps = -1                 # What is the frames-per-second of the current video file
+        self.playing_video_file = None              # If a video is playing on the screen, its VideoPlayer
         self.camera = Camera.SELFIE                 # Whether selfie or forward facing camera is active
         self.capture_mode = CaptureMode.PICTURE     # Whether camera is recording pictures or video
         self.display_mode = DisplayMode.GALLERY     # Whether screen is showing camera or gallery
@@ -73,19 +162,45 @@ class CameraApp():
         self.pos_override = None                    # Overriden mode selection, if using keyboard control
         self.recording = False                      # Whether a video is being recorded
         self.last_capture_timestamp = datetime.min  # The timestamp at which the last image was taken
-        self.last_interaction = datetime.now        # The timestamp at which the last button press occurred
+        self.last_interaction = datetime.now()      # The timestamp at which the last button press occurred
+        self.waiting_for_decode = False             # Whether the gallery is waiting on a background decode
+        self.key_pressed_at = {}                    # When each held-down key went down, by key
+        self.battery_source = battery_source
+        self.battery = None                         # The last battery status read
+        self.battery_read_at = None                 # When it was read, by time.monotonic()
+        self.governor = QualityGovernor(battery_source, thermal_source)
+        self.quality_level = 0                      # The governor's level the app is running at
+        self.quality = self.governor.ladder[0]      # That level's settings
+        self.frame_ring = None                      # Recent full resolution frames, for zero shutter lag capture
+        if (constants.ZSL_ENABLED):
+            self.frame_ring = FrameRingBuffer()
+
+        self.last_preview_image = None              # The preview frame currently on screen
+        self.preview_surface = None                 # That frame, as a pygame surface
 
         logger.info('Starting up initial camera')
         # Then, set up the first camera stuff to get started
-        cam_forward = Picamera2(constants.CAM_FWD_ID)
-        cam_selfie = Picamera2(constants.CAM_SLF_ID)
-        cam_selfie.start()
-        cam_forward.close()
+        self.album = Album(base_pic_path)
+        self.recorder = Recorder(on_saved=self.album.add_file, scratch_dir=os.path.join(base_pic_path, constants.RECORDING_SCRATCH_DIR))
+        # Put any clips interrupted by the last shutdown back in their albums
+        self.recorder.recover()
+        self.cameras = CameraManager(frame_ring=self.frame_ring, recorder=self.recorder)
+        self.cameras.start(self.camera, self.capture_mode)
 
         logger.info('Initializing plugin modules')
         # Finally, set up the additional modules that plug into the main class
-        self.album = Album(constants.BASE_PIC_PATH)
-        self.input = GPIOInput(self.post_custom_event, ENCODER_ROTATED, CAPTURE_PRESSED, CAPTURE_PRESSED_LONGTIME)
+        self.gallery_cache = SurfaceCache()
+        self.gallery_surface = None                 # The last gallery surface shown, kept up while the next one decodes
+        self.unreadable_surface = None              # Shown in place of a file that can't be decoded, built when first needed
+        self.gallery_filename = None                # The album file currently on screen in the gallery
+        self.gallery_item_shown_at = 0              # When that file came on screen, by time.monotonic()
+        self.prefetcher = GalleryPrefetcher(self.album, self.gallery_cache)
+        self.capture_pipeline = CapturePipeline(on_saved=self.album.add_file)
+        self.read_battery()
+        self.proxies = ProxyTranscoder(self.album, self.proxy_job_allowed)
+        self.proxies.start()
+        self.governor.start()
+        self.input = GPIOInput(self.post_custom_event, ENCODER_ROTATED, CAPTURE_PRESSED, CAPTURE_PRESSED_LONGTIME, SELECTOR_MOVED)
 
     def run(self):
         """
@@ -96,48 +211,146 @@ class CameraApp():
         """
         logger.debug('Function run')
         while (self.running):
-            self.clock.tick(self.playing_video_fps)
-            # clear the canvas from the previous frame
-            self.canvas.fill((92,106,114))
-            if (not self.recording):
-                self.set_current_mode()
-            else:
-                # If recording, see if it's time to stop recording
-                delta = datetime.now() - self.last_capture_timestamp
-                if (delta > presentation_timeout):
-                    logger.info('End of recording - directing camera to stop recording')
-                    self.recording = False
-                    # Save the recording to a file
-                    self.get_active_picamera_device().stop_encoder()
-            self.handle_nfc_card()
-            if (self.display_mode == DisplayMode.GALLERY):
-                self.render_gallery()
-            else:
-                self.render_camera_feed()
-            self.render_battery_icon()
-            self.handle_events()
-            pygame.display.flip()
+            self.run_frame()
         # If not running anymore, quit the app
-        self.get_active_picamera_device().close()
+        self.governor.stop()
+        self.proxies.stop()
+        self.cameras.close()
+        logger.info('Camera switch stats at shutdown: %s', self.cameras.stats())
+        # Make sure every recording that was stopped makes it to disk
+        self.recorder.close()
+        logger.info('Recording start latency stats at shutdown: %s', self.recorder.stats())
+        # Make sure every photo that was taken makes it to disk
+        self.capture_pipeline.close()
+        logger.info('Capture pipeline stats at shutdown: %s', self.capture_pipeline.stats())
+        self.album.close()
+        self.prefetcher.close()
+        logger.info('Gallery cache stats at shutdown: %s', self.gallery_cache.stats())
+        logger.info('Presented %s frames and skipped %s idle frames', self.renderer.frames_presented, self.renderer.frames_skipped)
+        logger.info('Input latency at shutdown: %s', self.latency.summary())
+        logger.info('Frame phase timings at shutdown: %s', self.profiler.summary())
+        logger.info('Quality level at shutdown: %s after %s changes', self.quality["name"], self.governor.changes)
+        flight_recorder.dump('shutdown')
+        self.latency.dump()
         pygame.quit()
         if (self.shut_down_everything):
             subprocess.run(["shutdown", "+0"])
 
+    def run_frame(self):
+        """
+        run_frame runs one pass of the main loop, timing each phase of it with
+        the frame profiler. Input is handled as soon as the loop wakes, before
+        anything is rendered, so whatever woke it is on screen in the same
+        frame rather than a frame later.
+        """
+        self.profiler.begin_frame()
+        self.scheduler.wait(self.target_frame_rate())
+        self.profiler.lap('wait')
+        self.handle_events()
+        self.profiler.lap('handle_events')
+        # start collecting what should be on screen this frame
+        self.renderer.begin_frame()
+        self.latency.frame_started()
+        if (not self.recording):
+            self.apply_quality()
+            self.set_current_mode()
+        else:
+            # If recording, see if it's time to stop recording
+            delta = datetime.now() - self.last_capture_timestamp
+            if (delta > presentation_timeout):
+                logger.info('End of recording - directing camera to stop recording')
+                self.recording = False
+                # The recorder saves the clip and adds it to the album
+                # in the background
+                self.recorder.stop()
+        self.profiler.lap('set_current_mode')
+        self.handle_nfc_card()
+        self.profiler.lap('handle_nfc_card')
+        if (self.display_mode == DisplayMode.GALLERY):
+            self.render_gallery()
+            self.profiler.lap('render_gallery')
+        else:
+            self.render_camera_feed()
+            self.profiler.lap('render_camera_feed')
+        self.render_battery_icon()
+        self.profiler.lap('render_battery_icon')
+        if (constants.LATENCY_OVERLAY):
+            self.render_latency_overlay()
+        if (self.show_profiler):
+            self.render_profiler_overlay()
+        self.profiler.lap('overlays')
+        # Only redraw and present what changed - if nothing did, this
+        # frame costs no drawing at all
+        self.renderer.present()
+        self.latency.presented(self.renderer.changed_layers)
+        self.profiler.lap('flip')
+        self.profiler.end_frame()
+
+    def target_frame_rate(self):
+        """
+        target_frame_rate picks how often the main loop should run, given what
+        is on the screen. The camera preview runs at the sensor's rate and a
+        playing video at its own rate. A still in the gallery barely changes,
+        so it runs slowly - and slower still once nobody has touched the device
+        for a while. Input always wakes the loop straight away regardless.
+        """
+        if self.display_mode == DisplayMode.CAPTURE or self.recording:
+            return self.quality["preview_fps"]
+        if self.playing_video_file:
+            return self.playing_video_file.fps
+        if self.waiting_for_decode:
+            # Show the image as soon as the prefetcher has it ready
+            return constants.PREVIEW_FPS
+        if datetime.now() - self.last_interaction > deep_idle_timeout:
+            return constants.DEEP_IDLE_FPS
+        return constants.GALLERY_FPS
+
+    def proxy_job_allowed(self):
+        """
+        proxy_job_allowed decides whether the background proxy transcode may
+        run right now: never while a capture is being recorded or saved or the
+        quality governor has ruled out background jobs, and otherwise only when
+        plugged in or nobody has touched the device for a while. It's called
+        from the proxy job's thread.
+        """
+        if self.recording or self.capture_pipeline.queue_depth > 0:
+            return False
+        if not self.quality["background_jobs"]:
+            return False
+        # Uses the status the main loop last read, rather than reading it here
+        power = self.battery
+        if power is None or power.power_plugged:
+            return True
+        return datetime.now() - self.last_interaction > proxy_idle_timeout
+
+    def apply_quality(self):
+        """
+        apply_quality switches to the quality governor's current level, if it
+        has changed: the preview frame rate, the preview and recording stream
+        sizes and the recording bitrate. Changing the streams restarts the live
+        camera, so it's never done while recording.
+        """
+        level = self.governor.level
+        if level == self.quality_level:
+            return
+        previous = self.quality
+        self.quality_level = level
+        self.quality = self.governor.ladder[level]
+        self.recorder.bitrate = self.quality["recording_bitrate"]
+        streams_changed = self.cameras.set_stream_settings(self.quality["preview_size"], self.quality["preview_fps"],
+            self.quality["recording_size"])
+        bitrate_changed = self.quality["recording_bitrate"] != previous["recording_bitrate"]
+        if streams_changed or (bitrate_changed and self.capture_mode == CaptureMode.VIDEO):
+            self.cameras.restart()
+        logger.info('Running at quality %s', self.quality["name"])
+
     def get_active_picamera_device(self):
         """
-        get_active_picamera_device is a quick helper to give you the correct
+        get_active_picamera_device is a quick helper to give you the live
         picamera2 camera reference, given the program's camera selection.
+        While the camera manager is switching cameras this is None.
         """
-        global cam_forward
-        global cam_selfie
-
-        logger.debug('Function get_active_picamera_device')
-        if (self.camera == Camera.SELFIE):
-            logger.debug('Returning reference to selfie cam')
-            return cam_selfie
-        else:
-            logger.debug('Returning reference to forward cam')
-            return cam_forward
+        return self.cameras.device
 
     def set_current_mode(self):
         """
@@ -147,14 +360,12 @@ class CameraApp():
         also checks whether the mode has changed since the last frame, and uses
         that check to determine if the app needs to be in capture mode.
         """
-        global cam_forward
-        global cam_selfie
-        logger.debug('Function set_current_mode')
         position = self.input.active_pos(override=self.pos_override)
         # Get the pre-existing camera.
         # If it ends up changing during this function, tell the app to switch
         # cameras.
         prev_camera = self.camera
+        prev_capture_mode = self.capture_mode
         # Check the selector
         if position == SelectorPosition.ONE:
             self.camera = Camera.SELFIE
@@ -175,17 +386,12 @@ class CameraApp():
             logger.info('Switching to Capture Mode')
             self.active_pos = position
             self.display_mode = DisplayMode.CAPTURE
-        if (not prev_camera == self.camera):
-            if (self.camera == Camera.SELFIE):
-                logger.info('Switching to selfie cam')
-                cam_forward.close()
-                cam_selfie = Picamera2(constants.CAM_SLF_ID)
-                cam_selfie.start()
-            else:
-                logger.info('Switching to forward cam')
-                cam_selfie.close()
-                cam_forward = Picamera2(constants.CAM_FWD_ID)
-                cam_forward.start()
+            self.stop_video_playback()
+        if (not prev_camera == self.camera) or (not prev_capture_mode == self.capture_mode):
+            # The camera manager switches in the background, and keeps the
+            # last frame on screen until the new stream is live
+            logger.info('Switching to %s in %s', self.camera, self.capture_mode)
+            self.cameras.switch(self.camera, self.capture_mode)
 
     def handle_nfc_card(self):
         """
@@ -194,7 +400,6 @@ class CameraApp():
         deactivates any current NFC card if none is found. This function does
         nothing if the detected state matches the preexisting NFC state.
         """
-        logger.debug('Function handle_nfc_card')
         # Look for an NFC card - if found, check that it is active
         found_nfc = None
         if (found_nfc):
@@ -211,41 +416,85 @@ class CameraApp():
         """
         render_gallery renders the image or video playback onto the screen.
         It begins by fetching a file from the current storage directory.
-        If it's an image, it gets scaled to the device size and sent to the
-        canvas for rendering.
-        If a video is detected, OpenCV is used to stream the video - of note,
-        the video's calculated FPS is used to set a periodic timer in pygame,
-        so that the video can correctly play frame-by-frame.
-        The video is also scaled to device size and rendered onto the canvas.
+        Its display-sized surface - for a video, the poster frame - is taken
+        from the gallery cache, or requested from the prefetcher if it isn't
+        decoded yet.
+        A video shows its poster straight away, and only once it has been on
+        screen for a moment does a VideoPlayer start decoding it in the
+        background, so scrolling past videos never opens a decoder. The player
+        hands back the frame that's due by the wall clock, and the video's FPS
+        is also used to pace the main loop while it plays.
         When a video finishes playing, it will loop continuously.
         """
-        logger.debug('Function render_gallery')
         # Get and display image at current position
+        self.waiting_for_decode = False
         res = self.album.load_image()
+        if res is None:
+            logger.debug('Gallery is empty - nothing to render')
+            return
         filename = res["filename"]
-        extension = res["extension"]
-        if (not extension == ".h264") and (not extension == ".mp4"):
-            logger.info('Creating and blitting pygame image from image file %s', filename)
-            image = pygame.image.load(filename)
-            image = pygame.transform.scale(image, (640, 480))
-            self.canvas.blit(image, dest = (0,0))
-        # If a video, make sure it loops
+        if (filename != self.gallery_filename):
+            self.gallery_filename = filename
+            self.gallery_item_shown_at = time.monotonic()
+        if (self.playing_video_file and not self.playing_video_file.filename == filename):
+            # The gallery changed underneath us, for example a new card
+            self.stop_video_playback()
+        image = self.gallery_cache.get(filename, res["mtime"])
+        if image is None:
+            # Never decode on the UI thread - ask for it in the background
+            # and keep showing the previous item until it's ready
+            logger.debug('File %s not decoded yet - requesting it', filename)
+            if self.prefetcher.request(res):
+                self.waiting_for_decode = True
+                image = self.gallery_surface
+            else:
+                # It can't be decoded, so there's nothing to wait for
+                image = self.unreadable_placeholder()
         else:
+            self.gallery_surface = image
+        if res["extension"] in constants.VIDEO_EXTENSIONS:
             if (not self.playing_video_file):
-                logger.info('Starting playback of video file %s', filename)
-                self.playing_video_file = cv2.VideoCapture(filename)
-                self.playing_video_fps = self.playing_video_file.get(cv2.CAP_PROP_FPS)
-            success, video_image = self.playing_video_file.read()
-            if success:
-                logger.info('Creating and blitting pygame image from video file buffer')
-                video_surf = pygame.image.frombuffer(video_image.tobytes(), video_image.shape[1::-1], "RGB")
-                video_surf = pygame.transform.scale(video_surf, (640,480))
-                self.canvas.blit(video_surf, (0,0))
-            else:
-                logger.info('Video file read did not succeed - Resetting to frame 0 to restart playback')
-                # Likely the end of the video frame, loop back to start
-                self.playing_video_file.set(cv2.CAP_PROP_POS_FRAMES, 0)
- 
+                if (time.monotonic() - self.gallery_item_shown_at < constants.VIDEO_START_DELAY):
+                    # Keep the loop awake so playback starts on time
+                    self.waiting_for_decode = True
+                else:
+                    logger.info('Starting playback of video file %s', filename)
+                    info = video_info.get(filename, res["mtime"])
+                    # Decode the low resolution proxy instead, if it's made
+                    self.playing_video_file = VideoPlayer(filename, fps=info["fps"] if info else None,
+                        source=playback_filename(filename))
+            if (self.playing_video_file):
+                # The player decodes in the background and hands back whichever
+                # frame is due - the same surface until the next one is.
+                # The poster stays up until playback gets going
+                video_surf = self.playing_video_file.current_frame()
+                if video_surf is not None:
+                    image = video_surf
+        if image is not None:
+            self.renderer.set_layer('background', image)
+
+    def unreadable_placeholder(self):
+        """
+        unreadable_placeholder returns the surface the gallery shows for a
+        file that couldn't be decoded.
+        """
+        if self.unreadable_surface is None:
+            surface = pygame.Surface(constants.DISPLAY_SIZE)
+            surface.fill(BACKGROUND_COLOR)
+            text, rect = self.labels.get("Can't show this one", center=surface.get_rect().center)
+            surface.blit(text, rect)
+            self.unreadable_surface = surface
+        return self.unreadable_surface
+
+    def stop_video_playback(self):
+        """
+        stop_video_playback stops any video playing in the gallery, so its
+        decoder doesn't keep running in the background.
+        """
+        if (self.playing_video_file):
+            self.playing_video_file.close()
+            self.playing_video_file = None
+
     def render_camera_feed(self):
         """
         render_camera_feed renders what the current active camera sees onto the
@@ -257,66 +506,107 @@ class CameraApp():
         Then, it checks if the device is actively recording a video - if so, an
         indicator is displayed overlaying the screen.
         """
-        logger.debug('Function render_camera_feed')
-        logger.info('Capturing camera image preview from active camera')
-        preview_image = self.get_active_picamera_device().capture_array()
-        logger.info('Creating and blitting pygame image from image buffer')
-        pygame_image = pygame.image.frombuffer(preview_image, preview_image.shape[1::-1], "RGBA")
-        pygame_image = pygame.transform.scale(pygame_image, (640,480))
-        self.canvas.blit(pygame_image, dest = (0,0))
+        # The low resolution stream is already display-sized, so no scaling.
+        # Mid-switch this is the same last frame, which needn't be converted
+        # again.
+        preview_image = self.cameras.capture_preview()
+        if (preview_image is not None):
+            if (preview_image is not self.last_preview_image):
+                self.last_preview_image = preview_image
+                self.preview_surface = preview_surface(preview_image)
+            self.renderer.set_layer('background', self.preview_surface)
 
-        logger.debug('Rendering camera feed debug text onto screen')
         if (self.camera == Camera.SELFIE):
             # Display selfie cam preview
-            camera_text = self.font.render('Selfie Cam', True, (211,198,170))
-            camera_rect = camera_text.get_rect()
-            camera_rect.center = (500, 300)
-            self.canvas.blit(camera_text, camera_rect)
+            camera_text, camera_rect = self.labels.get('Selfie Cam', center=(500, 300))
         else:
             # Display forward cam preview
-            camera_text = self.font.render('Forward Cam', True, (211,198,170))
-            camera_rect = camera_text.get_rect()
-            camera_rect.center = (500, 300)
-            self.canvas.blit(camera_text, camera_rect)
+            camera_text, camera_rect = self.labels.get('Forward Cam', center=(500, 300))
+        self.renderer.set_layer('camera_label', camera_text, camera_rect)
         if (self.capture_mode == CaptureMode.PICTURE):
-            capture_text = self.font.render('Picture Mode', True, (211,198,170))
-            capture_rect = capture_text.get_rect()
-            capture_rect.center = (150, 300)
-            self.canvas.blit(capture_text, capture_rect)
+            capture_text, capture_rect = self.labels.get('Picture Mode', center=(150, 300))
         else:
-            capture_text = self.font.render('Video Mode', True, (211,198,170))
-            capture_rect = capture_text.get_rect()
-            capture_rect.center = (150, 300)
-            self.canvas.blit(capture_text, capture_rect)
+            capture_text, capture_rect = self.labels.get('Video Mode', center=(150, 300))
+        self.renderer.set_layer('capture_label', capture_text, capture_rect)
         if (self.recording):
-            recording_text = self.font.render('RECORDING', True, (211,198,170))
-            recording_rect = recording_text.get_rect()
-            recording_rect.center = (500, 100)
-            self.canvas.blit(recording_text, recording_rect)
-            # If recording a video, can show indicator
+            # If recording a video, show an indicator
+            recording_text, recording_rect = self.labels.get('RECORDING', center=(500, 100))
+            self.renderer.set_layer('recording', recording_text, recording_rect)
+
+    def read_battery(self):
+        """
+        read_battery returns the battery status, reading it again if it's
+        more than BATTERY_POLL_SECONDS old.
+        """
+        now = time.monotonic()
+        if self.battery_read_at is None or now - self.battery_read_at > constants.BATTERY_POLL_SECONDS:
+            self.battery = self.battery_source()
+            self.battery_read_at = now
+        return self.battery
 
     def render_battery_icon(self):
-        plugged = battery.power_plugged
-        percent = battery.percent
+        """
+        render_battery_icon shows an icon for the battery's charge level, or
+        a charging icon when plugged in. The icons come ready-made from the
+        icon atlas, so this is only ever a lookup.
+        """
+        status = self.read_battery()
+        # Without a battery, the device must be running from mains power
+        plugged = status is None or status.power_plugged
+        percent = 100 if status is None else status.percent
+        if (percent is None):
+            # The charge is unknown, so warn rather than look full
+            percent = 0
         if (plugged):
-            image = icon(constants.ICON_BATTERY_CHARGING)
-            color = (0,255,150)
-        elif (percent > 70):
-            image = icon(constants.ICON_BATTERY_FULL)
-            color = (0,255,0)
-        elif (percent > 40):
-            image = icon(constants.ICON_BATTERY_MED)
-            color = (150,150,0)
-        elif (percent > 15):
-            image = icon(constants.ICON_BATTERY_LOW)
-            color = (255,150,0)
+            image = constants.ICON_BATTERY_CHARGING
+            color = constants.BATTERY_CHARGING_COLOR
         else:
-            image = icon(constants.ICON_BATTERY_WARNING)
-            color = (255,0,0)
-        battery_icon = pygame.image.load(image)
-        battery_icon = battery_icon.fill(color, special_flags=pygame.BLEND_ADD)
-        battery_icon = pygame.transform.scale(battery_icon, (80, 80))
-        self.canvas.blit(battery_icon, (280, 0))
+            for threshold, image, color in constants.BATTERY_LEVELS:
+                if (percent > threshold):
+                    break
+        battery_icon, dest = self.icons.get(image, color, "topcenter")
+        self.renderer.set_layer('battery', battery_icon, dest)
+
+    def render_latency_overlay(self):
+        """
+        render_latency_overlay shows the input latency percentiles for each
+        kind of event in the top left corner, for debugging.
+        """
+        lines = self.latency.overlay_lines()
+        key = tuple(lines)
+        if not lines or self.renderer.is_current('latency', key):
+            return
+        self.renderer.set_layer('latency', self.text_overlay(lines), (4, 4), key=key)
+
+    def render_profiler_overlay(self):
+        """
+        render_profiler_overlay shows the p50/p95/p99 time of each phase of
+        the frame in the bottom left corner. The numbers change every frame,
+        so it's only redrawn every PROFILER_OVERLAY_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if now - self.profiler_overlay_at < constants.PROFILER_OVERLAY_INTERVAL and self.renderer.is_current('profiler', self.profiler_overlay_at):
+            return
+        lines = self.profiler.overlay_lines()
+        if not lines:
+            return
+        self.profiler_overlay_at = now
+        overlay = self.text_overlay(lines)
+        self.renderer.set_layer('profiler', overlay, overlay.get_rect(bottomleft=(4, 476)), key=now)
+
+    def text_overlay(self, lines):
+        """
+        text_overlay renders lines of small debugging text onto one
+        transparent surface.
+        @param lines the strings to show, top to bottom
+        """
+        rendered = [self.labels.get(line, size=16)[0] for line in lines]
+        overlay = pygame.Surface((max(line.get_width() for line in rendered), sum(line.get_height() for line in rendered)), pygame.SRCALPHA)
+        y = 0
+        for line in rendered:
+            overlay.blit(line, (0, y))
+            y += line.get_height()
+        return overlay
 
     def handle_events(self):
         """
@@ -329,11 +619,26 @@ class CameraApp():
         - The c key to simulate the capture pressed behavior
         - Numbers 1-4 to override the mode switching feature in the gpiozero
           inputs.
+        - The l key to write out the input latency report
+        - The d key to write out the flight recorder log
+        - The f key to toggle the frame profiler overlay, and the t key to
+          write out a trace of the last frames
+        Each input event is handed to the latency tracker along with when it
+        was raised, and the layers that will show its result.
         """
-        logger.debug('Function handle_events')
-        for event in pygame.event.get():
+        for event in self.scheduler.take_events():
+            if event.type == pygame.KEYUP:
+                self.latency.started('key', event_raised_at(event))
+            elif event.type in latency_event_kinds:
+                kind, layers = latency_event_kinds[event.type]
+                self.latency.started(kind, getattr(event, 'raised_at', None), layers)
             if event.type == pygame.QUIT:
                 self.running = False
+            # The window's contents were lost, so everything needs redrawing
+            if event.type == pygame.VIDEOEXPOSE:
+                self.renderer.invalidate()
+            if event.type == pygame.KEYDOWN:
+                self.key_pressed_at[event.key] = event_raised_at(event)
             if event.type == pygame.KEYUP:
                 # ENCODER: Left and Right arrows
                 if event.key == pygame.K_LEFT:
@@ -353,7 +658,18 @@ class CameraApp():
                     self.action_selector_change()
                 # CAPTURE BUTTON: c key
                 if event.key == pygame.K_c:
-                    self.action_capture()
+                    self.action_capture(self.key_pressed_at.pop(pygame.K_c, None))
+                # FRAME PROFILER: f key for the overlay, t for a trace
+                if event.key == pygame.K_f:
+                    self.show_profiler = not self.show_profiler
+                if event.key == pygame.K_t:
+                    self.profiler.dump_trace()
+                # FLIGHT RECORDER: d key
+                if event.key == pygame.K_d:
+                    flight_recorder.dump()
+                # LATENCY REPORT: l key
+                if event.key == pygame.K_l:
+                    self.latency.dump()
                 # QUIT: q key
                 if event.key == pygame.K_q:
                     self.running = False
@@ -362,72 +678,129 @@ class CameraApp():
                     self.running = False
                     self.shut_down_everything = True
             if event.type == ENCODER_ROTATED:
-                self.action_rotate_encoder(event.dir)
+                # Every tick since the last frame, as one scroll
+                dir, steps = self.input.take_encoder_steps()
+                if steps:
+                    self.action_rotate_encoder(dir, steps)
             if event.type == CAPTURE_PRESSED:
-                self.action_capture()
+                self.action_capture(getattr(event, 'pressed_at', None))
             # Longtime capture pressed is the same as a force shutdown
             if event.type == CAPTURE_PRESSED_LONGTIME:
                     self.running = False
                     self.shut_down_everything = True
 
-    def action_rotate_encoder(self, dir):
+    def action_rotate_encoder(self, dir, steps=1):
         """
-        action_rotate_encoder represents one measured tick of the rotary
-        encoder on the device.
+        action_rotate_encoder represents the rotary encoder on the device
+        being turned by one or more steps.
         If the system isn't in gallery mode, it will switch to gallery mode.
         If it's already in gallery mode, the encoder rotation will be used to
         scrub through the available photos and videos.
         Rotating the encoder also resets any playing video files in the program
         state.
         @param dir the Direction to rotate, either FWD (clockwise) or REV.
+        @param steps how many gallery items to move by
         """
         logger.debug('Function action_rotate_encoder')
         self.last_interaction = datetime.now()
         if self.display_mode == DisplayMode.CAPTURE:
             logger.info('Switching display mode to Gallery')
             self.display_mode = DisplayMode.GALLERY
+            self.prefetcher.schedule()
         else:
             logger.info('Scrolling to new image and resetting any playing video file association')
             # Increment or decrement current gallery position (with wrapping)
-            self.album.gallery_scroll(dir)
-            self.playing_video_file = None
+            self.album.gallery_scroll(dir, steps)
+            self.prefetcher.scrolled(dir, steps)
+            self.stop_video_playback()
 
-    def action_capture(self):
+    def action_capture(self, pressed_at=None):
         """
         action_capture initiates a picture or video capture on the device.
         If in picture mode, the current active camera is used to take a picture
-        and then the image is saved to the filesystem.
+        and then the image is saved to the filesystem. With zero shutter lag
+        enabled, the picture is the buffered frame closest to when the button
+        went down (plus any further burst frames) instead of the next frame.
         If in video mode, a video recording is started and system state is
-        updated to indicate that a recording is active.
-        Either way, a timestamp is also recorded for when the capture happened,
-        so that timed events like the end of a video recording or the
-        end of a picture presentation can be set up.
+        updated to indicate that a recording is active. Pressing again while
+        recording takes a still from the recording's stream, without
+        interrupting it.
+        Apart from those stills, a timestamp is also recorded for when the
+        capture happened, so that timed events like the end of a video
+        recording or the end of a picture presentation can be set up.
+        @param pressed_at the time.monotonic() when the button went down, if
+            known - otherwise it's taken to be now
         """
         logger.debug('Function action_capture')
+        if (pressed_at is None):
+            pressed_at = time.monotonic()
+        # Give the capture the whole CPU and disk
+        self.proxies.pause()
         self.last_interaction = datetime.now()
-        self.last_capture_timestamp = datetime.now()
-        formatted_timestamp = self.last_capture_timestamp.strftime("%Y%m%d%H%M%S%f")
+        captured_at = datetime.now()
+        formatted_timestamp = captured_at.strftime("%Y%m%d%H%M%S%f")
+        if (not self.recording):
+            # A still taken mid-recording mustn't make the recording longer
+            self.last_capture_timestamp = captured_at
         if self.display_mode == DisplayMode.GALLERY:
             logger.info('Switching display mode to Capture')
             self.display_mode = DisplayMode.CAPTURE
+            self.stop_video_playback()
         else:
-            if self.capture_mode == CaptureMode.PICTURE:
+            if self.capture_mode == CaptureMode.PICTURE and self.frame_ring is not None and self.frame_ring.depth:
+                self.capture_from_frame_ring(pressed_at)
+            elif self.get_active_picamera_device() is None:
+                logger.info('Camera is still switching - ignoring capture')
+            elif self.capture_mode == CaptureMode.PICTURE:
                 # Take a pic with current self.camera
                 filename = os.path.join(self.album.pic_path, formatted_timestamp)
                 filename += ".jpeg"
-                logger.info('Instructing active camera to save image to %s', filename)
-                self.get_active_picamera_device().capture_file(filename)
+                # Only grab the frame here - encoding and writing happen in
+                # the capture pipeline, which adds it to the album once saved
+                logger.info('Grabbing frame from active camera for %s', filename)
+                grab_started = time.monotonic()
+                image = self.get_active_picamera_device().capture_array("main")
+                self.capture_pipeline.submit(filename, image, time.monotonic() - grab_started)
+            elif self.recording:
+                # Take a still from the recording's own stream - the encoder
+                # and the preview carry on untouched
+                filename = os.path.join(self.album.pic_path, formatted_timestamp)
+                filename += ".jpeg"
+                logger.info('Grabbing snapshot from recording for %s', filename)
+                grab_started = time.monotonic()
+                image = snapshot_image(self.get_active_picamera_device())
+                self.capture_pipeline.submit(filename, image, time.monotonic() - grab_started)
             else:
-                logger.info('Setting recording state to true')
-                self.recording = True
-                # Take a video with current self.camera
+                # Take a video with current self.camera - the encoder is
+                # already running, so this just starts saving its output,
+                # beginning with the few seconds before the press
                 filename = os.path.join(self.album.pic_path, formatted_timestamp)
-                # filename += ".h264"
-                # self.get_active_picamera_device().start_recording(encoder, filename)
                 filename += ".mp4"
-                logger.info('Instructing active camera to start recording video to %s', filename)
-                output = FfmpegOutput(filename)
-                self.get_active_picamera_device().start_recording(encoder, output)
+                logger.info('Instructing recorder to start recording video to %s', filename)
+                if self.recorder.start(filename, pressed_at):
+                    logger.info('Setting recording state to true')
+                    self.recording = True
+                else:
+                    logger.info('Recorder is not ready - ignoring capture')
+
+    def capture_from_frame_ring(self, pressed_at):
+        """
+        capture_from_frame_ring saves the buffered frames closest to the time
+        the shutter was pressed - one, or ZSL_BURST_COUNT for a burst. Each
+        frame is named for the moment it was actually captured.
+        @param pressed_at the time.monotonic() when the button went down
+        """
+        logger.debug('Function capture_from_frame_ring')
+        frames = self.frame_ring.closest(pressed_at, constants.ZSL_BURST_COUNT)
+        # Convert the frames' monotonic timestamps into wall clock time
+        clock_offset = datetime.now() - timedelta(seconds = time.monotonic())
+        for frame_timestamp, image in frames:
+            captured_at = clock_offset + timedelta(seconds = frame_timestamp)
+            filename = os.path.join(self.album.pic_path, captured_at.strftime("%Y%m%d%H%M%S%f"))
+            filename += ".jpeg"
+            logger.info('Saving buffered frame from %.3fs %s the press to %s',
+                abs(frame_timestamp - pressed_at), 'before' if frame_timestamp <= pressed_at else 'after', filename)
+            self.capture_pipeline.submit(filename, image)
 
     def action_selector_change(self, pos=None):
         """
@@ -452,11 +825,20 @@ class CameraApp():
         @param event_key the pygame USEREVENT key to be triggered
         @param **attributes a list of named key-value attributes to include in
             the event data
+        Every event is stamped with the time.monotonic() it was raised at, for
+        measuring input latency.
         """
+        attributes.setdefault('raised_at', time.monotonic())
         my_event = pygame.event.Event(event_key, **attributes)
         pygame.event.post(my_event)
 
 if __name__ == "__main__":
-    app = CameraApp()
+    flight_recorder.install()
+    # psutil rarely knows anything about the UPS HAT's battery, so read its
+    # power sensor where there is one
+    power_monitor = start_power_monitor()
+    app = CameraApp(battery_source=power_monitor.read if power_monitor else psutil.sensors_battery)
     app.run()
+    if power_monitor:
+        power_monitor.stop()
     sys.exit()
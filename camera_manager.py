@@ -0,0 +1,300 @@
+from collections import deque
+import logging
+import threading
+import time
+
+from kctypes import Camera, CaptureMode
+import constants
+
+logger = logging.getLogger(__name__)
+
+def picamera2_backend(camera_id):
+    """
+    picamera2_backend opens a real camera. It's the default backend for the
+    camera manager; tests and benchmarks can pass a fake one instead.
+    @param camera_id the libcamera index of the camera to open
+    """
+    from picamera2 import Picamera2
+    return Picamera2(camera_id)
+
+def build_configuration(cam, capture_mode, preview_size=constants.DISPLAY_SIZE, preview_fps=constants.PREVIEW_FPS,
+                        recording_size=constants.RECORDING_SIZE):
+    """
+    build_configuration creates a two stream configuration for a camera: a
+    main stream used for taking pictures and recording, and a low resolution
+    stream already at the display size that the preview draws from. Because
+    the preview never touches the main stream, its cost doesn't depend on the
+    sensor resolution.
+    In picture mode the main stream is the sensor's full resolution, and the
+    sensor runs at the preview's frame rate; in video mode it's the recording
+    size, at the recording frame rate.
+    @param cam the Picamera2 object the configuration is for
+    @param capture_mode the CaptureMode the camera is being set up for
+    @param preview_size the size of the low resolution stream
+    @param preview_fps the frame rate in picture mode
+    @param recording_size the size of the main stream in video mode
+    """
+    logger.debug('Function build_configuration')
+    if (capture_mode == CaptureMode.VIDEO):
+        main = {"size": recording_size, "format": "YUV420"}
+        # The recorder muxes the stream at this rate, so the sensor must match
+        controls = {"FrameRate": constants.RECORDING_FPS}
+    else:
+        main = {"size": cam.sensor_resolution, "format": "RGB888"}
+        controls = {"FrameRate": preview_fps}
+    lores = {"size": preview_size, "format": constants.PREVIEW_FORMAT}
+    return cam.create_preview_configuration(main=main, lores=lores, display="lores", encode="main", controls=controls)
+
+# Owns both cameras for the lifetime of the app.
+# Opening a camera is slow, so both are opened once at startup and kept open,
+# and a configuration for each camera in each capture mode is built up front.
+# Switching camera or mode then only means stopping one stream, applying an
+# already-built configuration and starting the other.
+# Switches happen on a background thread. While one is in progress the live
+# device is None and capture_preview keeps returning the last frame, so the
+# screen holds the previous picture instead of going blank. If the selector
+# moves again mid-switch, the thread carries on to the newest target.
+# The time from asking for a switch to the first frame from the new stream is
+# recorded for each switch.
+# If a switch fails, it's tried again up to CAMERA_SWITCH_ATTEMPTS times. After
+# that there's no live camera until another switch or a restart is asked for,
+# which tries again, even to the same target.
+# If given a recorder, its encoder is attached whenever a camera goes live in
+# video mode, and detached before that camera stops.
+# The stream sizes and preview frame rate can be changed with
+# set_stream_settings; they take effect the next time a camera goes live, which
+# restart brings about for the live one.
+class CameraManager():
+    def __init__(self, backend=picamera2_backend, camera_ids=None, frame_ring=None, recorder=None):
+        logger.debug('Function CameraManager __init__')
+        if (camera_ids is None):
+            camera_ids = {Camera.SELFIE: constants.CAM_SLF_ID, Camera.FORWARD: constants.CAM_FWD_ID}
+        self.frame_ring = frame_ring
+        self.recorder = recorder
+        self.last_frame = None
+        self.switch_latencies = deque(maxlen=constants.CAMERA_SWITCH_HISTORY)
+        self.stream_settings = {
+            "preview_size": constants.DISPLAY_SIZE,
+            "preview_fps": constants.PREVIEW_FPS,
+            "recording_size": constants.RECORDING_SIZE,
+        }
+        self._cameras = {}
+        self._configurations = {}
+        for camera, camera_id in camera_ids.items():
+            logger.info('Opening camera %s', camera_id)
+            self._cameras[camera] = backend(camera_id)
+        self._build_configurations()
+        self._lock = threading.Lock()
+        self._active = None              # The (Camera, CaptureMode) that is live, or None mid-switch
+        self._target = None              # The (Camera, CaptureMode) we're switching to
+        self._switch_requested_at = None # When the pending switch was asked for
+        self._switch_thread = None
+        self._restart_requested = False  # Whether the live camera should be stopped and started again
+
+    @property
+    def device(self):
+        """
+        device is the live Picamera2 object, or None while switching.
+        """
+        with self._lock:
+            if self._active is None:
+                return None
+            return self._cameras[self._active[0]]
+
+    @property
+    def is_switching(self):
+        with self._lock:
+            return self._active != self._target
+
+    def start(self, camera, capture_mode):
+        """
+        start brings up the first camera and waits until it's running.
+        @param camera the Camera to start
+        @param capture_mode the CaptureMode to start it in
+        """
+        logger.debug('Function start')
+        with self._lock:
+            self._target = (camera, capture_mode)
+        self._activate(camera, capture_mode)
+        with self._lock:
+            self._active = (camera, capture_mode)
+
+    def switch(self, camera, capture_mode):
+        """
+        switch asks for a different camera or capture mode to be made live.
+        It returns straight away; the switch happens in the background.
+        @param camera the Camera to switch to
+        @param capture_mode the CaptureMode to switch to
+        """
+        logger.debug('Function switch')
+        with self._lock:
+            if self._target == (camera, capture_mode) and (self._active == self._target or self._switch_thread is not None):
+                return
+            logger.info('Switching camera to %s in %s', camera, capture_mode)
+            self._target = (camera, capture_mode)
+            self._switch_requested_at = time.monotonic()
+            if self._switch_thread is not None:
+                # The running switch will pick up the new target when it's done
+                return
+            self._switch_thread = threading.Thread(target=self._run_switch, name='camera-switch', daemon=True)
+            self._switch_thread.start()
+
+    def set_stream_settings(self, preview_size, preview_fps, recording_size):
+        """
+        set_stream_settings rebuilds every configuration with new stream sizes
+        and preview frame rate. Cameras pick them up the next time they go
+        live.
+        @param preview_size the size of the low resolution stream
+        @param preview_fps the frame rate in picture mode
+        @param recording_size the size of the main stream in video mode
+        @return whether anything changed
+        """
+        logger.debug('Function set_stream_settings')
+        settings = {"preview_size": preview_size, "preview_fps": preview_fps, "recording_size": recording_size}
+        if settings == self.stream_settings:
+            return False
+        logger.info('Changing camera stream settings to %s', settings)
+        self.stream_settings = settings
+        self._build_configurations()
+        return True
+
+    def restart(self):
+        """
+        restart stops the live camera and starts it again in the background,
+        the same way a switch does, so that it picks up new stream settings or
+        a change to the recorder's.
+        """
+        logger.debug('Function restart')
+        with self._lock:
+            if self._target is None:
+                # Nothing has been started yet
+                return
+            self._restart_requested = True
+            if self._switch_thread is not None:
+                return
+            self._switch_thread = threading.Thread(target=self._run_switch, name='camera-switch', daemon=True)
+            self._switch_thread.start()
+
+    def capture_preview(self):
+        """
+        capture_preview returns the next frame from the live camera's low
+        resolution stream. While a switch is in progress it returns the last
+        frame instead - the same object each time - or None if there has never
+        been one.
+        """
+        with self._lock:
+            if self._active is None:
+                return self.last_frame
+            cam = self._cameras[self._active[0]]
+            # Hold the lock while waiting on the frame, so a switch can't stop
+            # the camera out from under us
+            self.last_frame = cam.capture_array("lores")
+            return self.last_frame
+
+    def stats(self):
+        """
+        stats returns the number of switches and the mean, worst and most
+        recent switch latency in seconds.
+        """
+        latencies = list(self.switch_latencies)
+        if not latencies:
+            return {"switches": 0}
+        return {
+            "switches": len(latencies),
+            "mean": sum(latencies) / len(latencies),
+            "max": max(latencies),
+            "last": latencies[-1],
+        }
+
+    def close(self):
+        """
+        close waits for any switch in progress, then stops and closes both
+        cameras.
+        """
+        logger.debug('Function close')
+        switch_thread = self._switch_thread
+        if switch_thread is not None:
+            switch_thread.join()
+        with self._lock:
+            active = self._active
+            self._active = None
+        if (active is not None):
+            self._deactivate(*active)
+        for cam in self._cameras.values():
+            cam.stop()
+            cam.close()
+
+    def _run_switch(self):
+        failures = 0
+        while True:
+            with self._lock:
+                target = self._target
+                previous = self._active
+                if previous == target and not self._restart_requested:
+                    self._switch_thread = None
+                    return
+                self._restart_requested = False
+                # From here on the app sees no live device
+                self._active = None
+            try:
+                if previous is not None:
+                    self._deactivate(*previous)
+                    self._cameras[previous[0]].stop()
+                self._activate(*target)
+                # Wait for the new stream's first frame before handing the
+                # camera over, so the switch latency covers the whole switch
+                first_frame = self._cameras[target[0]].capture_array("lores")
+            except Exception:
+                failures += 1
+                logger.exception('Failed to switch camera to %s in %s (attempt %s)', target[0], target[1], failures)
+                self._abandon(*target)
+                if failures >= constants.CAMERA_SWITCH_ATTEMPTS:
+                    with self._lock:
+                        self._switch_thread = None
+                    logger.error('Giving up on switching camera to %s in %s', target[0], target[1])
+                    return
+                time.sleep(constants.CAMERA_SWITCH_RETRY_SECONDS)
+                continue
+            with self._lock:
+                self._active = target
+                self.last_frame = first_frame
+                # Only time switches someone asked for - not restarts - and
+                # only once the newest target is the one that's live
+                if self._switch_requested_at is not None and self._target == target:
+                    self.switch_latencies.append(time.monotonic() - self._switch_requested_at)
+                    logger.info('Camera switch took %.3fs', self.switch_latencies[-1])
+                    self._switch_requested_at = None
+
+    def _abandon(self, camera, capture_mode):
+        # Undo whatever part of a failed activation happened, so the next try
+        # starts from a stopped camera
+        try:
+            self._deactivate(camera, capture_mode)
+            self._cameras[camera].stop()
+        except Exception:
+            logger.exception('Failed to stop camera %s after a failed switch', camera)
+
+    def _build_configurations(self):
+        configurations = {}
+        for camera, cam in self._cameras.items():
+            for capture_mode in CaptureMode:
+                configurations[(camera, capture_mode)] = build_configuration(cam, capture_mode, **self.stream_settings)
+        # Replaced in one go, so a switch in progress sees either all old or all new
+        self._configurations = configurations
+
+    def _activate(self, camera, capture_mode):
+        cam = self._cameras[camera]
+        cam.configure(self._configurations[(camera, capture_mode)])
+        if (self.frame_ring is not None):
+            self.frame_ring.clear()
+            if (capture_mode == CaptureMode.PICTURE):
+                cam.post_callback = self.frame_ring.push_request
+            else:
+                cam.post_callback = None
+        cam.start()
+        if (self.recorder is not None and capture_mode == CaptureMode.VIDEO):
+            self.recorder.attach(cam)
+
+    def _deactivate(self, camera, capture_mode):
+        if (self.recorder is not None and capture_mode == CaptureMode.VIDEO):
+            self.recorder.detach()
@@ -0,0 +1,142 @@
+from collections import deque
+import logging
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+from previews import write_preview
+import constants
+
+logger = logging.getLogger(__name__)
+
+# The stages a capture goes through, in order, for timing purposes
+STAGES = ['grab', 'encode', 'write', 'preview']
+
+# A still photo waiting to be saved
+class CaptureJob():
+    def __init__(self, filename, image, grab_seconds):
+        self.filename = filename
+        self.image = image
+        self.timings = {'grab': grab_seconds}
+
+# Saves still photos off the UI thread.
+# The UI thread only grabs the frame from the camera and hands it over; a small
+# pool of workers then encodes the JPEG, writes and syncs it to the SD card,
+# writes its gallery preview and finally tells on_saved that the file is safely
+# on disk. Until then the photo is only in memory, so the album doesn't list it.
+# The queue between the two is bounded. When it's full, new captures are turned
+# away rather than letting them pile up in memory or block the preview, and
+# submit returns False so the caller can tell.
+class CapturePipeline():
+    def __init__(self, on_saved=None, workers=constants.CAPTURE_WORKERS, max_queue=constants.CAPTURE_QUEUE_SIZE):
+        logger.debug('Function CapturePipeline __init__')
+        self.on_saved = on_saved
+        self.saved = 0
+        self.rejected = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._timings = dict((stage, deque(maxlen=constants.CAPTURE_TIMING_HISTORY)) for stage in STAGES)
+        self._timings_lock = threading.Lock()
+        self._workers = []
+        for index in range(workers):
+            worker = threading.Thread(target=self._run, name='capture-%s' % index, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, filename, image, grab_seconds=0.0):
+        """
+        submit queues a grabbed frame to be saved as a JPEG. It never blocks.
+        @param filename where the photo should end up
+        @param image the frame as a BGR array, which the pipeline now owns
+        @param grab_seconds how long it took to get the frame from the camera
+        @return True if the photo was queued, False if the queue was full
+        """
+        try:
+            self._queue.put_nowait(CaptureJob(filename, image, grab_seconds))
+        except queue.Full:
+            self.rejected += 1
+            logger.warning('Capture queue is full - dropping capture %s', filename)
+            return False
+        logger.debug('Queued capture %s, queue depth is now %s', filename, self.queue_depth)
+        return True
+
+    def stats(self):
+        """
+        stats returns the queue depth, counters, and the mean and worst time
+        spent in each stage over recent captures, in seconds.
+        """
+        result = {
+            "queue_depth": self.queue_depth,
+            "saved": self.saved,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+        with self._timings_lock:
+            for stage, durations in self._timings.items():
+                if durations:
+                    result[stage + "_mean"] = sum(durations) / len(durations)
+                    result[stage + "_max"] = max(durations)
+        return result
+
+    def close(self):
+        """
+        close waits for every queued photo to be saved, then stops the workers.
+        """
+        logger.debug('Function close')
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self._save(job)
+            except Exception:
+                with self._timings_lock:
+                    self.failed += 1
+                logger.exception('Failed to save capture %s', job.filename)
+
+    def _save(self, job):
+        started = time.monotonic()
+        success, encoded = cv2.imencode('.jpeg', job.image, [cv2.IMWRITE_JPEG_QUALITY, constants.CAPTURE_JPEG_QUALITY])
+        if not success:
+            raise ValueError('Could not encode capture ' + job.filename)
+        encoded_at = time.monotonic()
+        job.timings['encode'] = encoded_at - started
+        # Write under a temporary name and sync before renaming, so a photo
+        # either exists completely or not at all, even if the power goes.
+        # The temporary file is hidden so the album never lists it.
+        directory, name = os.path.split(job.filename)
+        temporary = os.path.join(directory, '.' + name + '.tmp')
+        with open(temporary, 'wb') as f:
+            f.write(encoded.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, job.filename)
+        written_at = time.monotonic()
+        job.timings['write'] = written_at - encoded_at
+        try:
+            write_preview(job.filename, image=job.image)
+        except (ValueError, OSError):
+            logger.exception('Failed to write preview for %s', job.filename)
+        job.timings['preview'] = time.monotonic() - written_at
+        job.image = None
+        with self._timings_lock:
+            for stage, duration in job.timings.items():
+                self._timings[stage].append(duration)
+            self.saved += 1
+        logger.info('Saved capture %s', job.filename)
+        logger.debug('Capture timings for %s: %s', job.filename, job.timings)
+        if self.on_saved is not None:
+            self.on_saved(job.filename)
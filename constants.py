@@ -29,6 +29,20 @@ ICON_NFC_ACTIVE='smartphone-nfc.svg'
 ICON_SWITCH_CAMERA='switch-camera.svg'
 ICON_STARTUP='aperture.svg'
 ICON_SHUTDOWN='moon.svg'
+# Where the icon atlas saves its rasterised icons between runs (None to disable)
+ICON_CACHE_PATH='./.icon-cache'
+
+# The colour of on-screen text and icons
+UI_COLOR=(211,198,170)
+# Battery icon and colour for each level, as (above this percent, icon, colour)
+# checked from the top down
+BATTERY_LEVELS=[
+    (70, ICON_BATTERY_FULL, (0,255,0)),
+    (40, ICON_BATTERY_MED, (150,150,0)),
+    (15, ICON_BATTERY_LOW, (255,150,0)),
+    (-1, ICON_BATTERY_WARNING, (255,0,0)),
+]
+BATTERY_CHARGING_COLOR=(0,255,150)
 
 CAPTURE_BUTTON_ID=25
 ENCODER_INPUT_A_ID=13
@@ -37,8 +51,177 @@ FOURPOS_A_ID=5
 FOURPOS_B_ID=6
 FOURPOS_C_ID=12
 FOURPOS_D_ID=16
+# Encoder acceleration: ticks this close together count as two steps, closer
+# still as more, up to ENCODER_ACCEL_MAX steps per tick
+ENCODER_FAST_TICK_SECONDS=0.08
+ENCODER_ACCEL_MAX=4
+# Debounce for the encoder's pins. Its quadrature decoding already ignores
+# contact bounce, and a longer debounce would keep ticks further apart than
+# ENCODER_FAST_TICK_SECONDS, so acceleration could never kick in
+ENCODER_BOUNCE_SECONDS=0.002
 
 CAM_SLF_ID=0
 CAM_FWD_ID=1
 
 FULLSCREEN=0
+
+# How often, in seconds, to check the gallery directory for outside changes
+ALBUM_WATCH_INTERVAL=2
+
+# The size of the screen, which everything in the gallery is scaled to
+DISPLAY_SIZE=(640, 480)
+# Memory budget, in bytes, for decoded gallery images held in memory
+# A display-sized surface is about 1.2MB, so this holds roughly 50 images
+GALLERY_CACHE_BYTES=64 * 1024 * 1024
+
+# File extensions that the gallery treats as videos rather than still images
+VIDEO_EXTENSIONS=('.h264', '.mp4')
+# How many gallery items either side of the current one to decode ahead of
+# time, and the furthest ahead to look when the encoder is spun quickly
+PREFETCH_RADIUS=2
+PREFETCH_MAX_RADIUS=8
+# How many seconds of scrolling at the current speed to decode ahead for
+PREFETCH_LOOKAHEAD_SECONDS=0.5
+# Number of background threads decoding gallery items
+PREFETCH_WORKERS=2
+
+# Hidden directory inside each album holding display-sized copies of its files
+PREVIEW_DIR='.previews'
+PREVIEW_JPEG_QUALITY=85
+
+# Target frame rates for the main loop in each state
+# Showing the camera preview, matched to the sensor's frame rate
+PREVIEW_FPS=30
+# Showing a still in the gallery, which only needs to notice the battery icon
+GALLERY_FPS=5
+# Nobody has touched the device for DEEP_IDLE_SECONDS
+DEEP_IDLE_FPS=1
+DEEP_IDLE_SECONDS=60
+
+# How many rendered text labels to keep around
+LABEL_CACHE_ENTRIES=64
+
+# Camera stream setup
+# The low resolution stream used for the on-screen preview. Pi 4 and earlier
+# can only produce YUV420 on this stream; a Pi 5 can use XBGR8888, which
+# needs no conversion at all before it reaches the screen.
+PREVIEW_FORMAT='YUV420'
+# The main stream size while in video mode, which is what gets recorded
+# The hardware H.264 encoder tops out at 1080p
+RECORDING_SIZE=(1920, 1080)
+
+# Still capture pipeline
+# Number of background threads encoding and saving photos
+CAPTURE_WORKERS=2
+# How many photos can wait to be saved before new captures are turned away
+CAPTURE_QUEUE_SIZE=4
+CAPTURE_JPEG_QUALITY=92
+# How many recent captures to keep per-stage timings for
+CAPTURE_TIMING_HISTORY=50
+
+# Zero shutter lag: keep the last few full resolution frames in memory so a
+# press saves the frame from when the button went down
+ZSL_ENABLED=False
+# How many frames to keep, and the most memory they may use between them -
+# the depth is reduced to fit if the frames are too big
+ZSL_DEPTH=8
+ZSL_MEMORY_LIMIT=256 * 1024 * 1024
+# How many frames around the press to save for each press
+ZSL_BURST_COUNT=1
+# How many recent camera switch times to keep for reporting
+CAMERA_SWITCH_HISTORY=20
+# How many times a camera switch is tried before giving up until the next
+# one is asked for, and how long to wait between tries
+CAMERA_SWITCH_ATTEMPTS=3
+CAMERA_SWITCH_RETRY_SECONDS=0.5
+
+# How many decoded video frames to hold ready ahead of playback
+VIDEO_QUEUE_FRAMES=8
+# The file in each album's preview directory holding its videos' frame rate,
+# frame count and duration
+VIDEO_INFO_FILE='videos.json'
+# How long a video has to be on screen before its decoder is started, so that
+# scrolling past videos only ever shows their posters
+VIDEO_START_DELAY=0.5
+# Recording: the frame rate and bitrate of recorded video
+RECORDING_FPS=30
+RECORDING_BITRATE=10000000
+# How many seconds from before the button press every recording starts with
+RECORDING_PREROLL_SECONDS=2
+# The hidden directory under the base pic path that recordings are muxed into
+# before being moved into their album
+RECORDING_SCRATCH_DIR='.recordings'
+# How many recording start latencies to keep for stats
+RECORDING_LATENCY_HISTORY=20
+# Playback proxies: the hidden directory in each album they're kept in, and
+# their bitrate
+PROXY_DIR='.proxies'
+PROXY_BITRATE='1M'
+# How often the proxy job checks whether it may run
+PROXY_POLL_INTERVAL=1
+# How long without any input before the proxy job may run on battery
+PROXY_IDLE_SECONDS=30
+# Recordings are fragmented MP4 with a fragment at every keyframe, so a clip
+# cut short still plays up to its last fragment
+RECORDING_MOVFLAGS='frag_keyframe+empty_moov+default_base_moof'
+# Input-to-photon latency: how many samples to keep per kind of event, how
+# long to wait for an event's result to reach the screen before giving up on
+# it, where the report is written, and whether to show it on screen
+LATENCY_HISTORY=500
+LATENCY_PENDING_TIMEOUT=2
+LATENCY_REPORT_PATH='./latency.json'
+LATENCY_OVERLAY=False
+# Frame profiler: how many frames to keep timings for, where the trace is
+# written, whether the overlay starts out shown, and how often it's redrawn
+PROFILER_HISTORY=300
+PROFILER_TRACE_PATH='./frame-trace.json'
+PROFILER_OVERLAY=False
+PROFILER_OVERLAY_INTERVAL=1
+# How often to read the battery status
+BATTERY_POLL_SECONDS=5
+# Logging: how many records the in-memory flight recorder keeps, how often a
+# message repeated from the same place is kept, where dumps are written and
+# how often an error may trigger one, and the levels for the flight recorder
+# and the console
+FLIGHT_RECORDER_RECORDS=20000
+FLIGHT_RECORDER_REPEAT_SECONDS=5
+FLIGHT_RECORDER_PATH='./flight-recorder'
+FLIGHT_RECORDER_ERROR_DUMP_INTERVAL=60
+FLIGHT_RECORDER_LEVEL='DEBUG'
+CONSOLE_LOG_LEVEL='WARNING'
+# UPS HAT power sensor: where it is on the I2C bus, how often it's sampled,
+# how much each sample moves the smoothed readings, the battery voltages read
+# as empty and full, and the current into the battery that counts as charging
+POWER_I2C_BUS=1
+POWER_I2C_ADDRESS=0x42
+POWER_SAMPLE_INTERVAL=2
+POWER_SMOOTHING=0.2
+POWER_EMPTY_VOLTS=6.0
+POWER_FULL_VOLTS=8.4
+POWER_CHARGING_MA=50
+# Quality governor: the ladder of quality levels it steps through, best first.
+# Each sets the preview's frame rate and size, the recording bitrate and size,
+# and whether background jobs like proxy transcodes may run
+QUALITY_LADDER=[
+    {"name": "full", "preview_fps": PREVIEW_FPS, "preview_size": DISPLAY_SIZE,
+     "recording_bitrate": RECORDING_BITRATE, "recording_size": RECORDING_SIZE, "background_jobs": True},
+    {"name": "saver", "preview_fps": 24, "preview_size": DISPLAY_SIZE,
+     "recording_bitrate": 6000000, "recording_size": RECORDING_SIZE, "background_jobs": True},
+    {"name": "low", "preview_fps": 15, "preview_size": (320, 240),
+     "recording_bitrate": 4000000, "recording_size": (1280, 720), "background_jobs": False},
+    {"name": "critical", "preview_fps": 10, "preview_size": (320, 240),
+     "recording_bitrate": 2000000, "recording_size": (1280, 720), "background_jobs": False},
+]
+# The battery percentages below which, and SoC temperatures in degrees Celsius
+# at or above which, the governor moves to each level after the first. A
+# reading must clear a threshold by the hysteresis to move back up, no sooner
+# than GOVERNOR_MIN_DWELL_SECONDS after the last change
+GOVERNOR_BATTERY_THRESHOLDS=[50, 20, 8]
+GOVERNOR_BATTERY_HYSTERESIS=5
+GOVERNOR_TEMPERATURE_THRESHOLDS=[70, 77, 82]
+GOVERNOR_TEMPERATURE_HYSTERESIS=5
+GOVERNOR_MIN_DWELL_SECONDS=30
+# How often the governor samples the battery and temperature, and where the
+# SoC temperature is read from
+GOVERNOR_INTERVAL=5
+THERMAL_ZONE_PATH='/sys/class/thermal/thermal_zone0/temp'
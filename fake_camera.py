@@ -0,0 +1,285 @@
+from collections import deque
+import functools
+import logging
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# A stand-in for Picamera2 that needs no camera hardware.
+# It implements the parts of the Picamera2 API the app uses, and produces
+# synthetic frames at a fixed frame rate: capture_array blocks until the next
+# frame is due, like the real thing does. Each frame is a flat colour that
+# changes from frame to frame, so consecutive frames always differ.
+# A stream's buffer is only filled for a frame when something reads it, so the
+# full-size main stream costs nothing on frames where only lores is used.
+# start_delay simulates how long a real camera takes to start streaming.
+# While an encoder is running, each frame also hands its next encoded frame to
+# the encoder's output.
+# Pass FakePicamera2 as the backend to CameraManager to run without a camera,
+# or call install_fake_picamera2 before importing the app to run all of it
+# without the picamera2 package.
+class FakePicamera2():
+    def __init__(self, camera_num=0, fps=30, sensor_resolution=(4056, 3040), start_delay=0.0):
+        logger.debug('Function FakePicamera2 __init__')
+        self.camera_num = camera_num
+        self.fps = fps
+        self.sensor_resolution = sensor_resolution
+        self.start_delay = start_delay
+        self.post_callback = None
+        self.started = False
+        self.encoder = None
+        self.encoder_output = None
+        self.frames = 0
+        self._configuration = None
+        self._buffers = {}
+        self._filled = {}            # The frame each stream's buffer was last filled for
+        self._next_frame = time.monotonic()
+
+    def create_preview_configuration(self, main=None, lores=None, display=None, encode=None, buffer_count=4, controls=None):
+        return {
+            "main": dict(main or {"size": (640, 480), "format": "XBGR8888"}),
+            "lores": dict(lores) if lores else None,
+            "display": display,
+            "encode": encode,
+            "buffer_count": buffer_count,
+            "controls": dict(controls or {}),
+        }
+
+    def configure(self, configuration):
+        if self.started:
+            raise RuntimeError('Camera must be stopped before configuring')
+        self._configuration = configuration
+        self._buffers = {}
+        self._filled = {}
+        for name in ("main", "lores"):
+            stream = configuration.get(name)
+            if stream:
+                self._buffers[name] = np.zeros(frame_shape(stream["size"], stream["format"]), dtype=np.uint8)
+
+    def camera_configuration(self):
+        return self._configuration
+
+    def start(self):
+        if self._configuration is None:
+            self.configure(self.create_preview_configuration())
+        time.sleep(self.start_delay)
+        self.started = True
+        self._next_frame = time.monotonic()
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.started = False
+
+    def capture_array(self, name="main"):
+        self._next_frame_due()
+        return self._buffer(name).copy()
+
+    def capture_request(self):
+        self._next_frame_due()
+        return FakeCompletedRequest(self)
+
+    def _buffer(self, name):
+        # Bring the stream's buffer up to the current frame
+        buffer = self._buffers[name]
+        if self._filled.get(name) != self.frames:
+            buffer.fill(self.frames % 256)
+            self._filled[name] = self.frames
+        return buffer
+
+    def _next_frame_due(self):
+        if not self.started:
+            raise RuntimeError('Camera is not running')
+        # Wait for the next frame to be due
+        delay = self._next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame = max(self._next_frame + 1.0 / self.fps, time.monotonic())
+        self.frames += 1
+        if self.post_callback is not None:
+            self.post_callback(FakeCompletedRequest(self))
+        encoder = self.encoder
+        output = self.encoder_output
+        if encoder is not None and output is not None:
+            encoded = encoder.encode_next()
+            if encoded is not None:
+                output.outputframe(*encoded)
+
+    def start_encoder(self, encoder, output=None, name=None):
+        self.encoder = encoder
+        self.encoder_output = output
+
+    def stop_encoder(self, encoders=None):
+        self.encoder = None
+        self.encoder_output = None
+
+    def start_recording(self, encoder, output, name=None):
+        self.start_encoder(encoder, output, name)
+
+    def stop_recording(self):
+        self.stop_encoder()
+
+# The parts of a picamera2 CompletedRequest that the app uses
+class FakeCompletedRequest():
+    def __init__(self, camera):
+        self._camera = camera
+
+    def make_array(self, name):
+        return self._camera._buffer(name).copy()
+
+    def release(self):
+        pass
+
+def frame_shape(size, pixel_format):
+    """
+    frame_shape returns the numpy array shape Picamera2 uses for a stream of
+    the given size and format.
+    """
+    width, height = size
+    if pixel_format == "YUV420":
+        return (height * 3 // 2, width)
+    if pixel_format in ("RGB888", "BGR888"):
+        return (height, width, 3)
+    return (height, width, 4)
+
+# The part of picamera2's MappedArray the app uses: the stream's buffer itself,
+# not a copy of it
+class FakeMappedArray():
+    def __init__(self, request, stream):
+        self.array = request._camera._buffer(stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+# Stands in for the encoder the recorder uses. Nothing is really encoded:
+# given frames, from h264_frames, it hands them out one per camera frame and
+# starts again from the first when it runs out, so a short canned clip makes a
+# stream of any length. Without frames it produces nothing.
+class FakeH264Encoder():
+    def __init__(self, bitrate=None, repeat=False, iperiod=None, frames=None):
+        self.bitrate = bitrate
+        self.repeat = repeat
+        self.iperiod = iperiod
+        self.frames = frames or []
+        self._next = 0
+
+    def encode_next(self):
+        """
+        encode_next returns the next (data, keyframe) encoded frame, or None.
+        """
+        if not self.frames:
+            return None
+        frame = self.frames[self._next % len(self.frames)]
+        self._next += 1
+        return frame
+
+# Stands in for picamera2's CircularOutput: it keeps the last buffersize
+# frames, and once started, writes them out from the first keyframe among
+# them, then every frame as it arrives, to fileoutput.
+class FakeCircularOutput():
+    def __init__(self, file=None, pts=None, buffersize=150, outputtofile=False):
+        self.fileoutput = file
+        self.buffersize = buffersize
+        self.recording = False
+        self._buffer = deque(maxlen=buffersize)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.recording = True
+            buffered = list(self._buffer)
+            self._buffer.clear()
+            while buffered and not buffered[0][1]:
+                buffered.pop(0)
+            for data, _ in buffered:
+                self._write(data)
+
+    def stop(self):
+        with self._lock:
+            self.recording = False
+
+    def outputframe(self, frame, keyframe=True, timestamp=None):
+        with self._lock:
+            if self.recording:
+                self._write(frame)
+            else:
+                self._buffer.append((frame, keyframe))
+
+    def _write(self, data):
+        if self.fileoutput is None:
+            return
+        try:
+            self.fileoutput.write(data)
+        except (BrokenPipeError, ValueError):
+            # The muxer has gone away
+            self.fileoutput = None
+
+def h264_frames(data):
+    """
+    h264_frames splits a raw Annex B H.264 stream, with one slice per frame,
+    into its frames, for FakeH264Encoder to hand out.
+    @param data the stream's bytes
+    @return a list of (bytes, keyframe) for each frame, where each frame's
+        bytes include the parameter sets that came before it
+    """
+    # Find where each NAL unit starts, including its start code
+    starts = []
+    position = data.find(b'\x00\x00\x01')
+    while position != -1:
+        start = position - 1 if position > 0 and data[position - 1] == 0 else position
+        starts.append((start, position + 3))
+        position = data.find(b'\x00\x00\x01', position + 3)
+    frames = []
+    frame_start = None
+    keyframe = False
+    for index, (start, header) in enumerate(starts):
+        end = starts[index + 1][0] if index + 1 < len(starts) else len(data)
+        if header >= len(data):
+            break
+        nal_type = data[header] & 0x1F
+        if frame_start is None:
+            frame_start = start
+        if nal_type == 5:
+            keyframe = True
+        if nal_type in (1, 5):
+            # A slice ends the frame
+            frames.append((data[frame_start:end], keyframe))
+            frame_start = None
+            keyframe = False
+    return frames
+
+def install_fake_picamera2(camera_class=FakePicamera2, h264_clip=None):
+    """
+    install_fake_picamera2 registers fake picamera2, picamera2.encoders and
+    picamera2.outputs modules, so the app's modules can be imported and run
+    on a machine without the picamera2 package. It must be called before
+    anything imports picamera2.
+    @param camera_class what Picamera2 should construct, such as a partial
+        of FakePicamera2 with a particular frame rate
+    @param h264_clip the bytes of a raw H.264 clip for every encoder to play
+        on a loop, so that recordings get real video data
+    """
+    picamera2 = types.ModuleType('picamera2')
+    picamera2.Picamera2 = camera_class
+    picamera2.MappedArray = FakeMappedArray
+    encoders = types.ModuleType('picamera2.encoders')
+    if h264_clip is None:
+        encoders.H264Encoder = FakeH264Encoder
+    else:
+        encoders.H264Encoder = functools.partial(FakeH264Encoder, frames=h264_frames(h264_clip))
+    outputs = types.ModuleType('picamera2.outputs')
+    outputs.CircularOutput = FakeCircularOutput
+    picamera2.encoders = encoders
+    picamera2.outputs = outputs
+    sys.modules['picamera2'] = picamera2
+    sys.modules['picamera2.encoders'] = encoders
+    sys.modules['picamera2.outputs'] = outputs
@@ -0,0 +1,60 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# INA219 register addresses
+_REG_CONFIG = 0x00
+_REG_SHUNTVOLTAGE = 0x01
+_REG_BUSVOLTAGE = 0x02
+_REG_POWER = 0x03
+_REG_CURRENT = 0x04
+_REG_CALIBRATION = 0x05
+
+# A stand-in for an smbus.SMBus with the UPS HAT's INA219 on it, for running
+# the power monitor without the hardware.
+# Set voltage and current_ma to whatever the battery should be doing - a
+# positive current is charging. Like the real chip, the current and power
+# registers read zero until the calibration register has been written, and
+# brownout clears it again. Every register write is kept in writes, so callers
+# can check how often the calibration is written.
+class FakeSMBus():
+    def __init__(self, voltage=7.8, current_ma=-400.0, shunt_ohms=0.1):
+        logger.debug('Function FakeSMBus __init__')
+        self.voltage = voltage
+        self.current_ma = current_ma
+        self.shunt_ohms = shunt_ohms
+        self.registers = {_REG_CONFIG: 0x399F, _REG_CALIBRATION: 0}
+        self.writes = []             # (addr, register, value) for every write
+        self.reads = 0
+
+    def brownout(self):
+        """
+        brownout resets the chip's registers, as a voltage dip would.
+        """
+        self.registers = {_REG_CONFIG: 0x399F, _REG_CALIBRATION: 0}
+
+    def write_i2c_block_data(self, addr, register, data):
+        value = (data[0] << 8) | data[1]
+        self.writes.append((addr, register, value))
+        self.registers[register] = value
+
+    def read_i2c_block_data(self, addr, register, length):
+        self.reads += 1
+        value = self._register_value(register) & 0xFFFF
+        return [value >> 8, value & 0xFF][:length]
+
+    def _register_value(self, register):
+        calibrated = self.registers.get(_REG_CALIBRATION, 0) != 0
+        if register == _REG_SHUNTVOLTAGE:
+            # 10uV per bit
+            return round(self.current_ma / 1000 * self.shunt_ohms / 0.00001)
+        if register == _REG_BUSVOLTAGE:
+            # 4mV per bit, in the top 13 bits
+            return round(self.voltage / 0.004) << 3
+        if register == _REG_CURRENT:
+            # 100uA per bit with the 32V 2A calibration
+            return round(self.current_ma / 0.1) if calibrated else 0
+        if register == _REG_POWER:
+            # 2mW per bit
+            return round(abs(self.voltage * self.current_ma / 1000) / 0.002) if calibrated else 0
+        return self.registers.get(register, 0)
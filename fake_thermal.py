@@ -0,0 +1,16 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A stand-in for the SoC's thermal zone, for running the quality governor
+# without a Pi. Set temperature to whatever the SoC should be doing, in
+# degrees Celsius, and pass read as the governor's thermal source.
+class FakeThermal():
+    def __init__(self, temperature=45.0):
+        logger.debug('Function FakeThermal __init__')
+        self.temperature = temperature
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        return self.temperature
@@ -0,0 +1,131 @@
+from collections import deque
+import logging
+import os
+import signal
+import threading
+import time
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+# An in-memory flight recorder for the app's logs.
+# Writing every log line to the journal costs string formatting and SD card
+# I/O all the time, for output nobody reads unless something went wrong. The
+# flight recorder instead keeps the most recent records in a ring buffer, still
+# unformatted - a record's message is only built if it's ever written out - and
+# only the console handler, at WARNING, writes anything as it happens.
+# The buffer is written to a file in FLIGHT_RECORDER_PATH when an error is
+# logged (at most once every FLIGHT_RECORDER_ERROR_DUMP_INTERVAL seconds, on a
+# thread of its own so the thread that logged it isn't held up), when the app
+# shuts down, on SIGUSR1, or whenever dump is called.
+# The same message with the same arguments logged from the same place over and
+# over is only kept once every FLIGHT_RECORDER_REPEAT_SECONDS; the next one
+# kept notes how many were skipped. Warnings and errors are always kept.
+# Repeats are only tracked for FLIGHT_RECORDER_REPEAT_SECONDS, so messages with
+# ever-changing arguments don't pile up: once a repeat has been quiet that long,
+# it's forgotten, along with any count of skipped records it hadn't noted yet.
+class FlightRecorder(logging.Handler):
+    def __init__(self, capacity=constants.FLIGHT_RECORDER_RECORDS, repeat_seconds=constants.FLIGHT_RECORDER_REPEAT_SECONDS,
+                 dump_dir=constants.FLIGHT_RECORDER_PATH, level=constants.FLIGHT_RECORDER_LEVEL):
+        super().__init__(level)
+        self.records = deque(maxlen=capacity)
+        self.repeat_seconds = repeat_seconds
+        self.dump_dir = dump_dir
+        self._last_kept = {}         # Repeat key -> [when a record with it was last kept, how many skipped since]
+        self._pruned_at = 0          # The record time _last_kept was last pruned at
+        self._last_error_dump = None
+        self.setFormatter(logging.Formatter('%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s'))
+
+    def emit(self, record):
+        # Called with the handler's lock held
+        record.skipped = 0
+        if record.created - self._pruned_at > self.repeat_seconds:
+            self._prune(record.created)
+        if record.levelno < logging.WARNING:
+            site = repeat_key(record)
+            kept = self._last_kept.get(site)
+            if kept is not None and record.created - kept[0] < self.repeat_seconds:
+                kept[1] += 1
+                return
+            record.skipped = kept[1] if kept is not None else 0
+            self._last_kept[site] = [record.created, 0]
+        if record.exc_info:
+            # Render the traceback now, rather than keep its frames alive
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+        if record.levelno >= logging.ERROR:
+            if self._last_error_dump is None or time.monotonic() - self._last_error_dump > constants.FLIGHT_RECORDER_ERROR_DUMP_INTERVAL:
+                self._last_error_dump = time.monotonic()
+                # Writing out the whole buffer is slow, so don't do it on the
+                # thread that logged the error
+                threading.Thread(target=self.dump, args=('error',), name='flight-recorder-dump', daemon=True).start()
+
+    def _prune(self, now):
+        # Called with the handler's lock held
+        self._pruned_at = now
+        self._last_kept = {key: kept for key, kept in self._last_kept.items() if now - kept[0] < self.repeat_seconds}
+
+    def dump(self, reason='request'):
+        """
+        dump writes every record in the buffer to a new file, oldest first.
+        @param reason why the dump was made, which goes in the file name
+        @return the path of the file written
+        """
+        with self.lock:
+            records = list(self.records)
+        os.makedirs(self.dump_dir, exist_ok=True)
+        path = os.path.join(self.dump_dir, 'flight-{}-{}.log'.format(time.strftime('%Y%m%d-%H%M%S'), reason))
+        with open(path, 'w') as f:
+            for record in records:
+                line = self.format(record)
+                if record.skipped:
+                    line += ' [{} similar skipped before this]'.format(record.skipped)
+                f.write(line + '\n')
+        return path
+
+def repeat_key(record):
+    """
+    repeat_key identifies what counts as a repeat of a record: the same call
+    site logging the same message with the same arguments.
+    @param record the LogRecord
+    """
+    key = (record.pathname, record.lineno, record.msg)
+    try:
+        return key + (hash(record.args), record.args)
+    except TypeError:
+        # Unhashable arguments - only the call site and message can match
+        return key
+
+# The installed flight recorder, if any
+recorder = None
+
+def install():
+    """
+    install sets up logging for the app: everything down to
+    FLIGHT_RECORDER_LEVEL goes to the flight recorder, and only
+    CONSOLE_LOG_LEVEL and above to the console. SIGUSR1 dumps the recorder.
+    """
+    global recorder
+    recorder = FlightRecorder()
+    console = logging.StreamHandler()
+    console.setLevel(constants.CONSOLE_LOG_LEVEL)
+    console.setFormatter(recorder.formatter)
+    root = logging.getLogger()
+    root.setLevel(constants.FLIGHT_RECORDER_LEVEL)
+    root.addHandler(recorder)
+    root.addHandler(console)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump('signal'))
+    return recorder
+
+def dump(reason='request'):
+    """
+    dump writes out the installed flight recorder, if there is one.
+    @param reason why the dump was made, which goes in the file name
+    """
+    if recorder is None:
+        return None
+    path = recorder.dump(reason)
+    logger.warning('Wrote flight recorder log to %s', path)
+    return path
@@ -0,0 +1,96 @@
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+from picamera2 import MappedArray
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+# A ring buffer of the most recent full resolution camera frames, for zero
+# shutter lag capture.
+# By the time a shutter press has made its way through the event queue to the
+# capture code, the moment has passed. With this buffer running, every camera
+# frame is copied into one of a fixed set of preallocated arrays as it arrives,
+# stamped with the monotonic time, and a press can then save whichever frame is
+# closest to when the button actually went down.
+# No memory is allocated per frame: the slots are allocated once, when the
+# first frame arrives (and again only if the frame size changes), and the
+# number of slots is capped so the whole buffer fits in max_bytes.
+class FrameRingBuffer():
+    def __init__(self, depth=constants.ZSL_DEPTH, max_bytes=constants.ZSL_MEMORY_LIMIT):
+        logger.debug('Function FrameRingBuffer __init__')
+        self.requested_depth = depth
+        self.max_bytes = max_bytes
+        self.depth = 0
+        self._shape = None
+        self._lock = threading.Lock()
+        self._slots = []
+        self._timestamps = []
+        self._next = 0
+
+    def push_request(self, request):
+        """
+        push_request is a Picamera2 post_callback that copies the main stream
+        of each completed request into the buffer.
+        @param request the picamera2 CompletedRequest
+        """
+        with MappedArray(request, "main") as mapped:
+            self.push(mapped.array, time.monotonic())
+
+    def push(self, frame, timestamp):
+        """
+        push copies a frame into the oldest slot of the buffer.
+        @param frame the frame as an array
+        @param timestamp the time.monotonic() the frame arrived at
+        """
+        with self._lock:
+            if frame.shape != self._shape:
+                self._allocate(frame.shape, frame.dtype)
+            if self.depth == 0:
+                return
+            index = self._next
+            self._next = (self._next + 1) % self.depth
+            # Mark the slot as being written, so readers skip it meanwhile
+            self._timestamps[index] = math.nan
+        np.copyto(self._slots[index], frame)
+        with self._lock:
+            self._timestamps[index] = timestamp
+
+    def closest(self, timestamp, count=1):
+        """
+        closest copies out the count frames nearest in time to the given
+        timestamp, oldest first. Fewer frames are returned if the buffer
+        doesn't hold enough yet.
+        @param timestamp the time.monotonic() to look for, such as a press time
+        @param count how many frames to return, for a burst
+        @return a list of (timestamp, frame) pairs
+        """
+        with self._lock:
+            filled = [(abs(ts - timestamp), index) for index, ts in enumerate(self._timestamps) if not math.isnan(ts)]
+            filled.sort()
+            chosen = sorted(filled[:count], key=lambda item: self._timestamps[item[1]])
+            return [(self._timestamps[index], self._slots[index].copy()) for _, index in chosen]
+
+    def clear(self):
+        """
+        clear forgets every buffered frame, for example after the camera
+        switched, while keeping the slots allocated.
+        """
+        with self._lock:
+            self._timestamps = [math.nan] * self.depth
+
+    def _allocate(self, shape, dtype):
+        # Callers must hold the lock
+        self._shape = shape
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.depth = max(0, min(self.requested_depth, self.max_bytes // frame_bytes))
+        if self.depth < self.requested_depth:
+            logger.warning('Zero shutter lag buffer limited to %s frames by its memory ceiling', self.depth)
+        self._slots = [np.empty(shape, dtype=dtype) for _ in range(self.depth)]
+        self._timestamps = [math.nan] * self.depth
+        self._next = 0
+        logger.info('Allocated %s zero shutter lag slots of %s bytes', self.depth, frame_bytes)
@@ -0,0 +1,52 @@
+import logging
+import time
+
+import pygame
+
+logger = logging.getLogger(__name__)
+
+# Paces the main loop at a target frame rate that the app picks per state.
+# Instead of sleeping for the rest of the frame like pygame's Clock.tick, the
+# scheduler waits on the pygame event queue, so any input - a key, a GPIO
+# button or an encoder tick - wakes the loop straight away. That lets the app
+# drop to a very low frame rate when nothing is happening without making the
+# device feel any slower to respond.
+# The queue is drained before waiting, and the wait only happens if it was
+# empty. Events taken either way are held in woken_events so that the event
+# handler can process them in order ahead of anything that arrives later.
+# The queue is never peeked at: peeking frees the attributes of queued user
+# events, such as the GPIO events' timestamps, before they're taken.
+class FrameScheduler():
+    def __init__(self):
+        logger.debug('Function FrameScheduler __init__')
+        self.fps = None
+        self.woken_events = []
+        self._last_frame = time.monotonic()
+
+    def wait(self, fps):
+        """
+        wait blocks until it's time to start the next frame at the given frame
+        rate, or until an event arrives, whichever happens first.
+        @param fps the target frames per second for the current state
+        """
+        if fps != self.fps:
+            logger.info('Frame rate target changed to %s fps', fps)
+            self.fps = fps
+        deadline = self._last_frame + 1.0 / fps
+        self.woken_events.extend(pygame.event.get())
+        remaining = deadline - time.monotonic()
+        if remaining > 0 and not self.woken_events:
+            event = pygame.event.wait(int(remaining * 1000) + 1)
+            if event.type != pygame.NOEVENT:
+                self.woken_events.append(event)
+        self._last_frame = time.monotonic()
+
+    def take_events(self):
+        """
+        take_events returns every pending event: the ones that woke the loop,
+        followed by everything else on the pygame queue.
+        """
+        events = self.woken_events
+        self.woken_events = []
+        events.extend(pygame.event.get())
+        return events
@@ -0,0 +1,139 @@
+from collections import OrderedDict
+import logging
+import threading
+
+import pygame
+
+from previews import has_current_preview, preview_filename, write_any_preview
+import constants
+
+logger = logging.getLogger(__name__)
+
+def load_display_surface(filename, size=constants.DISPLAY_SIZE):
+    """
+    load_display_surface decodes an image file and scales it to the display
+    size, ready to be blitted straight onto the canvas.
+    @param filename the path of the image file to decode
+    @param size the (width, height) to scale the image to
+    """
+    logger.debug('Decoding and scaling image file %s', filename)
+    surface = pygame.image.load(filename)
+    if surface.get_size() != size:
+        surface = pygame.transform.scale(surface, size)
+    # Match the display's pixel format so blitting doesn't convert every time
+    if pygame.display.get_surface() is not None:
+        surface = surface.convert()
+    return surface
+
+def load_entry_surface(entry):
+    """
+    load_entry_surface loads the display-sized preview for an album index
+    entry - for a video, that's its poster frame. A file without a preview
+    gets one written first, so a full resolution photo is only ever decoded
+    once, and a video's decoder is only ever opened once just to show it.
+    @param entry an album index entry, as returned by Album.load_image
+    """
+    filename = entry["filename"]
+    if not has_current_preview(filename):
+        logger.info('No preview for %s yet - writing one', filename)
+        write_any_preview(filename)
+    return load_display_surface(preview_filename(filename))
+
+# A least-recently-used cache of decoded, display-sized gallery surfaces.
+# Entries are keyed by filename and modification time, so that a file which
+# changes on disk is decoded again rather than served stale. The cache is
+# bounded by the number of bytes held in pixel data rather than by the number
+# of entries, and keeps hit/miss/eviction counters for tuning that budget.
+# The cache is shared with the prefetch workers, so every access is locked.
+class SurfaceCache():
+    def __init__(self, max_bytes=constants.GALLERY_CACHE_BYTES):
+        logger.debug('Function SurfaceCache __init__')
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # The cached key for each filename, so older versions can be dropped
+        self._keys_by_filename = {}
+
+    def get(self, filename, mtime):
+        """
+        get returns the cached surface for the given file version, or None if
+        it has not been decoded yet. A hit marks the entry as recently used.
+        @param filename the path of the file
+        @param mtime the modification time of the file
+        """
+        key = (filename, mtime)
+        with self._lock:
+            surface = self._entries.get(key)
+            if surface is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return surface
+
+    def contains(self, filename, mtime):
+        """
+        contains checks whether a file version is cached, without counting
+        a hit or miss or changing its place in the eviction order.
+        @param filename the path of the file
+        @param mtime the modification time of the file
+        """
+        with self._lock:
+            return (filename, mtime) in self._entries
+
+    def put(self, filename, mtime, surface):
+        """
+        put stores a surface for the given file version, replacing any older
+        version of the same file, then evicts the least recently used entries
+        until the cache fits in its byte budget again.
+        @param filename the path of the file
+        @param mtime the modification time of the file
+        @param surface the display-ready pygame surface
+        """
+        key = (filename, mtime)
+        size = surface_bytes(surface)
+        if size > self.max_bytes:
+            logger.info('Not caching %s since it is larger than the whole cache', filename)
+            return
+        with self._lock:
+            old_key = self._keys_by_filename.get(filename)
+            if old_key is not None:
+                self._remove(old_key)
+            self._entries[key] = surface
+            self._keys_by_filename[filename] = key
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        stats returns the cache counters and current memory usage as a dict.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        # Callers must hold the lock
+        surface = self._entries.pop(key)
+        self.current_bytes -= surface_bytes(surface)
+        if self._keys_by_filename.get(key[0]) == key:
+            del self._keys_by_filename[key[0]]
+
+def surface_bytes(surface):
+    """
+    surface_bytes returns the number of bytes of pixel data held by a surface.
+    """
+    return surface.get_pitch() * surface.get_height()
@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+def read_soc_temperature(path=constants.THERMAL_ZONE_PATH):
+    """
+    read_soc_temperature returns the SoC temperature in degrees Celsius, from
+    the kernel's thermal zone.
+    @param path the thermal zone's temp file
+    """
+    with open(path) as f:
+        return int(f.read()) / 1000
+
+# Steps the app down QUALITY_LADDER as the battery runs down or the SoC heats
+# up, and back up again as things recover.
+# Each rung of the ladder sets the preview frame rate and size, the recording
+# bitrate and resolution, and whether background jobs may run. The battery
+# and the temperature each pick a rung from their thresholds - the battery's
+# only while it isn't charging - and the governor uses the lower of the two.
+# Stepping down happens as soon as a threshold is crossed. Stepping back up
+# needs the reading to clear the threshold by a margin, and the governor to
+# have stayed on its current rung for GOVERNOR_MIN_DWELL_SECONDS, so a reading
+# hovering around a threshold doesn't flap between rungs.
+# A background thread samples both sources every GOVERNOR_INTERVAL seconds and
+# publishes the rung in level; the app applies it from the main loop.
+class QualityGovernor():
+    def __init__(self, battery_source, thermal_source=read_soc_temperature, ladder=constants.QUALITY_LADDER,
+                 interval=constants.GOVERNOR_INTERVAL, min_dwell=constants.GOVERNOR_MIN_DWELL_SECONDS):
+        logger.debug('Function QualityGovernor __init__')
+        self.battery_source = battery_source
+        self.thermal_source = thermal_source
+        self.ladder = ladder
+        self.interval = interval
+        self.min_dwell = min_dwell
+        self.level = 0               # The index of the current rung - 0 is full quality
+        self.changes = 0
+        self.read_errors = 0
+        self.battery = None          # The last battery status read
+        self._battery_level = 0
+        self._thermal_level = 0
+        self._changed_at = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='quality-governor', daemon=True)
+
+    @property
+    def quality(self):
+        return self.ladder[self.level]
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def sample(self):
+        """
+        sample reads the battery and temperature once and updates the level.
+        """
+        try:
+            self.battery = self.battery_source()
+        except Exception:
+            # Carry on with the last status, rather than let the thread die
+            self.read_errors += 1
+            logger.warning('Failed to read the battery', exc_info=True)
+        try:
+            temperature = self.thermal_source()
+        except (OSError, ValueError):
+            self.read_errors += 1
+            logger.warning('Failed to read the SoC temperature', exc_info=True)
+            temperature = None
+        return self.update(self.battery, temperature)
+
+    def update(self, battery, temperature, now=None):
+        """
+        update picks the rung for a battery status and temperature.
+        @param battery a battery status in the form of psutil.sensors_battery,
+            or None if there's no battery
+        @param temperature the SoC temperature in degrees Celsius, or None if
+            it couldn't be read
+        @param now the time.monotonic() of the reading
+        @return the new level
+        """
+        if now is None:
+            now = time.monotonic()
+        if battery is None or battery.power_plugged:
+            self._battery_level = 0
+        elif battery.percent is None:
+            # The charge is unknown - don't run at full quality on it
+            self._battery_level = max(self._battery_level, 1)
+        else:
+            # Lower charge is worse
+            self._battery_level = step_level(-battery.percent, [-t for t in constants.GOVERNOR_BATTERY_THRESHOLDS],
+                constants.GOVERNOR_BATTERY_HYSTERESIS, self._battery_level)
+        if temperature is not None:
+            self._thermal_level = step_level(temperature, constants.GOVERNOR_TEMPERATURE_THRESHOLDS,
+                constants.GOVERNOR_TEMPERATURE_HYSTERESIS, self._thermal_level)
+        level = min(max(self._battery_level, self._thermal_level), len(self.ladder) - 1)
+        if level < self.level and self._changed_at is not None and now - self._changed_at < self.min_dwell:
+            # Too soon after the last change to step back up
+            return self.level
+        if level != self.level:
+            logger.warning('Quality %s -> %s (battery %s, %s C)', self.quality["name"], self.ladder[level]["name"],
+                'charging' if battery is not None and battery.power_plugged else getattr(battery, 'percent', 'unknown'), temperature)
+            self.level = level
+            self.changes += 1
+            self._changed_at = now
+        return self.level
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+def step_level(value, thresholds, margin, current):
+    """
+    step_level counts how many of the ascending thresholds a reading is at or
+    above - that's its level. A reading only brings the level down once it's
+    below a threshold by the margin.
+    @param value the reading, where higher is worse
+    @param thresholds the reading for each level after the first, ascending
+    @param margin how far below a threshold the reading must drop to leave it
+    @param current the level the reading was at last time
+    """
+    level = sum(1 for threshold in thresholds if value >= threshold)
+    if level >= current:
+        return level
+    return min(current, sum(1 for threshold in thresholds if value > threshold - margin))
@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 from functools import partial
 from gpiozero import RotaryEncoder
 from gpiozero import Button
@@ -12,6 +14,14 @@ logger = logging.getLogger(__name__)
 # https://github.com/gpiozero/gpiozero/issues/685
 was_held = False
 
+# Reads the camera's physical controls and turns them into pygame events.
+# Everything is edge-triggered from gpiozero callbacks, so nothing here is
+# polled by the main loop: the mode selector's position is cached whenever it
+# moves, and rotary encoder ticks are added up between frames, so the main loop
+# scrolls once per frame by however many steps have built up instead of
+# working through a backlog of single-tick events. The faster the encoder is
+# spun, the more steps each tick is worth.
+# Pass gpiozero's MockFactory as pin_factory to drive it without hardware.
 class GPIOInput():
     # This can be called to get the current value of the mode selector input
     def active_pos(self, override=None):
@@ -20,28 +30,58 @@ class GPIOInput():
         The override argument can be used to override whatever the hardware says
         with a specific SelectorPosition value. This is useful when using keyboard
         input.
+        The position is cached whenever the selector moves, so this never reads
+        the pins.
         """
-        logger.debug('Function active_pos')
         if (override != None):
             return override
-        if self.selector_a.is_pressed:
-            return SelectorPosition.ONE
-        if self.selector_b.is_pressed:
-            return SelectorPosition.TWO
-        if self.selector_c.is_pressed:
-            return SelectorPosition.THREE
-        if self.selector_d.is_pressed:
-            return SelectorPosition.FOUR
+        return self.position
+
+    def take_encoder_steps(self):
+        """
+        take_encoder_steps returns the encoder steps built up since the last
+        call, as a Direction and a number of steps, and starts counting again.
+        The number of steps is 0 if the encoder hasn't moved.
+        """
+        with self._encoder_lock:
+            steps = self._encoder_steps
+            self._encoder_steps = 0
+        if steps < 0:
+            return Direction.REV, -steps
+        return Direction.FWD, steps
+
+    def encoder_was_rotated(self, direction):
+        now = time.monotonic()
+        with self._encoder_lock:
+            # Ticks close together in the same direction are worth more steps
+            weight = 1
+            if (direction == self._last_tick_direction and self._last_tick_at is not None):
+                interval = now - self._last_tick_at
+                if interval > 0:
+                    weight = max(1, min(constants.ENCODER_ACCEL_MAX, round(constants.ENCODER_FAST_TICK_SECONDS / interval)))
+            self._last_tick_direction = direction
+            self._last_tick_at = now
+            was_idle = self._encoder_steps == 0
+            self._encoder_steps += weight if direction == Direction.FWD else -weight
+        # Only wake the main loop for the first tick it hasn't seen yet - later
+        # ticks are picked up along with it
+        if (was_idle and self.encoder_event_key is not None):
+            self.pygame_event_fn(self.encoder_event_key)
+
+    def button_went_down(self):
+        # Remember when the button went down, since the capture event is only
+        # sent once it comes back up
+        self.pressed_at = time.monotonic()
 
     def button_was_held(self):
         global was_held
         was_held = True
         # stuff that should happen when a hold event is triggered
-        partial(self.pygame_event_fn, self.long_press_event_key)
+        self.pygame_event_fn(self.long_press_event_key)
 
     def button_was_pressed(self):
         # stuff that should happen on press
-        partial(self.pygame_event_fn, self.capture_event_key)
+        self.pygame_event_fn(self.capture_event_key, pressed_at=self.pressed_at)
 
     def button_was_released(self):
         global was_held
@@ -49,7 +89,13 @@ class GPIOInput():
             self.button_was_pressed()
         was_held = False
 
-    def __init__(self, pygame_event_fn=None, encoder_event_key=None, capture_event_key=None, long_press_event_key=None):
+    def selector_was_moved(self, position):
+        self.position = position
+        # Wake up the main loop so it acts on the new position straight away
+        if (self.selector_event_key is not None):
+            self.pygame_event_fn(self.selector_event_key, pos=position)
+
+    def __init__(self, pygame_event_fn=None, encoder_event_key=None, capture_event_key=None, long_press_event_key=None, selector_event_key=None, pin_factory=None):
         logger.debug('Function GPIOInput __init__')
         if (pygame_event_fn is not None):
             logger.debug('Received pygame_event_fn for passing along as a callback')
@@ -61,20 +107,40 @@ class GPIOInput():
         self.encoder_event_key = encoder_event_key
         self.capture_event_key = capture_event_key
         self.long_press_event_key = long_press_event_key
+        self.selector_event_key = selector_event_key
+        self.pressed_at = None
+        self.position = None
+        self._encoder_lock = threading.Lock()
+        self._encoder_steps = 0             # Net steps since the main loop last took them, negative for REV
+        self._last_tick_at = None
+        self._last_tick_direction = None
         logger.info('Initializing GPIO inputs')
-        self.encoder = RotaryEncoder(constants.ENCODER_INPUT_A_ID, constants.ENCODER_INPUT_B_ID, bounce_time=0.1, wrap=True)
-        self.capture_button = Button(constants.CAPTURE_BUTTON_ID, bounce_time=0.1, hold_time=5)
-        self.selector_a = Button(constants.FOURPOS_A_ID)
-        self.selector_b = Button(constants.FOURPOS_B_ID)
-        self.selector_c = Button(constants.FOURPOS_C_ID)
-        self.selector_d = Button(constants.FOURPOS_D_ID)
+        self.encoder = RotaryEncoder(constants.ENCODER_INPUT_A_ID, constants.ENCODER_INPUT_B_ID, bounce_time=constants.ENCODER_BOUNCE_SECONDS, wrap=True, pin_factory=pin_factory)
+        self.capture_button = Button(constants.CAPTURE_BUTTON_ID, bounce_time=0.1, hold_time=5, pin_factory=pin_factory)
+        self.selector_a = Button(constants.FOURPOS_A_ID, pin_factory=pin_factory)
+        self.selector_b = Button(constants.FOURPOS_B_ID, pin_factory=pin_factory)
+        self.selector_c = Button(constants.FOURPOS_C_ID, pin_factory=pin_factory)
+        self.selector_d = Button(constants.FOURPOS_D_ID, pin_factory=pin_factory)
         logger.info('All GPIO inputs constructed')
 
         self.encoder.steps = 0
-        self.encoder.when_rotated_clockwise = partial(pygame_event_fn, encoder_event_key, dir=Direction.FWD)
-        self.encoder.when_rotated_counter_clockwise = partial(pygame_event_fn, encoder_event_key, dir=Direction.REV)
+        self.encoder.when_rotated_clockwise = partial(self.encoder_was_rotated, Direction.FWD)
+        self.encoder.when_rotated_counter_clockwise = partial(self.encoder_was_rotated, Direction.REV)
+        self.capture_button.when_pressed=self.button_went_down
         self.capture_button.when_held=self.button_was_held
         self.capture_button.when_released=self.button_was_released
+        selectors = {
+            SelectorPosition.ONE: self.selector_a,
+            SelectorPosition.TWO: self.selector_b,
+            SelectorPosition.THREE: self.selector_c,
+            SelectorPosition.FOUR: self.selector_d,
+        }
+        for position, selector in selectors.items():
+            # Read the starting position once - from here on it's kept up to
+            # date by the callbacks
+            if (self.position is None and selector.is_pressed):
+                self.position = position
+            selector.when_pressed = partial(self.selector_was_moved, position)
         logger.debug('GPIO input event callbacks initialized')
 if __name__ == "__main__":
     gpio = GPIOInput()
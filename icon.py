@@ -1,40 +1,139 @@
+import logging
+import os
 import random
 import pygame
 
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Where each named icon position sits on the screen, and how big it is there
+ICON_POSITIONS = {
+    "topleft": ((80, 80), (0, 0)),
+    "topcenter": ((80, 80), (280, 0)),
+    "topright": ((80, 80), (560, 0)),
+    "bottomleft": ((80, 80), (0, 400)),
+    "bottomright": ((80, 80), (560, 400)),
+    # Center the icon on the screen by placing upper left so it aligns to center
+    # (640 - 480) / 2 = 80
+    "center": ((480, 480), (80, 0)),
+}
+# Positions small enough to build for every icon up front
+SMALL_POSITIONS = ["topleft", "topcenter", "topright", "bottomleft", "bottomright"]
+
 def get_random_color():
-    r = random.randInt(150,255)
-    g = random.randInt(150,255)
-    b = random.randInt(150,255)
+    r = random.randint(150,255)
+    g = random.randint(150,255)
+    b = random.randint(150,255)
     return (r,g,b)
 
+def load_icon(filepath, rgb, size):
+    """
+    load_icon rasterises an SVG icon at the given size and tints it with the
+    given RGB colour. This is the slow path - it should only run while the
+    icon atlas is being built.
+    """
+    # Rasterise straight at the target size where pygame supports it, which is
+    # both sharper and cheaper than scaling a tiny bitmap up
+    if hasattr(pygame.image, 'load_sized_svg'):
+        icon = pygame.image.load_sized_svg(filepath, size)
+    else:
+        icon = pygame.image.load(filepath)
+    icon.fill(rgb, special_flags=pygame.BLEND_ADD)
+    if icon.get_size() != size:
+        icon = pygame.transform.smoothscale(icon, size)
+    return icon
+
 def get_icon(filepath, rgb=None,alpha=None, position=None):
     """
     get_icon takes a filepath, an optional RGB color tuple, and an optional alpha
     value from 0 to 255. It returns a pygame image of the file, set to the
     specified color and transparency, suitable for blitting to the screen.
+    This builds the icon from scratch every time - use an IconAtlas anywhere
+    that runs every frame.
     """
-    icon = pygame.image.load(filepath)
     if (rgb is None):
         rgb = get_random_color()
     if (alpha is None):
         alpha = 255
-    rgba = rgb + alpha
-    icon = icon.fill(rgba, special_flags=pygame.BLEND_ADD)
-    if (position == "topleft"):
-        icon = pygame.transform.scale(icon, (80, 80))
-        return [icon, (0,0)]
-    elif (position == "topright"):
-        icon = pygame.transform.scale(icon, (80, 80))
-        return [icon, (560, 0)]
-    elif (position == "bottomleft"):
-        icon = pygame.transform.scale(icon, (80, 80))
-        return [icon, (0, 400)]
-    elif (position == "bottomright"):
-        icon = pygame.transform.scale(icon, (80, 80))
-        return [icon, (560, 400)]
-    else: # (position == "center"):
-        icon = pygame.transform.scale(icon, (480,480))
-        # Center the icon on the screen by placing upper left so it aligns to center
-        # (640 - 480) / 2 = 80
-        return [icon, (80,0)]
+    if (position not in ICON_POSITIONS):
+        position = "center"
+    size, dest = ICON_POSITIONS[position]
+    icon = load_icon(filepath, rgb, size)
+    icon.set_alpha(alpha)
+    return [icon, dest]
+
+# Every icon the app can draw, already rasterised, tinted and scaled.
+# Rasterising an SVG is far too slow to do in the render loop, so the atlas
+# builds each colour/size variant once - at startup for the variants the app is
+# known to use, or on the first request for anything else - and from then on
+# the render path only looks up a surface to blit.
+# With a cache_dir, built variants are also saved as PNGs there, so later
+# startups load bitmaps instead of rasterising the SVGs again.
+class IconAtlas():
+    def __init__(self, icon_dir=constants.BASE_ICON_PATH, cache_dir=constants.ICON_CACHE_PATH):
+        logger.debug('Function IconAtlas __init__')
+        self.icon_dir = icon_dir
+        self.cache_dir = cache_dir
+        self._surfaces = {}
+        if (self.cache_dir is not None):
+            os.makedirs(self.cache_dir, exist_ok=True)
 
+    def build(self, variants):
+        """
+        build creates every given variant up front.
+        @param variants an iterable of (icon filename, rgb, position) tuples
+        """
+        logger.debug('Function build')
+        for name, rgb, position in variants:
+            self.get(name, rgb, position)
+        logger.info('Icon atlas holds %s surfaces', len(self._surfaces))
+
+    def get(self, name, rgb, position):
+        """
+        get returns the surface and screen position for an icon variant as a
+        [surface, (x, y)] pair, like get_icon does.
+        @param name the icon's filename, one of the ICON_* constants
+        @param rgb the RGB colour to tint the icon with
+        @param position one of the named ICON_POSITIONS
+        """
+        size, dest = ICON_POSITIONS[position]
+        key = (name, tuple(rgb), size)
+        surface = self._surfaces.get(key)
+        if surface is None:
+            surface = self._load(name, tuple(rgb), size)
+            self._surfaces[key] = surface
+        return [surface, dest]
+
+    def _load(self, name, rgb, size):
+        filepath = os.path.join(self.icon_dir, name)
+        cached = None
+        if (self.cache_dir is not None):
+            stem = os.path.splitext(name)[0]
+            cached = os.path.join(self.cache_dir, '%s-%d_%d_%d-%dx%d.png' % ((stem,) + rgb + size))
+            if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(filepath):
+                return self._finish(pygame.image.load(cached))
+        logger.info('Rasterising icon %s at %s in %s', name, size, rgb)
+        surface = load_icon(filepath, rgb, size)
+        if (cached is not None):
+            pygame.image.save(surface, cached)
+        return self._finish(surface)
+
+    def _finish(self, surface):
+        # Match the display's pixel format so blitting doesn't convert every time
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha()
+        return surface
+
+def default_variants():
+    """
+    default_variants lists the icon variants the app uses: every ICON_*
+    constant in the standard UI colour at each small position, plus the
+    battery icons in their level colours.
+    """
+    names = [getattr(constants, attr) for attr in dir(constants) if attr.startswith('ICON_') and attr != 'ICON_CACHE_PATH']
+    variants = [(name, constants.UI_COLOR, position) for name in sorted(names) for position in SMALL_POSITIONS]
+    variants.append((constants.ICON_BATTERY_CHARGING, constants.BATTERY_CHARGING_COLOR, "topcenter"))
+    for _, name, rgb in constants.BATTERY_LEVELS:
+        variants.append((name, rgb, "topcenter"))
+    return variants
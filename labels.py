@@ -0,0 +1,55 @@
+from collections import OrderedDict
+import logging
+
+import pygame
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Pre-rendered text surfaces for on-screen labels.
+# Rasterising text with a TrueType font is slow enough that it shouldn't
+# happen every frame for strings that hardly ever change. The cache renders
+# each (text, colour, size) combination once and hands back the same surface
+# from then on, so text is only rasterised when it actually changes.
+# The cache is bounded so that labels which change often - counters or
+# timestamps - can't grow it forever; the least recently used are dropped.
+class LabelCache():
+    def __init__(self, font_path, max_entries=constants.LABEL_CACHE_ENTRIES):
+        logger.debug('Function LabelCache __init__')
+        self.font_path = font_path
+        self.max_entries = max_entries
+        self._fonts = {}
+        self._surfaces = OrderedDict()
+
+    def get(self, text, color=constants.UI_COLOR, size=32, center=None):
+        """
+        get returns a rendered label and the rect to draw it at, as a
+        (surface, rect) pair. The rect is a new copy on every call, so callers
+        are free to move it.
+        @param text the string to show
+        @param color the RGB colour of the text
+        @param size the font size in points
+        @param center where to centre the label on screen, if anywhere
+        """
+        key = (text, tuple(color), size)
+        surface = self._surfaces.get(key)
+        if surface is None:
+            logger.debug('Rendering label %s', text)
+            surface = self._font(size).render(text, True, color)
+            self._surfaces[key] = surface
+            if len(self._surfaces) > self.max_entries:
+                self._surfaces.popitem(last=False)
+        else:
+            self._surfaces.move_to_end(key)
+        rect = surface.get_rect()
+        if center is not None:
+            rect.center = center
+        return surface, rect
+
+    def _font(self, size):
+        font = self._fonts.get(size)
+        if font is None:
+            font = pygame.font.Font(self.font_path, size)
+            self._fonts[size] = font
+        return font
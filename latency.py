@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import time
+
+from stats import RollingPercentiles
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Measures input-to-photon latency: how long it takes from a button, encoder or
+# key event being raised until the screen update that shows its result.
+# Events carry the time.monotonic() they were raised at. When the main loop
+# handles one, it's marked as started, along with the screen layers that show
+# its result; it then counts as shown at the end of the first later frame that
+# changes one of those layers. Events handled after a frame's render functions
+# ran can't be on screen in that frame, so they wait for the next one - and if
+# an event's result takes longer to appear, such as a gallery image still
+# decoding, it waits for the frame that finally changes its layer. An overlay
+# redraw, say, doesn't count as showing an encoder tick.
+# The layers are per kind of event, not per outcome, so this is only as exact
+# as they are: a photo taken in capture mode has no on-screen result of its
+# own, so it counts as shown with the next preview frame.
+# Events whose result never makes it to the screen are dropped after
+# LATENCY_PENDING_TIMEOUT seconds.
+class LatencyTracker():
+    def __init__(self, max_samples=constants.LATENCY_HISTORY, pending_timeout=constants.LATENCY_PENDING_TIMEOUT):
+        logger.debug('Function LatencyTracker __init__')
+        self.max_samples = max_samples
+        self.pending_timeout = pending_timeout
+        self.histograms = {}         # Event kind -> RollingPercentiles of latencies in seconds
+        self.timed_out = 0
+        self._pending = []           # (kind, raised_at, layers) handled since the current frame began
+        self._in_frame = []          # (kind, raised_at, layers) that the current frame's render can show
+
+    def started(self, kind, raised_at, layers=None):
+        """
+        started records that the main loop has handled an event.
+        @param kind the kind of event, such as 'capture' or 'encoder'
+        @param raised_at the time.monotonic() the event was raised at, or None
+            if it wasn't stamped - in which case it isn't measured
+        @param layers the names of the renderer layers that show the event's
+            result, or None if a change to any layer does
+        """
+        if raised_at is not None:
+            self._pending.append((kind, raised_at, layers))
+
+    def frame_started(self):
+        """
+        frame_started is called as each frame begins rendering, so that events
+        handled before it are known to be reflected in it.
+        """
+        self._in_frame.extend(self._pending)
+        self._pending = []
+
+    def presented(self, changed_layers):
+        """
+        presented is called once a frame has been presented.
+        @param changed_layers the names of the layers the frame changed
+        """
+        now = time.monotonic()
+        waiting = []
+        for kind, raised_at, layers in self._in_frame:
+            if changed_layers and (layers is None or not changed_layers.isdisjoint(layers)):
+                histogram = self.histograms.get(kind)
+                if histogram is None:
+                    histogram = self.histograms[kind] = RollingPercentiles(self.max_samples)
+                histogram.add(now - raised_at)
+            elif now - raised_at < self.pending_timeout:
+                waiting.append((kind, raised_at, layers))
+            else:
+                self.timed_out += 1
+        self._in_frame = waiting
+
+    def summary(self):
+        """
+        summary returns the latency percentiles in seconds for each kind of
+        event.
+        """
+        return {kind: histogram.summary() for kind, histogram in sorted(self.histograms.items())}
+
+    def overlay_lines(self):
+        """
+        overlay_lines returns one short line of text per kind of event, for
+        showing the percentiles on screen.
+        """
+        lines = []
+        for kind, summary in self.summary().items():
+            if "p50" not in summary:
+                continue
+            lines.append('{} p50 {:.0f} p95 {:.0f} p99 {:.0f} ms'.format(
+                kind, summary["p50"] * 1000, summary["p95"] * 1000, summary["p99"] * 1000))
+        return lines
+
+    def dump(self, path=constants.LATENCY_REPORT_PATH):
+        """
+        dump writes the latency percentiles to a JSON file.
+        @param path where to write the report
+        """
+        report = {"summary": self.summary(), "timed_out": self.timed_out}
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(temporary, path)
+        logger.info('Wrote latency report to %s', path)
@@ -0,0 +1,103 @@
+from collections import namedtuple
+import logging
+import threading
+import time
+
+from UPS_HAT.INA219 import INA219
+import constants
+
+logger = logging.getLogger(__name__)
+
+# The battery status as the rest of the app sees it. The first three fields
+# match psutil.sensors_battery, so either can be the app's battery source.
+PowerSnapshot = namedtuple('PowerSnapshot', ['percent', 'secsleft', 'power_plugged', 'voltage', 'current_ma', 'read_at'])
+# What the monitor reports until the sensor has been read: on battery, with
+# the charge unknown. Reporting no battery at all would pass for mains power.
+UNKNOWN_POWER = PowerSnapshot(percent=None, secsleft=None, power_plugged=False, voltage=None, current_ma=None, read_at=None)
+
+# Watches the UPS HAT's INA219 power sensor from a background thread.
+# Every POWER_SAMPLE_INTERVAL seconds the thread reads all of the sensor's
+# registers in one go, smooths the voltage and current, and turns them into a
+# charge percentage and whether the battery is charging. The result is
+# published as a new immutable PowerSnapshot, replacing the last one in a
+# single assignment, so read never takes a lock and never touches the I2C bus -
+# the UI thread can call it every frame.
+# The charge is estimated from the smoothed voltage between POWER_EMPTY_VOLTS
+# and POWER_FULL_VOLTS; the battery counts as charging while the smoothed
+# current into it is above POWER_CHARGING_MA.
+# Pass a fake smbus as bus to run without the HAT.
+class PowerMonitor():
+    def __init__(self, bus=None, i2c_bus=constants.POWER_I2C_BUS, addr=constants.POWER_I2C_ADDRESS,
+                 interval=constants.POWER_SAMPLE_INTERVAL, smoothing=constants.POWER_SMOOTHING):
+        logger.debug('Function PowerMonitor __init__')
+        self.sensor = INA219(i2c_bus=i2c_bus, addr=addr, bus=bus)
+        self.interval = interval
+        self.smoothing = smoothing
+        self.snapshot = UNKNOWN_POWER
+        self.read_errors = 0
+        self._voltage = None
+        self._current = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='power-monitor', daemon=True)
+
+    def start(self):
+        """
+        start takes a first reading, so there's a snapshot straight away, and
+        then keeps sampling in the background.
+        """
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def read(self):
+        """
+        read returns the latest PowerSnapshot, or UNKNOWN_POWER if the sensor
+        has never been read. It can be used as the app's battery source.
+        """
+        return self.snapshot
+
+    def sample(self):
+        """
+        sample reads the sensor once and publishes a new snapshot.
+        """
+        try:
+            voltage, _, current, _ = self.sensor.read_all()
+        except OSError:
+            # The HAT can drop off the bus briefly - keep the last snapshot
+            self.read_errors += 1
+            logger.warning('Failed to read the power sensor', exc_info=True)
+            return
+        if self._voltage is None:
+            self._voltage = voltage
+            self._current = current
+        else:
+            self._voltage += self.smoothing * (voltage - self._voltage)
+            self._current += self.smoothing * (current - self._current)
+        percent = (self._voltage - constants.POWER_EMPTY_VOLTS) / (constants.POWER_FULL_VOLTS - constants.POWER_EMPTY_VOLTS) * 100
+        self.snapshot = PowerSnapshot(
+            percent=max(0, min(100, percent)),
+            secsleft=None,
+            power_plugged=self._current > constants.POWER_CHARGING_MA,
+            voltage=self._voltage,
+            current_ma=self._current,
+            read_at=time.monotonic(),
+        )
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+def start_power_monitor():
+    """
+    start_power_monitor starts watching the UPS HAT, or returns None if it
+    can't be reached - on a device without one, for instance.
+    """
+    try:
+        monitor = PowerMonitor()
+        monitor.start()
+    except (ImportError, OSError):
+        logger.warning('No UPS HAT power sensor found', exc_info=True)
+        return None
+    return monitor
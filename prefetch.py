@@ -0,0 +1,140 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+from gallery_cache import load_entry_surface
+from kctypes import Direction
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Decodes gallery items near the current position on a pool of background
+# threads, so that by the time the encoder scrolls onto an item its surface is
+# already waiting in the gallery cache.
+# The prefetcher looks further ahead in the direction of scrolling the faster
+# the encoder is being spun, and keeps a smaller radius behind. Any queued work
+# that falls outside that window - for instance when the direction reverses -
+# is cancelled so the workers only ever decode what's about to be shown.
+class GalleryPrefetcher():
+    def __init__(self, album, cache, workers=constants.PREFETCH_WORKERS, radius=constants.PREFETCH_RADIUS, max_radius=constants.PREFETCH_MAX_RADIUS):
+        logger.debug('Function GalleryPrefetcher __init__')
+        self.album = album
+        self.cache = cache
+        self.radius = radius
+        self.max_radius = max_radius
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        self._pending = {}                       # filename -> Future for queued or running decodes
+        self._failed = set()                     # (filename, mtime) of files that couldn't be decoded
+        self._direction = Direction.FWD          # The direction of the most recent scroll
+        self._scroll_times = deque(maxlen=8)     # Monotonic timestamps of recent scroll ticks
+
+    def scrolled(self, direction, steps=1):
+        """
+        scrolled tells the prefetcher that the gallery just moved.
+        It updates the scroll speed estimate and reschedules decoding around
+        the new position.
+        @param direction a Direction enum, either Direction.FWD or Direction.REV
+        @param steps how many files the gallery moved by
+        """
+        logger.debug('Function scrolled')
+        now = time.monotonic()
+        if direction != self._direction:
+            logger.debug('Scroll direction reversed - resetting speed estimate')
+            self._scroll_times.clear()
+        self._direction = direction
+        # Several steps at once count as that many ticks at the same moment
+        self._scroll_times.extend([now] * steps)
+        self.schedule()
+
+    def lookahead(self):
+        """
+        lookahead returns how many items ahead of the current position to
+        decode, based on how fast the gallery has been scrolling recently.
+        """
+        if len(self._scroll_times) < 2:
+            return self.radius
+        elapsed = self._scroll_times[-1] - self._scroll_times[0]
+        if elapsed <= 0:
+            return self.max_radius
+        # Stop counting a burst of scrolling once the encoder has gone quiet
+        if time.monotonic() - self._scroll_times[-1] > constants.PREFETCH_LOOKAHEAD_SECONDS:
+            return self.radius
+        ticks_per_second = (len(self._scroll_times) - 1) / elapsed
+        ahead = self.radius + int(ticks_per_second * constants.PREFETCH_LOOKAHEAD_SECONDS)
+        return min(ahead, self.max_radius)
+
+    def schedule(self):
+        """
+        schedule queues decodes for every uncached item in the window around
+        the current position, nearest first, and cancels queued decodes for
+        items that have fallen out of the window.
+        """
+        step = 1 if self._direction == Direction.FWD else -1
+        offsets = [0]
+        for distance in range(1, self.lookahead() + 1):
+            offsets.append(step * distance)
+            if distance <= self.radius:
+                offsets.append(-step * distance)
+        wanted = []
+        for offset in offsets:
+            entry = self.album.peek(offset)
+            if entry is not None and entry not in wanted:
+                wanted.append(entry)
+        wanted_filenames = set(entry["filename"] for entry in wanted)
+        with self._lock:
+            for filename, future in list(self._pending.items()):
+                if future.done():
+                    del self._pending[filename]
+                elif filename not in wanted_filenames and future.cancel():
+                    logger.debug('Cancelled stale prefetch of %s', filename)
+                    del self._pending[filename]
+            for entry in wanted:
+                self._submit(entry)
+
+    def request(self, entry):
+        """
+        request makes sure the given entry is being decoded, for when the
+        render loop needs an item that isn't in the cache yet. It never waits
+        for the decode to finish.
+        @param entry an album index entry, as returned by Album.load_image
+        @return False if this version of the file has already failed to
+            decode, so there's nothing to wait for; True otherwise
+        """
+        with self._lock:
+            return self._submit(entry)
+
+    def close(self):
+        """
+        close cancels any queued decodes and stops the worker threads.
+        """
+        logger.debug('Function close')
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, entry):
+        # Callers must hold the lock. Returns False for a file known not to decode
+        filename = entry["filename"]
+        if filename in self._pending and not self._pending[filename].done():
+            return True
+        if (filename, entry["mtime"]) in self._failed:
+            return False
+        if self.cache.contains(filename, entry["mtime"]):
+            return True
+        self._pending[filename] = self._executor.submit(self._decode, entry)
+        return True
+
+    def _decode(self, entry):
+        filename = entry["filename"]
+        if self.cache.contains(filename, entry["mtime"]):
+            return
+        try:
+            surface = load_entry_surface(entry)
+        except Exception:
+            logger.exception('Failed to prefetch %s', filename)
+            with self._lock:
+                self._failed.add((filename, entry["mtime"]))
+            return
+        self.cache.put(filename, entry["mtime"], surface)
+        logger.debug('Prefetched %s', filename)
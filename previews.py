@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import pathlib
+import sys
+import threading
+
+import cv2
+import psutil
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Display-sized preview copies of album photos and videos.
+# The gallery only ever shows photos at screen size, so decoding a full sensor
+# resolution JPEG just to shrink it again is wasted work. Each photo gets a
+# small JPEG in a hidden directory next to it, written when the photo is taken
+# (or by the backfill command below for photos taken before this existed), and
+# the gallery loads that instead of the original.
+# A video's preview is its first frame - a poster the gallery can show without
+# opening a decoder - and its frame rate, frame count and duration are kept
+# alongside in the album's video info file.
+# Running this module directly backfills previews for every album:
+#   python previews.py [base_pic_path]
+
+def preview_filename(filename):
+    """
+    preview_filename returns where the preview for a given album file lives.
+    The original's extension is kept in the name, so that a photo and a video
+    taken at the same moment get previews of their own.
+    @param filename the path of the original file
+    """
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, constants.PREVIEW_DIR, name + '.jpg')
+
+def has_current_preview(filename):
+    """
+    has_current_preview checks whether the file has a preview that is at
+    least as new as the file itself.
+    @param filename the path of the original file
+    """
+    try:
+        return os.path.getmtime(preview_filename(filename)) >= os.path.getmtime(filename)
+    except FileNotFoundError:
+        return False
+
+def write_preview(filename, image=None, size=constants.DISPLAY_SIZE):
+    """
+    write_preview scales an image down to the display size and saves it as
+    the file's preview. The preview is written to a temporary name and then
+    renamed into place, so an interrupted write never leaves a broken preview.
+    @param filename the path of the original image file
+    @param image the already-decoded image as a BGR array, if the caller has
+        it in memory - otherwise the file is decoded at reduced size
+    @param size the (width, height) of the preview
+    """
+    logger.debug('Function write_preview')
+    if image is None:
+        # Let libjpeg do most of the shrinking during decode, which is far
+        # cheaper than decoding at full size and scaling afterwards
+        image = cv2.imread(filename, cv2.IMREAD_REDUCED_COLOR_4)
+        if image is None:
+            raise ValueError('Could not decode image ' + filename)
+    preview = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    target = preview_filename(filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temporary = target + '.tmp.jpg'
+    if not cv2.imwrite(temporary, preview, [cv2.IMWRITE_JPEG_QUALITY, constants.PREVIEW_JPEG_QUALITY]):
+        raise OSError('Could not write preview ' + temporary)
+    os.replace(temporary, target)
+    logger.info('Wrote preview %s', target)
+    return target
+
+def write_video_preview(filename):
+    """
+    write_video_preview opens a video once to save its first frame as the
+    video's preview, and records its frame rate, frame count and duration in
+    the album's video info file.
+    @param filename the path of the video file
+    """
+    logger.debug('Function write_video_preview')
+    video = cv2.VideoCapture(filename)
+    try:
+        success, frame = video.read()
+        fps = video.get(cv2.CAP_PROP_FPS)
+        frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        video.release()
+    if not success:
+        raise ValueError('Could not read a frame from ' + filename)
+    info = {
+        "fps": fps if fps > 0 else None,
+        # Raw H.264 streams have no index, so their length isn't known
+        "frame_count": frame_count if frame_count > 0 else None,
+        "duration": frame_count / fps if fps > 0 and frame_count > 0 else None,
+    }
+    target = write_preview(filename, image=frame)
+    video_info.put(filename, info)
+    return target
+
+def write_any_preview(filename):
+    """
+    write_any_preview writes the right kind of preview for an album file.
+    @param filename the path of the photo or video
+    """
+    if is_video(filename):
+        return write_video_preview(filename)
+    return write_preview(filename)
+
+def is_video(filename):
+    """
+    is_video checks whether an album file is a video, by its extension.
+    """
+    return pathlib.Path(filename).suffix in constants.VIDEO_EXTENSIONS
+
+def is_previewable(filename):
+    """
+    is_previewable checks whether a file in an album should have a preview.
+    Hidden files are skipped.
+    @param filename the path of the file
+    """
+    return not os.path.basename(filename).startswith('.')
+
+# Frame rate, frame count and duration for the videos in each album, saved as
+# a JSON file in the album's preview directory so it survives restarts.
+# Entries are keyed by file name and only returned while the video's mtime
+# still matches the one recorded with them.
+# The prefetch workers write to this while the UI reads it, so it is locked.
+class VideoInfoCache():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._albums = {}
+
+    def get(self, filename, mtime=None):
+        """
+        get returns the recorded info for a video as a dict, or None if there
+        is none or the video has changed since it was recorded.
+        @param filename the path of the video file
+        @param mtime the video's modification time, if the caller already
+            knows it - otherwise the file is checked
+        """
+        directory, name = os.path.split(filename)
+        with self._lock:
+            info = self._load(directory).get(name)
+        if info is None:
+            return None
+        try:
+            if mtime is None:
+                mtime = os.path.getmtime(filename)
+        except FileNotFoundError:
+            return None
+        if info["mtime"] != mtime:
+            return None
+        return info
+
+    def put(self, filename, info):
+        """
+        put records info for a video and saves the album's info file.
+        @param filename the path of the video file
+        @param info a dict of the video's fps, frame_count and duration
+        """
+        directory, name = os.path.split(filename)
+        info = dict(info, mtime=os.path.getmtime(filename))
+        with self._lock:
+            album = self._load(directory)
+            album[name] = info
+            target = os.path.join(directory, constants.PREVIEW_DIR, constants.VIDEO_INFO_FILE)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            temporary = target + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(album, f)
+            os.replace(temporary, target)
+
+    def _load(self, directory):
+        # Callers must hold the lock
+        album = self._albums.get(directory)
+        if album is None:
+            try:
+                with open(os.path.join(directory, constants.PREVIEW_DIR, constants.VIDEO_INFO_FILE)) as f:
+                    album = json.load(f)
+            except (FileNotFoundError, ValueError):
+                album = {}
+            self._albums[directory] = album
+        return album
+
+# The shared video info cache
+video_info = VideoInfoCache()
+
+def backfill(base_dir=constants.BASE_PIC_PATH):
+    """
+    backfill writes previews for every file in every album under base_dir
+    that doesn't already have a current one. Since existing previews are
+    skipped, it can be stopped at any point and simply run again to resume.
+    It drops its own CPU and disk priority so it can run alongside the app.
+    @param base_dir the directory holding one folder per album
+    """
+    logger.debug('Function backfill')
+    os.nice(19)
+    try:
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (AttributeError, psutil.Error):
+        logger.info('Could not lower disk priority - continuing at normal priority')
+    written = 0
+    for album in sorted(os.listdir(base_dir)):
+        album_path = os.path.join(base_dir, album)
+        if album.startswith('.') or not os.path.isdir(album_path):
+            continue
+        logger.info('Backfilling previews for album %s', album)
+        for name in sorted(os.listdir(album_path)):
+            filename = os.path.join(album_path, name)
+            if not is_previewable(filename) or not os.path.isfile(filename):
+                continue
+            if has_current_preview(filename):
+                continue
+            try:
+                write_any_preview(filename)
+                written += 1
+            except (ValueError, OSError):
+                logger.exception('Failed to write preview for %s', filename)
+    logger.info('Backfill complete - wrote %s previews', written)
+    return written
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    backfill(sys.argv[1] if len(sys.argv) > 1 else constants.BASE_PIC_PATH)
@@ -0,0 +1,95 @@
+from collections import deque
+import json
+import logging
+import os
+import time
+
+from stats import RollingPercentiles
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Times each phase of every frame of the main loop.
+# The loop calls begin_frame as a frame starts, lap after each phase with the
+# phase's name, and end_frame at the end. A lap is one clock read and a list
+# append, and the percentiles are only sorted when somebody asks for them, so
+# the profiler is cheap enough to leave running all the time.
+# Rolling percentiles are kept for each phase and for the busy part of the
+# frame (everything but waiting for the next one), and the phases of the last
+# history frames are kept for writing out as a Chrome trace, which can be
+# opened in chrome://tracing or Perfetto.
+class FrameProfiler():
+    def __init__(self, history=constants.PROFILER_HISTORY):
+        logger.debug('Function FrameProfiler __init__')
+        self.history = history
+        self.phases = {}             # Phase name -> RollingPercentiles of durations in seconds
+        self._frames = deque(maxlen=history)
+        self._laps = []              # (name, start, duration) for the frame in progress
+        self._frame_start = None
+        self._last = None
+
+    def begin_frame(self):
+        self._frame_start = self._last = time.perf_counter()
+        self._laps = []
+
+    def lap(self, name):
+        """
+        lap ends the current phase of the frame.
+        @param name the name of the phase that just finished
+        """
+        now = time.perf_counter()
+        self._laps.append((name, self._last, now - self._last))
+        self._last = now
+
+    def end_frame(self):
+        busy = 0.0
+        for name, _, duration in self._laps:
+            self._histogram(name).add(duration)
+            if name != 'wait':
+                busy += duration
+        self._histogram('busy').add(busy)
+        self._frames.append(self._laps)
+
+    def summary(self):
+        """
+        summary returns the percentiles in seconds of each phase.
+        """
+        return {name: histogram.summary() for name, histogram in self.phases.items()}
+
+    def overlay_lines(self):
+        """
+        overlay_lines returns one short line of text per phase, for showing
+        the percentiles on screen.
+        """
+        lines = []
+        for name, summary in self.summary().items():
+            if "p50" not in summary:
+                continue
+            lines.append('{} {:.1f}/{:.1f}/{:.1f} ms'.format(
+                name, summary["p50"] * 1000, summary["p95"] * 1000, summary["p99"] * 1000))
+        return lines
+
+    def dump_trace(self, path=constants.PROFILER_TRACE_PATH):
+        """
+        dump_trace writes the phases of the last frames as a Chrome trace
+        JSON file.
+        @param path where to write the trace
+        """
+        events = []
+        for laps in self._frames:
+            for name, start, duration in laps:
+                events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(), "tid": 0,
+                    "ts": start * 1000000, "dur": duration * 1000000,
+                })
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.replace(temporary, path)
+        logger.info('Wrote trace of %s frames to %s', len(self._frames), path)
+
+    def _histogram(self, name):
+        histogram = self.phases.get(name)
+        if histogram is None:
+            histogram = self.phases[name] = RollingPercentiles(self.history)
+        return histogram
@@ -0,0 +1,210 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+
+import psutil
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Low resolution playback proxies for recorded videos.
+# Clips are recorded at full bitrate and resolution, and decoding one just to
+# show it at display size takes most of a core. Each clip gets a display-sized,
+# low bitrate copy in a hidden directory next to it, and the gallery plays that
+# instead when it exists.
+# Proxies are made by a background job that runs ffmpeg at the lowest CPU and
+# disk priority, and only while the app says it's a good time - when the
+# device is idle or charging. The app can also pause the job the moment a
+# capture starts; a paused ffmpeg is stopped with SIGSTOP and picks up where it
+# left off with SIGCONT.
+# Each proxy is written to a temporary name and renamed into place once it's
+# complete, so a shutdown mid-transcode only loses that one clip's progress,
+# and the job carries on with it the next time the app starts.
+
+def proxy_filename(filename):
+    """
+    proxy_filename returns where the playback proxy for a video lives. The
+    original's extension is kept in the name, so that videos of different
+    formats taken at the same moment get proxies of their own.
+    @param filename the path of the original video
+    """
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, constants.PROXY_DIR, name + '.mp4')
+
+def has_current_proxy(filename):
+    """
+    has_current_proxy checks whether the video has a proxy that is at least as
+    new as the video itself.
+    @param filename the path of the original video
+    """
+    try:
+        return os.path.getmtime(proxy_filename(filename)) >= os.path.getmtime(filename)
+    except FileNotFoundError:
+        return False
+
+def playback_filename(filename):
+    """
+    playback_filename returns the file the gallery should decode to play a
+    video: its proxy if there's a current one, otherwise the video itself.
+    @param filename the path of the original video
+    """
+    if has_current_proxy(filename):
+        return proxy_filename(filename)
+    return filename
+
+# Works through the active album's videos in the background, making a proxy for
+# each one that doesn't have a current one.
+# should_run is called every PROXY_POLL_INTERVAL seconds, and the job only
+# starts or carries on a transcode while it returns True.
+# The lock only guards the running process, so pause never waits on the job
+# looking for its next video or starting ffmpeg. Videos known to have a
+# current proxy aren't checked on disk again.
+class ProxyTranscoder():
+    def __init__(self, album, should_run, poll_interval=constants.PROXY_POLL_INTERVAL):
+        logger.debug('Function ProxyTranscoder __init__')
+        self.album = album
+        self.should_run = should_run
+        self.poll_interval = poll_interval
+        self.written = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._process = None         # The running ffmpeg, if any
+        self._job = None             # The (filename, mtime, temporary, target) it's working on
+        self._paused = False
+        self._pause_requested = False  # Whether pause was called since should_run last allowed the job
+        self._failed = set()         # (filename, mtime) of videos that couldn't be transcoded
+        self._done = set()           # (filename, mtime) of videos known to have a current proxy
+        self._thread = threading.Thread(target=self._run, name='proxy-transcoder', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def pause(self):
+        """
+        pause suspends any transcode in progress straight away. The job
+        resumes by itself once should_run returns True again.
+        """
+        with self._lock:
+            self._pause_requested = True
+            self._set_paused(True)
+
+    def stop(self):
+        """
+        stop ends the job, abandoning any transcode in progress. Its clip is
+        transcoded from the start the next time the job runs.
+        """
+        logger.debug('Function stop')
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop_event.wait(self.poll_interval):
+                allowed = self.should_run()
+                try:
+                    with self._lock:
+                        if allowed:
+                            self._pause_requested = False
+                        if self._process is not None:
+                            self._set_paused(not allowed)
+                            if self._process.poll() is not None:
+                                self._finish()
+                            continue
+                    if allowed:
+                        self._start_next()
+                except OSError:
+                    logger.exception('Proxy transcode failed')
+        finally:
+            with self._lock:
+                if self._process is not None:
+                    self._abandon()
+
+    def _next_video(self):
+        for entry in self.album.entries():
+            if entry["extension"] not in constants.VIDEO_EXTENSIONS:
+                continue
+            key = (entry["filename"], entry["mtime"])
+            if key in self._failed or key in self._done:
+                continue
+            if has_current_proxy(entry["filename"]):
+                self._done.add(key)
+                continue
+            return key
+        return None
+
+    def _start_next(self):
+        # Runs without the lock, which is only taken to hand over the process
+        video = self._next_video()
+        if video is None:
+            return
+        filename, mtime = video
+        target = proxy_filename(filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = os.path.join(os.path.dirname(target), '.' + os.path.basename(target) + '.tmp.mp4')
+        width, height = constants.DISPLAY_SIZE
+        logger.info('Transcoding proxy for %s', filename)
+        process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-y', '-i', filename,
+             '-vf', 'scale={}:{}'.format(width, height), '-an',
+             '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', constants.PROXY_BITRATE,
+             '-movflags', '+faststart', temporary],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            preexec_fn=lambda: os.nice(19))
+        try:
+            psutil.Process(process.pid).ionice(psutil.IOPRIO_CLASS_IDLE)
+        except (AttributeError, psutil.Error):
+            logger.info('Could not lower disk priority of the proxy transcode')
+        with self._lock:
+            self._process = process
+            self._job = (filename, mtime, temporary, target)
+            self._paused = False
+            # A capture may have started while ffmpeg was starting
+            if self._pause_requested:
+                self._set_paused(True)
+
+    def _finish(self):
+        # Callers must hold the lock
+        filename, mtime, temporary, target = self._job
+        returncode = self._process.returncode
+        self._process = None
+        self._job = None
+        if returncode != 0:
+            logger.error('Proxy transcode of %s exited with %s', filename, returncode)
+            try:
+                self._failed.add((filename, os.path.getmtime(filename)))
+                os.remove(temporary)
+            except FileNotFoundError:
+                pass
+            return
+        os.replace(temporary, target)
+        self._done.add((filename, mtime))
+        self.written += 1
+        logger.info('Wrote proxy %s', target)
+
+    def _abandon(self):
+        # Callers must hold the lock
+        _, _, temporary, _ = self._job
+        self._set_paused(False)
+        self._process.kill()
+        self._process.wait()
+        self._process = None
+        self._job = None
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+
+    def _set_paused(self, paused):
+        # Callers must hold the lock
+        if self._process is None or paused == self._paused:
+            return
+        try:
+            self._process.send_signal(signal.SIGSTOP if paused else signal.SIGCONT)
+        except ProcessLookupError:
+            # It finished in the meantime
+            return
+        self._paused = paused
+        logger.info('%s proxy transcode', 'Paused' if paused else 'Resumed')
@@ -0,0 +1,256 @@
+from collections import deque
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from picamera2.encoders import H264Encoder
+from picamera2.outputs import CircularOutput
+
+from previews import write_video_preview
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Records videos that start the moment the button goes down, and a little
+# before it.
+# While a camera is in video mode its H.264 encoder runs the whole time into a
+# circular buffer holding the last RECORDING_PREROLL_SECONDS of frames. That
+# only costs the hardware encoder, not the CPU. The ffmpeg process that muxes
+# a clip into an MP4 is also started ahead of time, writing to a scratch file
+# and waiting on its stdin.
+# A press then just points the buffer at the waiting muxer: the buffered
+# frames are written first, followed by the live stream, so nothing has to
+# start up at the press and every clip includes what happened just before it.
+# When recording stops, the clip is finished and moved into the album on a
+# background thread, and the next muxer is started ready for the next press.
+# Clips are written as fragmented MP4: the header goes at the very start and
+# a self-contained fragment is flushed at every keyframe, so players can open
+# a clip without parsing all of it, and a clip cut short by a crash or a flat
+# battery is still playable up to its last fragment. Each clip's destination
+# is noted next to its scratch file when recording starts, so recover can
+# move interrupted clips into their albums the next time the app starts.
+# The time from the button going down to the stream being handed to the muxer
+# is recorded for each clip.
+class Recorder():
+    def __init__(self, on_saved=None, fps=constants.RECORDING_FPS, bitrate=constants.RECORDING_BITRATE,
+                 preroll_seconds=constants.RECORDING_PREROLL_SECONDS,
+                 scratch_dir=os.path.join(constants.BASE_PIC_PATH, constants.RECORDING_SCRATCH_DIR)):
+        logger.debug('Function Recorder __init__')
+        self.on_saved = on_saved
+        self.fps = fps
+        self.bitrate = bitrate
+        self.preroll_frames = int(preroll_seconds * fps)
+        self.scratch_dir = scratch_dir
+        self.start_latencies = deque(maxlen=constants.RECORDING_LATENCY_HISTORY)
+        self._lock = threading.Lock()
+        self._camera = None          # The Picamera2 the encoder is running on
+        self._output = None          # The encoder's circular buffer
+        self._muxer = None           # A (process, scratch filename) waiting for the next clip
+        self._recording = None       # The (process, scratch filename, filename) being recorded
+        self._finishing = []         # Threads finishing off stopped clips
+        os.makedirs(self.scratch_dir, exist_ok=True)
+
+    @property
+    def is_recording(self):
+        with self._lock:
+            return self._recording is not None
+
+    def attach(self, cam):
+        """
+        attach starts the encoder running into the pre-roll buffer on a camera
+        that has just started streaming in video mode.
+        @param cam the Picamera2 object to encode from
+        """
+        logger.debug('Function attach')
+        # A keyframe every second, and room for one more second than the
+        # pre-roll, so the buffer always holds a full pre-roll from a keyframe.
+        # The stream headers are repeated at every keyframe, since a clip cut
+        # from the buffer doesn't start at the beginning of the stream
+        encoder = H264Encoder(self.bitrate, repeat=True, iperiod=self.fps)
+        output = CircularOutput(buffersize=self.preroll_frames + self.fps)
+        cam.start_encoder(encoder, output)
+        with self._lock:
+            self._camera = cam
+            self._output = output
+            if self._muxer is None:
+                self._muxer = self._spawn_muxer()
+
+    def detach(self):
+        """
+        detach stops any recording in progress and the encoder, before the
+        camera stops or leaves video mode.
+        """
+        logger.debug('Function detach')
+        self.stop()
+        with self._lock:
+            cam = self._camera
+            self._camera = None
+            self._output = None
+        if cam is not None:
+            cam.stop_encoder()
+
+    def start(self, filename, pressed_at=None):
+        """
+        start records a clip into the given file, beginning with the buffered
+        pre-roll. It returns False if the encoder isn't running or a clip is
+        already being recorded.
+        @param filename the path the finished MP4 should be saved to
+        @param pressed_at the time.monotonic() when the button went down, if
+            known - used to measure how long the recording took to start
+        """
+        logger.debug('Function start')
+        with self._lock:
+            if self._output is None or self._recording is not None:
+                return False
+            muxer = self._muxer
+            if muxer is None:
+                logger.warning('No muxer was ready - starting one now')
+                muxer = self._spawn_muxer()
+            self._muxer = None
+            process, scratch = muxer
+            self._output.fileoutput = process.stdin
+            self._output.start()
+            self._recording = (process, scratch, filename)
+        # Note where the clip belongs, in case it never gets to finish
+        with open(scratch + '.target', 'w') as f:
+            f.write(filename)
+        if pressed_at is not None:
+            self.start_latencies.append(time.monotonic() - pressed_at)
+            logger.info('Recording to %s started %.3fs after the press', filename, self.start_latencies[-1])
+        return True
+
+    def stop(self):
+        """
+        stop ends the clip being recorded. The muxer is finished off and the
+        file moved into place in the background; on_saved is called with its
+        filename once it's there.
+        @return the filename of the clip that was stopped, or None
+        """
+        logger.debug('Function stop')
+        with self._lock:
+            if self._recording is None:
+                return None
+            self._output.stop()
+            recording = self._recording
+            self._recording = None
+            thread = threading.Thread(target=self._finish, args=recording, name='recorder-finish')
+            self._finishing = [t for t in self._finishing if t.is_alive()] + [thread]
+        thread.start()
+        return recording[2]
+
+    def recover(self):
+        """
+        recover deals with the scratch files left behind by a previous run
+        that ended while recording. Clips that were being recorded are moved
+        into their albums as they are, since every fragment written before
+        the interruption still plays; muxers that never got a clip are
+        deleted. Call it before the first recording starts.
+        @return the filenames of the recovered clips
+        """
+        logger.debug('Function recover')
+        recovered = []
+        for name in sorted(os.listdir(self.scratch_dir)):
+            if not name.endswith('.mp4'):
+                continue
+            scratch = os.path.join(self.scratch_dir, name)
+            journal = scratch + '.target'
+            try:
+                with open(journal) as f:
+                    filename = f.read().strip()
+            except FileNotFoundError:
+                filename = None
+            if filename and os.path.getsize(scratch) > 0:
+                logger.warning('Recovering interrupted recording %s', filename)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                os.replace(scratch, filename)
+                recovered.append(filename)
+            else:
+                os.remove(scratch)
+            if filename is not None:
+                os.remove(journal)
+        for filename in recovered:
+            try:
+                write_video_preview(filename)
+            except (ValueError, OSError):
+                logger.exception('Recovered recording %s has no playable frames', filename)
+            if self.on_saved is not None:
+                self.on_saved(filename)
+        return recovered
+
+    def stats(self):
+        """
+        stats returns the number of clips recorded and the mean, worst and most
+        recent start latency in seconds.
+        """
+        latencies = list(self.start_latencies)
+        if not latencies:
+            return {"clips": 0}
+        return {
+            "clips": len(latencies),
+            "mean": sum(latencies) / len(latencies),
+            "max": max(latencies),
+            "last": latencies[-1],
+        }
+
+    def close(self):
+        """
+        close stops recording and the encoder, waits for every stopped clip to
+        be saved, and shuts down the waiting muxer.
+        """
+        logger.debug('Function close')
+        self.detach()
+        for thread in self._finishing:
+            thread.join()
+        with self._lock:
+            muxer = self._muxer
+            self._muxer = None
+        if muxer is not None:
+            process, scratch = muxer
+            process.kill()
+            process.wait()
+            try:
+                os.remove(scratch)
+            except FileNotFoundError:
+                pass
+
+    def _spawn_muxer(self):
+        # Callers must hold the lock
+        fd, scratch = tempfile.mkstemp(suffix='.mp4', dir=self.scratch_dir)
+        os.close(fd)
+        process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-y',
+             '-f', 'h264', '-framerate', str(self.fps), '-i', 'pipe:0',
+             '-c', 'copy', '-f', 'mp4', '-movflags', constants.RECORDING_MOVFLAGS,
+             '-flush_packets', '1', scratch],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        logger.info('Started muxer for %s', scratch)
+        return (process, scratch)
+
+    def _finish(self, process, scratch, filename):
+        # Get the next muxer going while this one finishes
+        with self._lock:
+            if self._muxer is None:
+                self._muxer = self._spawn_muxer()
+        try:
+            process.stdin.close()
+        except (OSError, ValueError):
+            # Already closed along with the buffer's output
+            pass
+        returncode = process.wait()
+        if returncode != 0:
+            # Whatever was written is still playable, so recover will pick it
+            # up on the next start
+            logger.error('Muxer for %s exited with %s - leaving %s in place', filename, returncode, scratch)
+            return
+        os.replace(scratch, filename)
+        os.remove(scratch + '.target')
+        logger.info('Saved recording %s', filename)
+        try:
+            write_video_preview(filename)
+        except (ValueError, OSError):
+            logger.exception('Failed to write preview for %s', filename)
+        if self.on_saved is not None:
+            self.on_saved(filename)
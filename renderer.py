@@ -0,0 +1,129 @@
+import logging
+
+import pygame
+
+logger = logging.getLogger(__name__)
+
+# The layers the app draws, from the bottom of the screen to the top
+LAYER_ORDER = ['background', 'camera_label', 'capture_label', 'recording', 'battery', 'latency', 'profiler']
+# The colour shown wherever no layer covers the screen
+BACKGROUND_COLOR = (92,106,114)
+
+# One surface placed on the screen by the renderer
+class Layer():
+    def __init__(self, surface, dest, key):
+        self.surface = surface
+        if isinstance(dest, pygame.Rect):
+            dest = dest.topleft
+        self.rect = pygame.Rect(dest, surface.get_size())
+        self.key = key
+
+# A retained-mode renderer for the app's screen.
+# Rather than clearing and redrawing the whole canvas every frame, the render
+# functions tell the renderer what each layer should currently show. The
+# renderer compares that against what's already on screen, redraws only the
+# areas whose layers changed, and pushes just those rectangles to the display.
+# When nothing changed at all - a still photo in the gallery, for instance -
+# no drawing or display update happens for the frame.
+# Each frame starts with begin_frame; any layer that isn't set again before
+# present is taken off the screen. After present, changed_layers holds the
+# names of the layers that frame changed.
+class Renderer():
+    def __init__(self, canvas, layer_order=LAYER_ORDER, background_color=BACKGROUND_COLOR):
+        logger.debug('Function Renderer __init__')
+        self.canvas = canvas
+        self.layer_order = layer_order
+        self.background_color = background_color
+        self.frames_presented = 0
+        self.frames_skipped = 0
+        self.changed_layers = set()  # The layers the last frame presented changed
+        self._changed = set()
+        self._layers = {}
+        self._seen = set()
+        self._dirty = [canvas.get_rect()]
+
+    def begin_frame(self):
+        """
+        begin_frame starts collecting the layers for a new frame.
+        """
+        self._seen = set()
+
+    def is_current(self, name, key):
+        """
+        is_current checks whether a layer is already showing the content
+        identified by key. Render functions use it to skip building a surface
+        that wouldn't change anything. A current layer counts as set for this
+        frame.
+        @param name the layer name
+        @param key the identifier of the content the layer should show
+        """
+        layer = self._layers.get(name)
+        if layer is not None and layer.key == key:
+            self._seen.add(name)
+            return True
+        return False
+
+    def set_layer(self, name, surface, dest=(0,0), key=None):
+        """
+        set_layer places a surface on the named layer. The layer is only
+        marked dirty if its content or position actually changed.
+        @param name the layer name, from the renderer's layer order
+        @param surface the pygame surface to show
+        @param dest the top left position, or a Rect, to place the surface at
+        @param key an identifier for the surface's content - if omitted, the
+            surface object itself is used, so a new surface is always redrawn
+        """
+        if key is None:
+            key = id(surface)
+        self._seen.add(name)
+        layer = Layer(surface, dest, key)
+        old_layer = self._layers.get(name)
+        if old_layer is not None:
+            if old_layer.key == key and old_layer.rect == layer.rect:
+                return
+            self._dirty.append(old_layer.rect)
+        self._layers[name] = layer
+        self._dirty.append(layer.rect)
+        self._changed.add(name)
+
+    def invalidate(self):
+        """
+        invalidate marks the whole screen as dirty, for when its contents have
+        been lost - for example after the window was covered.
+        """
+        self._dirty.append(self.canvas.get_rect())
+
+    def present(self):
+        """
+        present removes the layers that weren't set this frame, redraws every
+        dirty area of the canvas and updates just those areas of the display.
+        If nothing is dirty, nothing is drawn or presented, and False is
+        returned.
+        """
+        for name in list(self._layers):
+            if name not in self._seen:
+                self._dirty.append(self._layers.pop(name).rect)
+                self._changed.add(name)
+        self.changed_layers = self._changed
+        self._changed = set()
+        if not self._dirty:
+            self.frames_skipped += 1
+            return False
+        screen_rect = self.canvas.get_rect()
+        dirty_rects = [rect.clip(screen_rect) for rect in self._dirty]
+        dirty_rects = [rect for rect in dirty_rects if rect.width and rect.height]
+        # No point redrawing pieces of the screen if all of it is changing
+        if screen_rect in dirty_rects:
+            dirty_rects = [screen_rect]
+        for rect in dirty_rects:
+            self.canvas.set_clip(rect)
+            self.canvas.fill(self.background_color, rect)
+            for name in self.layer_order:
+                layer = self._layers.get(name)
+                if layer is not None and layer.rect.colliderect(rect):
+                    self.canvas.blit(layer.surface, layer.rect)
+        self.canvas.set_clip(None)
+        pygame.display.update(dirty_rects)
+        self._dirty = []
+        self.frames_presented += 1
+        return True
@@ -0,0 +1,46 @@
+from collections import deque
+import math
+
+# Percentiles over the most recent samples of a measurement.
+# Only the last max_samples values are kept, so the numbers reflect how the
+# app is behaving now rather than since it started, and memory stays bounded.
+class RollingPercentiles():
+    def __init__(self, max_samples):
+        self._samples = deque(maxlen=max_samples)
+        self.count = 0               # Every sample ever added, not just the ones kept
+
+    def add(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def percentile(self, p):
+        """
+        percentile returns the nearest-rank percentile of the kept samples,
+        or None if there are none.
+        @param p the percentile, from 0 to 100
+        """
+        if not self._samples:
+            return None
+        return nearest_rank(sorted(self._samples), p)
+
+    def summary(self):
+        """
+        summary returns the sample count with the p50, p95, p99 and worst of
+        the kept samples.
+        """
+        if not self._samples:
+            return {"count": self.count}
+        ordered = sorted(self._samples)
+        return {
+            "count": self.count,
+            "p50": nearest_rank(ordered, 50),
+            "p95": nearest_rank(ordered, 95),
+            "p99": nearest_rank(ordered, 99),
+            "max": ordered[-1],
+        }
+
+def nearest_rank(ordered, p):
+    """
+    nearest_rank returns the p'th percentile of an already sorted list.
+    """
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
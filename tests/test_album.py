@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip('cv2')
+from album import Album
+from kctypes import Direction
+
+def touch(album, name):
+    filename = os.path.join(album.pic_path, name)
+    with open(filename, 'wb'):
+        pass
+    return filename
+
+def make_album(tmp_path, names=(), watch_interval=60):
+    os.makedirs(tmp_path / 'default')
+    for name in names:
+        (tmp_path / 'default' / name).touch()
+    return Album(str(tmp_path), watch_interval=watch_interval)
+
+def shown(album):
+    return os.path.basename(album.load_image()["filename"])
+
+def test_index_is_sorted_by_capture_time(tmp_path):
+    album = make_album(tmp_path, ['20240102000000000000.jpg', '20240101000000000000.jpg', '.hidden'])
+    try:
+        assert album.gallery_size == 2
+        assert shown(album) == '20240101000000000000.jpg'
+    finally:
+        album.close()
+
+def test_add_file_keeps_the_same_file_shown(tmp_path):
+    album = make_album(tmp_path, ['20240101000000000000.jpg', '20240103000000000000.jpg'])
+    try:
+        album.gallery_scroll(Direction.FWD)
+        album.add_file(touch(album, '20240102000000000000.jpg'))
+        assert album.gallery_size == 3
+        assert shown(album) == '20240103000000000000.jpg'
+        assert os.path.basename(album.peek(-1)["filename"]) == '20240102000000000000.jpg'
+        # Adding it again doesn't index it twice
+        album.add_file(os.path.join(album.pic_path, '20240102000000000000.jpg'))
+        assert album.gallery_size == 3
+    finally:
+        album.close()
+
+def test_refresh_index_keeps_the_same_file_shown(tmp_path):
+    album = make_album(tmp_path, ['20240101000000000000.jpg', '20240103000000000000.jpg'])
+    try:
+        album.gallery_scroll(Direction.FWD)
+        # Added and removed outside of the app, before the shown file
+        touch(album, '20240102000000000000.jpg')
+        album.refresh_index()
+        assert shown(album) == '20240103000000000000.jpg'
+        os.remove(os.path.join(album.pic_path, '20240101000000000000.jpg'))
+        os.remove(os.path.join(album.pic_path, '20240102000000000000.jpg'))
+        album.refresh_index()
+        assert shown(album) == '20240103000000000000.jpg'
+    finally:
+        album.close()
+
+def test_refresh_index_moves_on_from_a_removed_file(tmp_path):
+    album = make_album(tmp_path, ['20240101000000000000.jpg', '20240102000000000000.jpg', '20240103000000000000.jpg'])
+    try:
+        album.gallery_scroll(Direction.FWD)
+        os.remove(os.path.join(album.pic_path, '20240102000000000000.jpg'))
+        album.refresh_index()
+        assert shown(album) == '20240103000000000000.jpg'
+        os.remove(os.path.join(album.pic_path, '20240103000000000000.jpg'))
+        album.refresh_index()
+        assert shown(album) == '20240101000000000000.jpg'
+    finally:
+        album.close()
+
+def test_watcher_picks_up_outside_changes(tmp_path):
+    album = make_album(tmp_path, ['20240101000000000000.jpg'], watch_interval=0.01)
+    try:
+        touch(album, '20240102000000000000.jpg')
+        deadline = time.monotonic() + 5
+        while album.gallery_size != 2:
+            assert time.monotonic() < deadline, 'Watcher never refreshed the index'
+            time.sleep(0.01)
+        assert shown(album) == '20240101000000000000.jpg'
+    finally:
+        album.close()
@@ -0,0 +1,142 @@
+import time
+
+import pytest
+
+pytest.importorskip('numpy')
+from fake_camera import FakePicamera2
+
+import constants
+from camera_manager import CameraManager
+from kctypes import Camera, CaptureMode
+
+# Stands in for the Recorder, remembering which camera it's attached to
+class FakeRecorder():
+    def __init__(self):
+        self.attached = None
+        self.attaches = 0
+
+    def attach(self, cam):
+        self.attached = cam
+        self.attaches += 1
+
+    def detach(self):
+        self.attached = None
+
+# A camera whose start fails the given number of times
+class FlakyPicamera2(FakePicamera2):
+    def __init__(self, camera_id, failures=0, **kwargs):
+        super().__init__(camera_id, **kwargs)
+        self.failures = failures
+
+    def start(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('Camera failed to start')
+        super().start()
+
+def make_manager(start_delay=0.0, recorder=None, failures=None):
+    failures = failures or {}
+    backend = lambda camera_id: FlakyPicamera2(camera_id, failures=failures.get(camera_id, 0), fps=100,
+        sensor_resolution=(64, 48), start_delay=start_delay)
+    manager = CameraManager(backend=backend, recorder=recorder)
+    manager.start(Camera.SELFIE, CaptureMode.PICTURE)
+    return manager
+
+def wait_for_switch(manager, timeout=5):
+    deadline = time.monotonic() + timeout
+    while manager.is_switching or manager._switch_thread is not None:
+        assert time.monotonic() < deadline, 'Switch never finished'
+        time.sleep(0.01)
+
+def test_start_makes_the_camera_live():
+    manager = make_manager()
+    try:
+        assert manager.device is manager._cameras[Camera.SELFIE]
+        assert manager.capture_preview() is not None
+        # Starting up isn't a switch
+        assert manager.stats() == {"switches": 0}
+    finally:
+        manager.close()
+
+def test_switch_changes_the_live_camera():
+    manager = make_manager()
+    try:
+        manager.switch(Camera.FORWARD, CaptureMode.PICTURE)
+        wait_for_switch(manager)
+        assert manager.device is manager._cameras[Camera.FORWARD]
+        assert not manager._cameras[Camera.SELFIE].started
+        assert manager.stats()["switches"] == 1
+    finally:
+        manager.close()
+
+def test_last_frame_is_shown_while_switching():
+    manager = make_manager(start_delay=0.3)
+    try:
+        frame = manager.capture_preview()
+        manager.switch(Camera.FORWARD, CaptureMode.PICTURE)
+        # The forward camera takes a while to start, so the switch is soon
+        # under way with no live device
+        deadline = time.monotonic() + 1
+        while manager.device is not None:
+            assert time.monotonic() < deadline
+            time.sleep(0.005)
+        assert manager.capture_preview() is frame
+        wait_for_switch(manager)
+        assert manager.capture_preview() is not frame
+    finally:
+        manager.close()
+
+def test_restart_is_not_timed_as_a_switch():
+    manager = make_manager()
+    try:
+        manager.restart()
+        wait_for_switch(manager)
+        assert manager.device is manager._cameras[Camera.SELFIE]
+        assert manager.stats() == {"switches": 0}
+    finally:
+        manager.close()
+
+def test_recorder_follows_video_mode():
+    recorder = FakeRecorder()
+    manager = make_manager(recorder=recorder)
+    try:
+        assert recorder.attached is None
+        manager.switch(Camera.SELFIE, CaptureMode.VIDEO)
+        wait_for_switch(manager)
+        assert recorder.attached is manager._cameras[Camera.SELFIE]
+        manager.switch(Camera.FORWARD, CaptureMode.PICTURE)
+        wait_for_switch(manager)
+        assert recorder.attached is None
+        manager.switch(Camera.FORWARD, CaptureMode.VIDEO)
+        wait_for_switch(manager)
+        assert recorder.attached is manager._cameras[Camera.FORWARD]
+    finally:
+        manager.close()
+    # Closing detaches it too
+    assert recorder.attached is None
+    assert recorder.attaches == 2
+
+def test_failed_switch_is_retried(monkeypatch):
+    monkeypatch.setattr(constants, 'CAMERA_SWITCH_RETRY_SECONDS', 0)
+    manager = make_manager(failures={constants.CAM_FWD_ID: 1})
+    try:
+        manager.switch(Camera.FORWARD, CaptureMode.PICTURE)
+        wait_for_switch(manager)
+        assert manager.device is manager._cameras[Camera.FORWARD]
+    finally:
+        manager.close()
+
+def test_switch_can_be_asked_for_again_after_giving_up(monkeypatch):
+    monkeypatch.setattr(constants, 'CAMERA_SWITCH_RETRY_SECONDS', 0)
+    manager = make_manager(failures={constants.CAM_FWD_ID: constants.CAMERA_SWITCH_ATTEMPTS})
+    try:
+        manager.switch(Camera.FORWARD, CaptureMode.PICTURE)
+        wait_for_switch(manager)
+        assert manager.device is None
+        assert manager._switch_thread is None
+        # The camera has stopped failing, so asking again brings it up
+        manager.switch(Camera.FORWARD, CaptureMode.PICTURE)
+        wait_for_switch(manager)
+        assert manager.device is manager._cameras[Camera.FORWARD]
+    finally:
+        manager.close()
@@ -0,0 +1,43 @@
+import io
+
+import pytest
+
+pytest.importorskip('numpy')
+from fake_camera import FakeCircularOutput, FakeH264Encoder, FakePicamera2, h264_frames
+
+def nal(nal_type, payload=b'\xaa\xbb', long_start=False):
+    start = b'\x00\x00\x00\x01' if long_start else b'\x00\x00\x01'
+    return start + bytes([0x60 | nal_type]) + payload
+
+def test_h264_frames_groups_parameter_sets_with_their_keyframe():
+    sps, pps, idr, p1, p2 = nal(7, long_start=True), nal(8), nal(5), nal(1), nal(1, b'\xcc')
+    frames = h264_frames(sps + pps + idr + p1 + p2)
+    assert frames == [(sps + pps + idr, True), (p1, False), (p2, False)]
+
+def test_encoder_loops_over_its_frames():
+    encoder = FakeH264Encoder(frames=[(b'a', True), (b'b', False)])
+    assert [encoder.encode_next() for _ in range(3)] == [(b'a', True), (b'b', False), (b'a', True)]
+    assert FakeH264Encoder().encode_next() is None
+
+def test_circular_output_starts_from_a_keyframe():
+    output = FakeCircularOutput(buffersize=3)
+    for frame in [(b'1', True), (b'2', False), (b'3', True), (b'4', False)]:
+        output.outputframe(*frame)
+    output.fileoutput = io.BytesIO()
+    output.start()
+    output.outputframe(b'5', False)
+    output.stop()
+    output.outputframe(b'6', False)
+    # The buffer only held 2, 3 and 4, and 2 isn't a keyframe
+    assert output.fileoutput.getvalue() == b'345'
+
+def test_only_streams_that_are_read_are_filled():
+    cam = FakePicamera2(fps=1000, sensor_resolution=(64, 48))
+    cam.configure(cam.create_preview_configuration(main={"size": (64, 48), "format": "XBGR8888"},
+        lores={"size": (32, 24), "format": "YUV420"}))
+    cam.start()
+    lores = cam.capture_array("lores")
+    assert lores[0, 0] == cam.frames % 256
+    assert "main" not in cam._filled
+    request = cam.capture_request()
+    assert request.make_array("main")[0, 0, 0] == cam.frames % 256
@@ -0,0 +1,78 @@
+import logging
+import time
+
+from flight_recorder import FlightRecorder
+
+def make_logger(recorder, name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.handlers = [recorder]
+    return logger
+
+def test_repeats_are_skipped(tmp_path):
+    recorder = FlightRecorder(dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.repeats')
+    for _ in range(5):
+        logger.info('Polling')
+    assert [record.getMessage() for record in recorder.records] == ['Polling']
+
+def test_different_arguments_are_kept(tmp_path):
+    recorder = FlightRecorder(dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.arguments')
+    for i in range(5):
+        logger.info('Loading %s', i)
+    assert [record.getMessage() for record in recorder.records] == ['Loading {}'.format(i) for i in range(5)]
+
+def test_warnings_are_never_skipped(tmp_path):
+    recorder = FlightRecorder(dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.warnings')
+    for _ in range(3):
+        logger.warning('Failed to read the sensor')
+    assert len(recorder.records) == 3
+
+def test_skipped_count_is_noted(tmp_path):
+    recorder = FlightRecorder(repeat_seconds=5, dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.skipped')
+    def poll():
+        logger.info('Polling')
+    for _ in range(4):
+        poll()
+    # Pretend the first one was kept long enough ago
+    for kept in recorder._last_kept.values():
+        kept[0] -= 10
+    poll()
+    assert [record.skipped for record in recorder.records] == [0, 3]
+
+def test_dump_writes_every_record(tmp_path):
+    recorder = FlightRecorder(dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.dump')
+    logger.info('first')
+    logger.info('second')
+    path = recorder.dump('test')
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith('first') and lines[1].endswith('second')
+
+def test_error_dumps_in_the_background(tmp_path):
+    recorder = FlightRecorder(dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.error')
+    logger.error('Something broke')
+    deadline = time.monotonic() + 2
+    while not list(tmp_path.iterdir()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [path.name.endswith('-error.log') for path in tmp_path.iterdir()] == [True]
+
+def test_old_repeats_are_forgotten(tmp_path):
+    recorder = FlightRecorder(repeat_seconds=5, dump_dir=str(tmp_path))
+    logger = make_logger(recorder, 'test.prune')
+    for i in range(100):
+        logger.info('Loading %s', i)
+    assert len(recorder._last_kept) == 100
+    # Pretend they were all kept long enough ago
+    for kept in recorder._last_kept.values():
+        kept[0] -= 10
+    recorder._pruned_at -= 10
+    logger.info('Loading %s', 'another')
+    assert len(recorder._last_kept) == 1
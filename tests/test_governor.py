@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+from fake_thermal import FakeThermal
+from governor import QualityGovernor, step_level
+import constants
+
+Battery = namedtuple('Battery', ['percent', 'secsleft', 'power_plugged'])
+
+def on_battery(percent):
+    return Battery(percent=percent, secsleft=None, power_plugged=False)
+
+CHARGING = Battery(percent=30, secsleft=None, power_plugged=True)
+COOL = 50
+
+def test_step_level_goes_up_straight_away():
+    assert step_level(5, [10, 20, 30], 5, 0) == 0
+    assert step_level(10, [10, 20, 30], 5, 0) == 1
+    assert step_level(25, [10, 20, 30], 5, 0) == 2
+    assert step_level(35, [10, 20, 30], 5, 1) == 3
+
+def test_step_level_comes_down_past_the_margin():
+    # Just under the threshold isn't enough to leave it
+    assert step_level(18, [10, 20, 30], 5, 2) == 2
+    assert step_level(15, [10, 20, 30], 5, 2) == 1
+    # Well clear of several thresholds drops several levels
+    assert step_level(0, [10, 20, 30], 5, 3) == 0
+
+def test_charging_is_full_quality():
+    governor = QualityGovernor(lambda: CHARGING, FakeThermal(COOL).read)
+    assert governor.update(CHARGING, COOL, now=0) == 0
+    assert governor.update(None, COOL, now=1) == 0
+
+def test_battery_hysteresis_and_dwell():
+    governor = QualityGovernor(None)
+    assert governor.update(on_battery(80), COOL, now=0) == 0
+    assert governor.update(on_battery(49), COOL, now=1) == 1
+    assert governor.quality["name"] == 'saver'
+    # Back above the threshold, but not by the margin
+    assert governor.update(on_battery(52), COOL, now=100) == 1
+    # Clear by the margin, but too soon after the last change
+    governor.update(on_battery(10), COOL, now=200)
+    assert governor.level == 2
+    assert governor.update(on_battery(80), COOL, now=200 + constants.GOVERNOR_MIN_DWELL_SECONDS / 2) == 2
+    assert governor.update(on_battery(80), COOL, now=200 + constants.GOVERNOR_MIN_DWELL_SECONDS + 1) == 0
+    assert governor.changes == 3
+
+def test_worse_of_battery_and_temperature_wins():
+    governor = QualityGovernor(None)
+    hot = constants.GOVERNOR_TEMPERATURE_THRESHOLDS[-1]
+    assert governor.update(on_battery(80), hot, now=0) == len(constants.QUALITY_LADDER) - 1
+    assert not governor.quality["background_jobs"]
+    # Cooled down, but the battery now wants the first step down
+    assert governor.update(on_battery(45), COOL, now=100) == 1
+
+def test_unknown_charge_is_not_full_quality():
+    governor = QualityGovernor(None)
+    assert governor.update(on_battery(None), COOL, now=0) == 1
+
+def test_sample_reads_both_sources():
+    thermal = FakeThermal(COOL)
+    governor = QualityGovernor(lambda: on_battery(80), thermal.read)
+    assert governor.sample() == 0
+    thermal.temperature = constants.GOVERNOR_TEMPERATURE_THRESHOLDS[0]
+    assert governor.sample() == 1
+    assert thermal.reads == 2
+
+def test_read_errors_are_counted_and_survived():
+    readings = [on_battery(45)]
+    def battery():
+        if not readings:
+            raise RuntimeError('Sensor went away')
+        return readings.pop()
+    def thermal():
+        raise OSError('No thermal zone')
+    governor = QualityGovernor(battery, thermal)
+    assert governor.sample() == 1
+    # The last battery status is kept
+    assert governor.sample() == 1
+    assert governor.read_errors == 3
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+gpiozero = pytest.importorskip('gpiozero')
+from gpiozero.pins.mock import MockFactory
+
+import constants
+from gpioinput import GPIOInput
+
+@pytest.fixture
+def gpio():
+    factory = MockFactory()
+    gpio = GPIOInput(pygame_event_fn=lambda key, **attributes: None, encoder_event_key=1, pin_factory=factory)
+    yield gpio
+    gpio.encoder.close()
+    gpio.capture_button.close()
+    for selector in (gpio.selector_a, gpio.selector_b, gpio.selector_c, gpio.selector_d):
+        selector.close()
+    factory.reset()
+
+def tick(gpio, edge_gap):
+    # One detent: a full quadrature cycle on the encoder's two pins
+    a = gpio.encoder.a.pin
+    b = gpio.encoder.b.pin
+    for edge in (a.drive_low, b.drive_low, a.drive_high, b.drive_high):
+        edge()
+        time.sleep(edge_gap)
+
+def test_slow_ticks_are_one_step_each(gpio):
+    for _ in range(3):
+        tick(gpio, constants.ENCODER_FAST_TICK_SECONDS)
+    direction, steps = gpio.take_encoder_steps()
+    assert steps == 3
+
+def test_fast_ticks_accelerate(gpio):
+    for _ in range(10):
+        tick(gpio, constants.ENCODER_BOUNCE_SECONDS * 2)
+    direction, steps = gpio.take_encoder_steps()
+    assert steps > 10
+    assert steps <= 10 * constants.ENCODER_ACCEL_MAX
+
+def test_steps_are_taken_once(gpio):
+    tick(gpio, constants.ENCODER_FAST_TICK_SECONDS)
+    assert gpio.take_encoder_steps()[1] == 1
+    assert gpio.take_encoder_steps()[1] == 0
@@ -0,0 +1,40 @@
+import time
+
+from latency import LatencyTracker
+
+def test_event_waits_for_its_own_layer():
+    tracker = LatencyTracker()
+    tracker.started('encoder', time.monotonic(), {'background'})
+    tracker.frame_started()
+    # Only the overlay changed, so the tick isn't on screen yet
+    tracker.presented({'profiler'})
+    assert tracker.summary() == {}
+    tracker.presented({'background', 'profiler'})
+    assert tracker.summary()['encoder']['count'] == 1
+
+def test_event_without_layers_counts_any_change():
+    tracker = LatencyTracker()
+    tracker.started('key', time.monotonic())
+    tracker.frame_started()
+    tracker.presented(set())
+    assert tracker.summary() == {}
+    tracker.presented({'battery'})
+    assert tracker.summary()['key']['count'] == 1
+
+def test_event_handled_after_render_waits_a_frame():
+    tracker = LatencyTracker()
+    tracker.frame_started()
+    tracker.started('encoder', time.monotonic(), {'background'})
+    tracker.presented({'background'})
+    assert tracker.summary() == {}
+    tracker.frame_started()
+    tracker.presented({'background'})
+    assert tracker.summary()['encoder']['count'] == 1
+
+def test_unshown_events_time_out():
+    tracker = LatencyTracker(pending_timeout=1)
+    tracker.started('selector', time.monotonic() - 2, {'camera_label'})
+    tracker.frame_started()
+    tracker.presented({'background'})
+    assert tracker.timed_out == 1
+    assert tracker.summary() == {}
@@ -0,0 +1,92 @@
+import pytest
+
+from fake_smbus import FakeSMBus, _REG_CALIBRATION, _REG_CONFIG
+from power import PowerMonitor, UNKNOWN_POWER
+from UPS_HAT.INA219 import INA219
+import constants
+
+def register_writes(bus, register):
+    return [write for write in bus.writes if write[1] == register]
+
+def test_setup_writes_calibration_and_config_once():
+    bus = FakeSMBus()
+    sensor = INA219(addr=0x42, bus=bus)
+    assert len(register_writes(bus, _REG_CALIBRATION)) == 1
+    assert len(register_writes(bus, _REG_CONFIG)) == 1
+    for _ in range(5):
+        sensor.read_all()
+    # Reading doesn't write anything while the chip keeps its registers
+    assert len(bus.writes) == 2
+
+def test_read_all():
+    bus = FakeSMBus(voltage=7.8, current_ma=-400.0)
+    voltage, shunt_mv, current_ma, power_w = INA219(addr=0x42, bus=bus).read_all()
+    assert voltage == pytest.approx(7.8, abs=0.004)
+    assert shunt_mv == pytest.approx(-40.0, abs=0.01)
+    assert current_ma == pytest.approx(-400.0, abs=0.1)
+    assert power_w == pytest.approx(3.12, abs=0.01)
+
+def test_brownout_recovery():
+    bus = FakeSMBus(current_ma=-400.0)
+    sensor = INA219(addr=0x42, bus=bus)
+    bus.brownout()
+    _, _, current_ma, _ = sensor.read_all()
+    assert current_ma == pytest.approx(-400.0, abs=0.1)
+    # Both registers the brownout reset are written again
+    assert bus.registers[_REG_CALIBRATION] == sensor._cal_value
+    assert bus.registers[_REG_CONFIG] == sensor.config
+    assert len(register_writes(bus, _REG_CALIBRATION)) == 2
+    assert len(register_writes(bus, _REG_CONFIG)) == 2
+
+def test_unknown_until_first_reading():
+    monitor = PowerMonitor(bus=FakeSMBus())
+    assert monitor.read() is UNKNOWN_POWER
+    assert not monitor.read().power_plugged
+
+def test_snapshot():
+    monitor = PowerMonitor(bus=FakeSMBus(voltage=7.8, current_ma=-400.0))
+    monitor.sample()
+    snapshot = monitor.read()
+    expected = (7.8 - constants.POWER_EMPTY_VOLTS) / (constants.POWER_FULL_VOLTS - constants.POWER_EMPTY_VOLTS) * 100
+    assert snapshot.percent == pytest.approx(expected, abs=0.5)
+    assert not snapshot.power_plugged
+    assert snapshot.voltage == pytest.approx(7.8, abs=0.004)
+    assert snapshot.read_at is not None
+
+def test_percent_is_clamped():
+    bus = FakeSMBus(voltage=9.0)
+    monitor = PowerMonitor(bus=bus)
+    monitor.sample()
+    assert monitor.read().percent == 100
+    monitor = PowerMonitor(bus=FakeSMBus(voltage=5.0))
+    monitor.sample()
+    assert monitor.read().percent == 0
+
+def test_smoothing():
+    bus = FakeSMBus(voltage=7.0, current_ma=-400.0)
+    monitor = PowerMonitor(bus=bus, smoothing=0.25)
+    monitor.sample()
+    bus.voltage = 8.0
+    bus.current_ma = 600.0
+    monitor.sample()
+    snapshot = monitor.read()
+    # Each sample moves the smoothed readings a quarter of the way
+    assert snapshot.voltage == pytest.approx(7.25, abs=0.004)
+    assert snapshot.current_ma == pytest.approx(-150.0, abs=0.1)
+    assert not snapshot.power_plugged
+    monitor.sample()
+    monitor.sample()
+    # -150 -> 37.5 -> 178.1, above POWER_CHARGING_MA
+    assert monitor.read().power_plugged
+
+def test_read_errors_keep_the_last_snapshot():
+    bus = FakeSMBus()
+    monitor = PowerMonitor(bus=bus)
+    monitor.sample()
+    snapshot = monitor.read()
+    def fail(*args):
+        raise OSError('Remote I/O error')
+    bus.read_i2c_block_data = fail
+    monitor.sample()
+    assert monitor.read() is snapshot
+    assert monitor.read_errors == 1
@@ -0,0 +1,138 @@
+import logging
+import queue
+import threading
+import time
+
+import cv2
+import pygame
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+# Plays a video file in the gallery.
+# A background thread decodes the file, scales and converts each frame into a
+# display-ready surface, and puts it on a short queue. The render loop asks for
+# whichever frame is due right now: frames are timed against the wall clock
+# from when playback started, so if rendering falls behind, late frames are
+# dropped rather than the whole video slowing down. If decoding falls behind,
+# the decoder skips past frames that are already late without converting them,
+# so it catches up with the clock instead of drifting further behind it.
+# The decoder can be pointed at a different file than the one being played,
+# such as a low resolution proxy of it.
+# Frames are numbered continuously across loops of the file, and the decoder
+# rewinds on its own thread while frames from the end of the previous loop are
+# still queued, so the video loops without a stall.
+class VideoPlayer():
+    def __init__(self, filename, fps=None, source=None, size=constants.DISPLAY_SIZE, queue_frames=constants.VIDEO_QUEUE_FRAMES):
+        logger.debug('Function VideoPlayer __init__')
+        self.filename = filename
+        self.source = source if source is not None else filename
+        self.size = size
+        # If the frame rate isn't known up front, the file's own rate replaces
+        # this once it's open
+        self._fps_known = fps is not None
+        self.fps = fps if fps is not None else constants.PREVIEW_FPS
+        self.presented = 0
+        self.dropped = 0
+        self.skipped = 0                     # Frames the decoder skipped for being late
+        self._frames = queue.Queue(maxsize=queue_frames)
+        self._stop_event = threading.Event()
+        self._started_at = None              # When the first frame was shown
+        self._current = None                 # The surface currently on screen
+        self._pending = None                 # A decoded (index, surface) that isn't due yet
+        self._thread = threading.Thread(target=self._decode, name='video-player', daemon=True)
+        self._thread.start()
+
+    def current_frame(self):
+        """
+        current_frame returns the surface that should be on screen now. It
+        returns the same surface object until the next frame is due, and None
+        until the first frame has been decoded. It never waits on the decoder.
+        """
+        now = time.monotonic()
+        newest = None
+        while True:
+            if self._pending is None:
+                try:
+                    self._pending = self._frames.get_nowait()
+                except queue.Empty:
+                    break
+            index, surface = self._pending
+            if self._started_at is None:
+                # Start the clock with the first frame, so the time spent
+                # opening the file doesn't count as falling behind
+                self._started_at = now - index / self.fps
+            if index > int((now - self._started_at) * self.fps):
+                break
+            # A later frame is also due, so this one is too late to show
+            if newest is not None:
+                self.dropped += 1
+            newest = surface
+            self._pending = None
+        if newest is not None:
+            self._current = newest
+            self.presented += 1
+        return self._current
+
+    def close(self):
+        """
+        close stops the decoder thread and releases the file.
+        """
+        logger.debug('Function close')
+        self._stop_event.set()
+        # Unblock the decoder if it's waiting for room on the queue
+        try:
+            while True:
+                self._frames.get_nowait()
+        except queue.Empty:
+            pass
+        logger.info('Played %s: presented %s frames, dropped %s, skipped %s undecoded',
+            self.filename, self.presented, self.dropped, self.skipped)
+
+    def _decode(self):
+        video = cv2.VideoCapture(self.source)
+        try:
+            if not self._fps_known:
+                fps = video.get(cv2.CAP_PROP_FPS)
+                if fps and fps > 0:
+                    self.fps = fps
+            index = 0
+            frames_this_loop = 0
+            while not self._stop_event.is_set():
+                success = video.grab()
+                if not success:
+                    if frames_this_loop == 0:
+                        logger.warning('Could not read any frames from %s', self.source)
+                        return
+                    # Rewind for the next loop, while the UI is still showing
+                    # frames from this one
+                    if not video.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                        # Raw streams can't always seek, so open them again
+                        video.release()
+                        video = cv2.VideoCapture(self.source)
+                    frames_this_loop = 0
+                    continue
+                frames_this_loop += 1
+                started_at = self._started_at
+                if started_at is not None and index < int((time.monotonic() - started_at) * self.fps):
+                    # Already late - move on without converting it
+                    self.skipped += 1
+                    index += 1
+                    continue
+                success, frame = video.retrieve()
+                if not success:
+                    index += 1
+                    continue
+                frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                surface = pygame.image.frombuffer(frame.tobytes(), self.size, "RGB")
+                while not self._stop_event.is_set():
+                    try:
+                        self._frames.put((index, surface), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                index += 1
+        finally:
+            video.release()